@@ -0,0 +1,207 @@
+/*CONTROL SYSTEM FOR STEPPER MOTORS ATTACHED TO SHAKER 1, FRAMED BINARY PROTOCOL
+
+  Same motors as Shaker_Motor_v2 but commands arrive as binary frames (see labequipment/stepper.py
+  FramedStepper) rather than text lines:
+
+    SYNC(0x7E)  LEN  SEQ  CMD  PAYLOAD[LEN]  CRC16 (CCITT, big endian, over LEN..PAYLOAD)
+
+  Moves are queued as they arrive and acknowledged straight away, so the PC can send several without
+  waiting. Each motor has its own queue. Every pass of loop() takes one step of each motor that has a
+  move, so both motors move at once and incoming frames are read while they do. A DONE frame is sent as
+  each move finishes. Frames failing their CRC are ignored, the PC sends them again.
+*/
+
+#include <Wire.h>
+#include <Adafruit_MotorShield.h>
+#include "utility/Adafruit_MS_PWMServoDriver.h"
+
+/*Setup stepper motors*/
+Adafruit_MotorShield AFMS = Adafruit_MotorShield();  // Create an instance of the Adafruit Motor Shield
+Adafruit_StepperMotor *stepper1 = AFMS.getStepper(200, 1);  // Stepper motor 1 object
+Adafruit_StepperMotor *stepper2 = AFMS.getStepper(200, 2);  // Stepper motor 2 object
+
+/* Protocol, must match labequipment/stepper.py */
+const byte SYNC = 0x7E;
+const long MAX_STEPS = 100000;
+const byte QUEUE_SIZE = 8;
+const byte MAX_PAYLOAD = 8;
+
+const byte MOVE = 0x01;
+const byte PING = 0x02;
+const byte HELLO = 0x03;
+
+const byte ACK = 0x81;
+const byte DONE = 0x82;
+const byte NAK = 0x83;
+const byte PONG = 0x84;
+
+const byte NAK_SEQUENCE = 1;
+const byte NAK_QUEUE_FULL = 2;
+const byte NAK_INVALID = 3;
+
+/* Queue of moves for each motor, moves[head] is the one being carried out */
+struct Move {
+  byte seq;
+  long steps;
+};
+struct Motor {
+  Adafruit_StepperMotor *stepper;
+  Move moves[QUEUE_SIZE];
+  byte head;
+  byte queued;
+  long stepsLeft;                                                    // Microsteps left of moves[head]
+  boolean moving;
+  byte lastDone;                                                     // SEQ of the last move finished
+  boolean anyDone;                                                   // since the motor was last given a move
+};
+Motor motors[2] = {{stepper1}, {stepper2}};
+
+byte expected = 0;                                                   // SEQ of the next move
+
+/* Incoming frame */
+byte frame[MAX_PAYLOAD + 5];                                         // LEN SEQ CMD PAYLOAD CRC
+byte received = 0;
+boolean inFrame = false;
+
+unsigned int crc16(const byte *data, byte length) {
+  unsigned int crc = 0xFFFF;
+  for (byte i = 0; i < length; i++) {
+    crc ^= (unsigned int)data[i] << 8;
+    for (byte bit = 0; bit < 8; bit++) {
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+    }
+  }
+  return crc;
+}
+
+void sendFrame(byte seq, byte cmd, const byte *payload, byte length) {
+  byte out[MAX_PAYLOAD + 6];
+  out[0] = SYNC;
+  out[1] = length;
+  out[2] = seq;
+  out[3] = cmd;
+  memcpy(out + 4, payload, length);
+  unsigned int crc = crc16(out + 1, length + 3);
+  out[4 + length] = crc >> 8;
+  out[5 + length] = crc & 0xFF;
+  Serial.write(out, length + 6);
+}
+
+void sendReply(byte seq, byte cmd, byte value) {
+  sendFrame(seq, cmd, &value, 1);
+}
+
+void sendStatus(byte seq) {
+  byte status[4];
+  for (byte i = 0; i < 2; i++) {
+    status[2 * i] = motors[i].anyDone ? motors[i].lastDone : 0;
+    status[2 * i + 1] = motors[i].anyDone;
+  }
+  sendFrame(seq, PONG, status, 4);
+}
+
+/* Act on a frame whose CRC has been checked */
+void processFrame(byte seq, byte cmd, const byte *payload, byte length) {
+  switch (cmd) {
+    case HELLO:                                                                       // Take our sequence numbers from the PC
+      expected = seq;
+      motors[0].anyDone = false;
+      motors[1].anyDone = false;
+      sendStatus(seq);
+      break;
+    case PING:                                                                        // Report the last move each motor finished
+      sendStatus(seq);
+      break;
+    case MOVE:
+      if (seq == expected) {
+        long steps = 0;
+        if (length == 5) {
+          memcpy(&steps, payload + 1, 4);                                               // int32 little endian, AVR is little endian too
+        }
+        if (length != 5 || (payload[0] != 1 && payload[0] != 2) || steps > MAX_STEPS || steps < -MAX_STEPS) {
+          expected++;
+          sendReply(seq, NAK, NAK_INVALID);
+        }
+        else if (motors[payload[0] - 1].queued >= QUEUE_SIZE) {
+          sendReply(seq, NAK, NAK_QUEUE_FULL);                                          // Not taken, the PC sends it again later
+        }
+        else {
+          Motor &motor = motors[payload[0] - 1];
+          Move &move = motor.moves[(motor.head + motor.queued) % QUEUE_SIZE];
+          move.seq = seq;
+          move.steps = steps;
+          motor.queued++;
+          motor.anyDone = false;
+          expected++;
+          sendReply(seq, ACK, QUEUE_SIZE - motor.queued);
+        }
+      }
+      else if ((byte)(expected - seq) < 128) {                                      // Sent again after our ACK was lost
+        sendReply(expected - 1, ACK, 0);
+      }
+      else {                                                                          // A move before this one was lost
+        sendReply(expected, NAK, NAK_SEQUENCE);
+      }
+      break;
+  }
+}
+
+/* Serial Reading, assembles frames byte by byte */
+void processIncomingByte(const byte inByte) {
+  if (!inFrame) {
+    inFrame = inByte == SYNC;
+    received = 0;
+    return;
+  }
+  frame[received++] = inByte;
+  if (received == 1 && frame[0] > MAX_PAYLOAD) {                                    // Can't be a frame, wait for the next SYNC
+    inFrame = false;
+    return;
+  }
+  if (received == frame[0] + 5) {
+    inFrame = false;
+    byte length = frame[0];
+    unsigned int crc = ((unsigned int)frame[length + 3] << 8) | frame[length + 4];
+    if (crc == crc16(frame, length + 3)) {
+      processFrame(frame[1], frame[2], frame + 3, length);
+    }
+  }
+}
+
+/* Take one step of the motor's current move, starting the next when it finishes */
+void stepMotor(Motor &motor) {
+  if (!motor.moving) {
+    if (motor.queued == 0) {
+      return;
+    }
+    motor.stepsLeft = labs(motor.moves[motor.head].steps) * MICROSTEPS;             // As step() with MICROSTEP style in v2
+    motor.moving = true;
+  }
+  Move &move = motor.moves[motor.head];
+  if (motor.stepsLeft > 0) {
+    motor.stepper->onestep(move.steps > 0 ? FORWARD : BACKWARD, MICROSTEP);
+    motor.stepsLeft--;
+    return;
+  }
+  motor.stepper->release();
+  motor.moving = false;
+  motor.lastDone = move.seq;
+  motor.anyDone = true;
+  motor.head = (motor.head + 1) % QUEUE_SIZE;
+  motor.queued--;
+  sendFrame(move.seq, DONE, NULL, 0);
+}
+
+void setup() {
+  AFMS.begin();  // Initialize the Adafruit Motor Shield
+  Serial.begin(115200);                                                           // Enable serial communication at 115200 baud rate
+  Serial.println("System ready.");                                                // Lets the PC know setup is complete
+}
+
+void loop() {
+  while (Serial.available() > 0) {                                                // Read everything that has arrived
+    processIncomingByte(Serial.read());
+  }
+  stepMotor(motors[0]);                                                           // Interleave the motors' steps
+  stepMotor(motors[1]);
+}
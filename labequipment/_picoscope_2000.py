@@ -1,55 +1,75 @@
 
 from ctypes import byref, c_byte, POINTER, c_int16, c_int32, c_float, c_uint32, sizeof
 from gc import collect
-from time import sleep, time_ns
+from time import perf_counter, time_ns
 
-from picosdk.ps2000 import ps2000
-from picosdk.functions import assert_pico2000_ok, adc2mV, mV2adc
-from picosdk.PicoDeviceEnums import picoEnum
+from picosdk.errors import CannotFindPicoSDKError
+from picosdk.functions import assert_pico2000_ok, mV2adc
 from picosdk.ctypes_wrapper import C_CALLBACK_FUNCTION_FACTORY
+try:
+    from picosdk.ps2000 import ps2000
+except CannotFindPicoSDKError as error:
+    # Without the PicoSDK C libraries only a simulated driver can be used, see _picoscope_sim.py
+    ps2000 = None
+    _sdk_error = error
 
 import matplotlib.pyplot as plt
 import numpy as np
 
-CALLBACK = C_CALLBACK_FUNCTION_FACTORY(None, POINTER(POINTER(c_int16)), c_int16, c_uint32, c_int16, c_int16, c_uint32)
-
-adc_values_a = []
+from .capture_file import CaptureFile, CaptureWriter
+from ._picoscope_common import AcquisitionPlan, adc_to_volts, Capture, channel_values, channel_zeros, group_rows, over_voltage_channels, pop_channels, ScaledCounts, serial_text, StreamBuffer, TimeAxis, volts_per_count, wait_until_ready
 
-def get_overview_buffers_a(buffers, _overflow, _triggered_at, _triggered, _auto_stop, n_values):
-    adc_values_a.extend(buffers[0][0:n_values])
+# The driver aggregates each group of samples to its max and min. Which of the two buffers
+# handed to the streaming callback for each channel to keep for each aggregate_mode
+AGGREGATE_BUFFERS = {'max': (0,), 'min': (1,), 'minmax': (0, 1)}
 
-callback_a = CALLBACK(get_overview_buffers_a)
+CALLBACK = C_CALLBACK_FUNCTION_FACTORY(None, POINTER(POINTER(c_int16)), c_int16, c_uint32, c_int16, c_int16, c_uint32)
 
 
 
 
 def get_timebase(device, samples, wanted_time_interval, oversample=1):
-    current_timebase = 1
+    """
+    Find the timebase just faster than wanted_time_interval (ns).
+
+    The sample interval grows with the timebase so the boundary is found by bisection,
+    ~15 driver calls rather than one per timebase. A timebase the driver rejects counts as too slow.
 
-    old_time_interval = None
+    returns timebase, its sample interval and the time units (c_int16) of that interval
+    """
     time_interval = c_int32(0)
     time_units = c_int16()
     max_samples = c_int32()
 
-    while ps2000.ps2000_get_timebase(
-        device.handle,
-        current_timebase,
-        samples,
-        byref(time_interval),
-        byref(time_units),
-        oversample,
-        byref(max_samples)) == 0 \
-        or time_interval.value < wanted_time_interval:
-
-        current_timebase += 1
-        old_time_interval = time_interval.value
-    
-        if current_timebase.bit_length() > sizeof(c_int16) * 8:
-            raise Exception('No appropriate timebase was identifiable - you might be asking for too many samples')
-
-    return current_timebase - 1, old_time_interval, time_units
+    def interval(timebase):
+        ok = device.driver.ps2000_get_timebase(
+            device.handle,
+            timebase,
+            samples,
+            byref(time_interval),
+            byref(time_units),
+            oversample,
+            byref(max_samples))
+        return time_interval.value if ok else None
+
+    def too_slow(timebase):
+        value = interval(timebase)
+        return value is None or value >= wanted_time_interval
+
+    # Smallest timebase that is too slow lies in (low, high]
+    low, high = 0, 2 ** (sizeof(c_int16) * 8 - 1) - 1
+    while high - low > 1:
+        middle = (low + high) // 2
+        if too_slow(middle):
+            high = middle
+        else:
+            low = middle
 
+    timebase = high - 1
+    if interval(timebase) is None:
+        raise Exception('No appropriate timebase was identifiable - you might be asking for too many samples')
 
+    return timebase, time_interval.value, time_units
 
 
 class PicoScopeDAQ:
@@ -79,8 +99,8 @@ class PicoScopeDAQ:
     For full specs of each model of oscilloscope see here: https://www.picotech.com/download/datasheets/picoscope-2000-series-data-sheet-en.pdf
 
     'stream' mode continuously collects and transfers data to the 
-    pc's buffer allowing long time data collection but at the expense of speed. The code is implemented
-    only for use with channel A. I found there were issues trying to get both to run without losing data
+    pc's buffer allowing long time data collection but at the expense of speed. Channel A, B or Both
+    can be streamed, each channel being copied into its own preallocated buffer.
 
     Import statement
 
@@ -119,12 +139,32 @@ class PicoScopeDAQ:
     """
 
 
-    def __init__(self):
-        """This assumes only one device connected to system. Checks device found and instantiates object"""
-        self.device = ps2000.open_unit()
+    def __init__(self, driver=None, serial=None):
+        """
+        Opens the first device found, or the one with the given serial number, and instantiates object
+
+        serial - batch and serial number eg 'AB123/0001', to choose between several connected scopes. See picoscope.list_scopes()
+        driver - object to use in place of picosdk's ps2000, eg _picoscope_sim.SimulatedPs2000() to run without hardware
+        """
+        if driver is None:
+            if ps2000 is None:
+                raise _sdk_error
+            driver = ps2000
+        self._ps = driver
+        # picosdk's ps2000 works with serial numbers as bytes, everything else here uses str
+        self.device = self._ps.open_unit(serial.encode() if isinstance(serial, str) else serial)
         print('Device info: {}'.format(self.device.info))
+        self.serial = serial_text(self.device.info.serial)
         self.channel_a=False
         self.channel_b=False
+        self.trigger_channel=None
+        self._plan=None
+        # time.perf_counter() just before the driver was told to start the last block capture
+        self.run_started=None
+        # Times the driver's overview buffer overran during the last stream, samples were lost if not 0
+        self.stream_driver_overruns=0
+        # Channels that went over their voltage range during the last stream, eg {'A'}
+        self.stream_over_voltage=set()
 
     def quick_setup(self, param_dict,**kwargs):
         """
@@ -156,15 +196,16 @@ class PicoScopeDAQ:
             voltage_range = int(voltage_range)
 
         if channel == 'A':
-            self._v_range_a=ps2000.PS2000_VOLTAGE_RANGE['PS2000_' + str(voltage_range) + self.voltage_unit]
+            self._v_range_a=self._ps.PS2000_VOLTAGE_RANGE['PS2000_' + str(voltage_range) + self.voltage_unit]
         elif channel == 'B':
-            self._v_range_b=ps2000.PS2000_VOLTAGE_RANGE['PS2000_' + str(voltage_range) + self.voltage_unit]
+            self._v_range_b=self._ps.PS2000_VOLTAGE_RANGE['PS2000_' + str(voltage_range) + self.voltage_unit]
         else:
-            self._v_range_a=ps2000.PS2000_VOLTAGE_RANGE['PS2000_' + str(voltage_range) + self.voltage_unit]
-            self._v_range_b=ps2000.PS2000_VOLTAGE_RANGE['PS2000_' + str(voltage_range) + self.voltage_unit]
+            self._v_range_a=self._ps.PS2000_VOLTAGE_RANGE['PS2000_' + str(voltage_range) + self.voltage_unit]
+            self._v_range_b=self._ps.PS2000_VOLTAGE_RANGE['PS2000_' + str(voltage_range) + self.voltage_unit]
 
         self.sample_rate = sample_rate
         self.oversampling=oversampling
+        self._plan = None
     
         if coupling == 'DC':
             coupling_id=1
@@ -177,18 +218,18 @@ class PicoScopeDAQ:
         if channel == 'A':     
             self.channel_a=True
             self.channel_b=False
-            ps2000._python_set_channel(self.device.handle,channel_A, True,coupling_id,self._v_range_a,None)
-            ps2000._python_set_channel(self.device.handle,channel_B, False,coupling_id,self._v_range_a,None)
+            self._ps._python_set_channel(self.device.handle,channel_A, True,coupling_id,self._v_range_a,None)
+            self._ps._python_set_channel(self.device.handle,channel_B, False,coupling_id,self._v_range_a,None)
         elif channel == 'B':
             self.channel_a=False
             self.channel_b=True
-            ps2000._python_set_channel(self.device.handle,channel_A, False,coupling_id,self._v_range_b,None)
-            ps2000._python_set_channel(self.device.handle,channel_B, True,coupling_id,self._v_range_b,None)
+            self._ps._python_set_channel(self.device.handle,channel_A, False,coupling_id,self._v_range_b,None)
+            self._ps._python_set_channel(self.device.handle,channel_B, True,coupling_id,self._v_range_b,None)
         elif channel == 'Both':
             self.channel_a=True
             self.channel_b=True
-            ps2000._python_set_channel(self.device.handle,channel_A, True,coupling_id,self._v_range_a,None)
-            ps2000._python_set_channel(self.device.handle,channel_B, True,coupling_id,self._v_range_b,None)
+            self._ps._python_set_channel(self.device.handle,channel_A, True,coupling_id,self._v_range_a,None)
+            self._ps._python_set_channel(self.device.handle,channel_B, True,coupling_id,self._v_range_b,None)
         else:
             raise ValueError('Channel must be A, B or Both')
 
@@ -219,123 +260,291 @@ class PicoScopeDAQ:
         
         self._delay = delay
         self._max_wait = max_wait
+        self._plan = None
 
         millivolts = threshold*1000
         self._converted_threshold = mV2adc(millivolts, self._v_range_a, c_int16(32767))       
 
         
-    def start(self, samples=2000):
+    def start(self, samples=2000, raw=False, dtype=np.float64):
         """
         Collect data in block mode. 
 
         start will collect data from setup channels.
         block mode fills picoscope buffer once and then returns the data  (Fast, but limited time)
 
+        raw - return each channel as ScaledCounts (int16 counts plus volts per count) and skip the conversion
+        dtype - np.float64 or np.float32 for the volts
+
         Signal amplitude in V
         Time in s
-        """
-
-        self.samples = samples
-        self.timebase, self.interval, self.time_units = get_timebase(self.device, samples, 1E9/self.sample_rate, oversample=self.oversampling)
 
-        percent_delay = int(100*self._delay*self.sample_rate/self.samples)
-        if percent_delay < -100 or percent_delay > 100:
-            raise ValueError('Delay must not require value greater than number of samples collected. ie |delay| < samples/sample_rate')
-        
-        ps2000.ps2000_set_trigger(c_int16(self.device.handle), c_int16(self.trigger_channel), c_int16(self._converted_threshold), c_int16(int(self._direction)), c_int16(percent_delay), c_int16(int(self._max_wait*1000)))
+        returns a Capture which unpacks as time_s, a, b with time_s a lazy TimeAxis.
+        Use .as_tuple() for the times as an array.
+        """
 
-        print("Using sample rate: {} Hz".format(1E9/self.interval))
+        assert self.channel_a or self.channel_b, 'You must setup a channel before running start'
 
-        channel_a_v, channel_b_v = None, None
+        plan = self._acquisition_plan(samples)
+        self.samples = samples
 
         collection_time = c_int32()
 
-        res = ps2000.ps2000_run_block(
+        self.run_started = perf_counter()
+        res = self._ps.ps2000_run_block(
             self.device.handle,
             self.samples,
-            self.timebase,
+            plan.timebase,
             self.oversampling,
             byref(collection_time)
             )
 
-        while ps2000.ps2000_ready(self.device.handle) == 0:
-            sleep(0.1)
+        # The driver has no block ready callback but does say how long the capture will take
+        wait_until_ready(lambda: self._ps.ps2000_ready(self.device.handle) != 0, collection_time.value / 1000)
 
-        times = (c_int32 * self.samples)()
-        if self.channel_a:
-            buffer_a = (c_int16 * self.samples)()
-        if self.channel_b:
-            buffer_b = (c_int16 * self.samples)()
-        
         overflow = c_byte(0)
 
-        assert self.channel_a or self.channel_b, 'You must setup a channel before running start'
+        res = self._ps.ps2000_get_times_and_values(
+            self.device.handle,
+            plan.pointer('times'),
+            plan.pointer('A'),
+            plan.pointer('B'),
+            None,
+            None,
+            byref(overflow),
+            plan.time_units,
+            self.samples,
+            )
 
-        
-        if self.channel_a and self.channel_b:
-            res = ps2000.ps2000_get_times_and_values(
-                self.device.handle,
-                byref(times),
-                byref(buffer_a),
-                byref(buffer_b),
-                None,
-                None,
-                byref(overflow),
-                self.time_units,  
-                self.samples,
-                )
-            channel_a_v = np.array(adc2mV(buffer_a, self._v_range_a, c_int16(32767)))/1000 # convert from mV to V
-            channel_b_v = np.array(adc2mV(buffer_b, self._v_range_b, c_int16(32767)))/1000   
-        elif self.channel_a:
-            res = ps2000.ps2000_get_times_and_values(
-                self.device.handle,
-                byref(times),
-                byref(buffer_a),
-                None,
-                None,
-                None,
-                byref(overflow),
-                self.time_units,  
-                self.samples,
-                )
-            channel_a_v = np.array(adc2mV(buffer_a, self._v_range_a, c_int16(32767)))/1000 # convert from mV to V
-        elif self.channel_b:
-            res = ps2000.ps2000_get_times_and_values(
-                self.device.handle,
-                byref(times),
-                byref(buffer_b),
-                None,
-                None,
-                None,
-                byref(overflow),
-                self.time_units,  
-                self.samples,
-                )
-            channel_b_v = np.array(adc2mV(buffer_b, self._v_range_b, c_int16(32767)))/1000 # convert from mV to V    
-            
+        # The plan's buffers are reused by the next capture so raw counts are copied out
+        channel_a_v = self._convert(plan.buffers['A'], 'A', raw, dtype, copy=True) if self.channel_a else None
+        channel_b_v = self._convert(plan.buffers['B'], 'B', raw, dtype, copy=True) if self.channel_b else None
 
-        time_s=np.array(times[:])/1E9 # Convert from ns to s
+        # Sampling is uniform so only the first time the driver reports is needed. Convert from ns to s
+        time_s = TimeAxis(plan.buffers['times'][0]/1E9, plan.interval/1E9, self.samples)
         
-        return time_s, channel_a_v, channel_b_v            
+        return Capture(time_s, channel_a_v, channel_b_v)            
+
+    def _acquisition_plan(self, samples):
+        """
+        Timebase, trigger settings and buffers for a block capture of samples.
+
+        Worked out on the first start() after setup_channel or setup_trigger and reused until
+        one of them is called again or a different number of samples is asked for.
+        """
+        if self._plan is not None and self._plan.samples == samples:
+            return self._plan
+
+        self.timebase, self.interval, self.time_units = get_timebase(self.device, samples, 1E9/self.sample_rate, oversample=self.oversampling)
+
+        if self.trigger_channel is not None:
+            percent_delay = int(100*self._delay*self.sample_rate/samples)
+            if percent_delay < -100 or percent_delay > 100:
+                raise ValueError('Delay must not require value greater than number of samples collected. ie |delay| < samples/sample_rate')
+
+            self._ps.ps2000_set_trigger(c_int16(self.device.handle), c_int16(self.trigger_channel), c_int16(self._converted_threshold), c_int16(int(self._direction)), c_int16(percent_delay), c_int16(int(self._max_wait*1000)))
+
+        print("Using sample rate: {} Hz".format(1E9/self.interval))
+
+        buffers = {'times': np.zeros(samples, dtype=np.int32)}
+        if self.channel_a:
+            buffers['A'] = np.zeros(samples, dtype=np.int16)
+        if self.channel_b:
+            buffers['B'] = np.zeros(samples, dtype=np.int16)
+
+        self._plan = AcquisitionPlan(samples, self.timebase, self.interval, buffers,
+                                     time_units=self.time_units, max_adc=32767)
+        return self._plan
     
 
-    def start_streaming(self, collect_time=5, aggregate=1):
+    def start_streaming(self, collect_time=5, aggregate=1, aggregate_mode='max', raw=False, dtype=np.float64):
         """
         Collect data in streaming mode
 
-        Only channel A can be used in streaming mode.
+        The channels set up with setup_channel are streamed simultaneously. A disabled channel is returned as zeros shaped like the enabled one.
 
-        stream mode transfers data repeatedly as requested with no gaps.
-        **Important** if you call start_streaming multiple times you will get 2 sets of data concatenated and all the timing will be wrong.
+        stream mode transfers data repeatedly as requested with no gaps. The samples are copied
+        straight into a preallocated int16 buffer so repeated calls each return a fresh capture.
 
         collect_time: time in seconds to collect for in stream mode, has no effect on block mode
-        aggregate: number of values averaged together and returned as single point in Stream mode
+        aggregate: number of samples the device reduces to a single point, so only 1/aggregate of the data crosses the USB
+        aggregate_mode: 'max' or 'min' of each group of samples, or 'minmax' for both in which case each
+                        channel is returned as a (2, n) array of rows max, min
+        raw: return each channel as ScaledCounts (int16 counts plus volts per count) and skip the conversion
+        dtype: np.float64 or np.float32 for the volts
         """
 
         samples_in_buffer = 1000
+        overview_indices = self._overview_indices(aggregate_mode)
+        self._run_streaming(aggregate, samples_in_buffer)
+
+        # Allow 10% headroom on the expected number of samples so the buffer is not resized mid capture
+        expected_samples = collect_time * 1E9 / (self.interval * aggregate)
+        streams = [StreamBuffer(1.1 * expected_samples + samples_in_buffer) for _ in overview_indices]
+
+        def get_overview_buffers(buffers, overflow, _triggered_at, _triggered, _auto_stop, n_values):
+            if overflow:
+                self.stream_over_voltage.update(over_voltage_channels(overflow))
+            for index, stream in zip(overview_indices, streams):
+                stream.extend_from_pointer(buffers[index], n_values)
+
+        callback = CALLBACK(get_overview_buffers)
+
+        start_time = time_ns()
+        while time_ns() - start_time < collect_time*1E9:               
+            self._poll_streaming(callback)
+            
+        end_time = time_ns()
+        self._ps.ps2000_stop(self.device.handle)
+
+        n_samples = streams[0].n_samples
+        per_channel = len(AGGREGATE_BUFFERS[aggregate_mode])
+        data_a_V = self._convert(channel_values(streams[:per_channel]), 'A', raw, dtype) if self.channel_a else channel_zeros(per_channel, n_samples)
+        data_b_V = self._convert(channel_values(streams[-per_channel:]), 'B', raw, dtype) if self.channel_b else channel_zeros(per_channel, n_samples)
+        
+        times = TimeAxis(0, (end_time - start_time) * 1e-9 / max(n_samples - 1, 1), n_samples)
+
+        return Capture(times, data_a_V, data_b_V)
+
+    def iter_stream(self, chunk_samples=100000, collect_time=None, aggregate=1, aggregate_mode='max'):
+        """
+        Stream the channels set up with setup_channel and yield the data block by block while the scope keeps acquiring.
+
+        Only one block is held in memory at a time so hour long runs can be processed or
+        written to disk as they go rather than returned as one huge array at the end.
+
+        chunk_samples: number of samples in each block yielded. The final block may be shorter.
+        collect_time: time in seconds to stream for. None streams until you stop iterating.
+        aggregate: number of samples the device reduces to a single point
+        aggregate_mode: 'max', 'min' or 'minmax'. With 'minmax' chunk gains an axis of length 2
+                        before the samples holding the max and min, eg (2, n) for one channel
+
+        yields (t0, chunk) where t0 is the time in s of the first sample of the block and chunk is an
+        int16 array of raw ADC counts. chunk is 1d for a single channel and has rows A, B when streaming Both.
+        Convert with pico.counts_to_volts(chunk) or, streaming Both, pico.counts_to_volts(chunk[1], 'B')
+
+        Example:
+
+            for t0, chunk in pico.iter_stream(chunk_samples=50000, collect_time=3600):
+                np.save('block_{}.npy'.format(t0), chunk)
+        """
+        overview_indices = self._overview_indices(aggregate_mode)
+        per_channel = len(AGGREGATE_BUFFERS[aggregate_mode])
+        self._run_streaming(aggregate)
+        dt = self.stream_interval
+
+        pending = [StreamBuffer(2 * chunk_samples) for _ in overview_indices]
+
+        def get_overview_buffers(buffers, overflow, _triggered_at, _triggered, _auto_stop, n_values):
+            if overflow:
+                self.stream_over_voltage.update(over_voltage_channels(overflow))
+            for index, stream in zip(overview_indices, pending):
+                stream.extend_from_pointer(buffers[index], n_values)
+
+        callback = CALLBACK(get_overview_buffers)
+        n_yielded = 0
+
+        try:
+            start_time = time_ns()
+            while collect_time is None or time_ns() - start_time < collect_time*1E9:
+                self._poll_streaming(callback)
+                while pending[0].n_samples >= chunk_samples:
+                    yield n_yielded * dt, pop_channels(pending, chunk_samples, per_channel)
+                    n_yielded += chunk_samples
+            if pending[0].n_samples:
+                yield n_yielded * dt, pop_channels(pending, pending[0].n_samples, per_channel)
+        finally:
+            self._ps.ps2000_stop(self.device.handle)
+
+    def record_streaming(self, filename, collect_time=None, chunk_samples=100000, aggregate=1, aggregate_mode='max', metadata=None):
+        """
+        Stream the channels set up with setup_channel straight into a memory-mapped capture file.
+
+        Only one chunk is held in memory at a time so the length of a recording is limited by disk
+        space, not RAM. With collect_time=None it records until interrupted (ctrl-c); the file is
+        closed properly either way.
+
+        filename - capture file to write, see capture_file.py
+        collect_time - time in seconds to record for, None records until interrupted
+        chunk_samples - samples written to disk at a time
+        aggregate - number of samples the device reduces to a single point
+        aggregate_mode - 'max', 'min' or 'minmax'. 'minmax' stores channels 'A max', 'A min' etc
+        metadata - dict of extra information to keep in the file header
+
+        returns a CaptureFile for the recording. capture.volts('A') gives channel A in volts
+        """
+        channels = [name for name, enabled in (('A', self.channel_a), ('B', self.channel_b)) if enabled]
+        if aggregate_mode == 'minmax':
+            names = [name + suffix for name in channels for suffix in (' max', ' min')]
+            scale = [self.scale_factor(name) for name in channels for _ in range(2)]
+        else:
+            names = channels
+            scale = [self.scale_factor(name) for name in channels]
+        header = {'device': 'ps2000', 'sample_rate': self.sample_rate, 'aggregate': aggregate, 'aggregate_mode': aggregate_mode}
+        header.update(metadata or {})
+        writer = None
+        try:
+            for _, chunk in self.iter_stream(chunk_samples, collect_time, aggregate, aggregate_mode):
+                if writer is None:
+                    # The sample interval is only known once streaming has started
+                    writer = CaptureWriter(filename, names, self.stream_interval, scale=scale, metadata=header)
+                writer.write(chunk.reshape(-1, chunk.shape[-1]))
+        finally:
+            if writer is not None:
+                writer.close()
+        return CaptureFile(filename)
+
+    def scale_factor(self, channel='A'):
+        """Volts per ADC count for channel 'A' or 'B' at its current voltage range"""
+        range_index = self._v_range_a if channel == 'A' else self._v_range_b
+        return volts_per_count(range_index, 32767)
+
+    @property
+    def stream_interval(self):
+        """Time in s between the samples of the current or last stream, after aggregation"""
+        return self._stream_interval_ns / 1E9
+
+    def counts_to_volts(self, counts, channel='A', dtype=np.float64, out=None):
+        """
+        Convert raw ADC counts from iter_stream or a raw capture to volts.
+
+        channel - 'A' or 'B', picks the voltage range
+        dtype - np.float64 or np.float32
+        out - optional float array to write the volts into, eg one reused for every chunk of a stream
+        """
+        range_index = self._v_range_a if channel == 'A' else self._v_range_b
+        return adc_to_volts(counts, range_index, 32767, dtype=dtype, out=out)
+
+    def _convert(self, counts, channel, raw, dtype, copy=False):
+        """Volts, or ScaledCounts when raw, for one channel's counts"""
+        if raw:
+            return ScaledCounts(counts.copy() if copy else counts, self.scale_factor(channel))
+        return self.counts_to_volts(counts, channel, dtype)
+
+    def _overview_indices(self, aggregate_mode='max'):
+        """Positions in the array handed to the streaming callback of the buffers to keep, grouped by channel"""
+        assert self.channel_a or self.channel_b, 'You must setup a channel before streaming'
+        if aggregate_mode not in AGGREGATE_BUFFERS:
+            raise ValueError("The ps2000 aggregates on the device to the max and min of each group of samples, "
+                             "aggregate_mode must be one of {}".format(list(AGGREGATE_BUFFERS)))
+        return [2 * channel + offset for channel, enabled in ((0, self.channel_a), (1, self.channel_b)) if enabled
+                for offset in AGGREGATE_BUFFERS[aggregate_mode]]
+
+    def _poll_streaming(self, callback):
+        """Pass the data that has arrived to callback, counting it if the driver lost any since the last poll"""
+        self._ps.ps2000_get_streaming_last_values(self.device.handle, callback)
+        overrun = c_int16()
+        self._ps.ps2000_overview_buffer_status(self.device.handle, byref(overrun))
+        if overrun.value:
+            self.stream_driver_overruns += 1
+
+    def _run_streaming(self, aggregate, samples_in_buffer=1000):
+        """Work out the sample interval and start the device streaming"""
+        self.stream_driver_overruns = 0
+        self.stream_over_voltage = set()
         _, self.interval, _ = get_timebase(self.device, samples_in_buffer, 1E9/self.sample_rate, oversample=self.oversampling)
 
-        ps2000.ps2000_run_streaming_ns(
+        self._ps.ps2000_run_streaming_ns(
                     c_int16(self.device.handle),
                     c_uint32(self.interval),
                     2,
@@ -344,23 +553,8 @@ class PicoScopeDAQ:
                     c_uint32(aggregate),
                     c_uint32(100000)
                     )
-
-        start_time = time_ns()
-        data=[]
-        while time_ns() - start_time < collect_time*1E9:               
-            ps2000.ps2000_get_streaming_last_values(
-                self.device.handle,
-                callback_a
-                )
-            
-        end_time = time_ns()
-        ps2000.ps2000_stop(self.device.handle)
-        data_a_V = np.array(adc2mV(adc_values_a, self._v_range_a, c_int16(32767)))/1000
-        
-        times = np.linspace(0, (end_time - start_time) * 1e-9, len(data_a_V))
-
-        return times, data_a_V, np.zeros(np.shape(data_a_V))
+        self._stream_interval_ns = self.interval * aggregate
 
     def close_scope(self):
-        ps2000.ps2000_close_unit(self.device.handle)
+        self._ps.ps2000_close_unit(self.device.handle)
 
@@ -1,17 +1,36 @@
 from calendar import c
+import threading
 import time
 
-from picosdk.ps2000a import ps2000a as ps
-from picosdk.functions import assert_pico_ok, adc2mV, mV2adc
+from picosdk.constants import PICO_INFO
+from picosdk.errors import CannotFindPicoSDKError
+from picosdk.functions import assert_pico_ok, mV2adc
+try:
+    from picosdk.ps2000a import ps2000a as ps
+except CannotFindPicoSDKError as error:
+    # Without the PicoSDK C libraries only a simulated driver can be used, see _picoscope_sim.py
+    ps = None
+    _sdk_error = error
 import ctypes
 
 import matplotlib.pyplot as plt
 import numpy as np
 
+from .capture_file import CaptureFile, CaptureWriter
+from ._picoscope_common import AcquisitionPlan, adc_to_volts, Capture, channel_values, channel_zeros, group_rows, over_voltage_channels, pop_channels, RingBuffer, ScaledCounts, StreamBuffer, TimeAxis, volts_per_count
 
 
-def get_timebase(device, samples, sample_rate, oversample=1):
-    """sample_rate is in Hz but timebase is in ns."""
+# Downsampling done on the device while streaming so only the reduced data crosses the USB.
+# aggregate_mode: picosdk ratio mode
+RATIO_MODES = {
+    'average': 'PS2000A_RATIO_MODE_AVERAGE',    # mean of each group of samples
+    'decimate': 'PS2000A_RATIO_MODE_DECIMATE',  # first sample of each group
+    'minmax': 'PS2000A_RATIO_MODE_AGGREGATE',   # max and min of each group, eg for envelopes or peak detection
+}
+
+
+def get_timebase(device, samples, sample_rate, oversample=1, driver=ps):
+    """sample_rate is in Hz but timebase is in ns. driver is the ps2000a driver object the device was opened with"""
     sample_interval = 1/sample_rate
     
     if sample_interval*1e9 <= 4:
@@ -28,7 +47,7 @@ def get_timebase(device, samples, sample_rate, oversample=1):
   
     status =   {}
 
-    status['getTimebase2']= ps.ps2000aGetTimebase2(device,
+    status['getTimebase2']= driver.ps2000aGetTimebase2(device,
                         timebase,
                         samples,
                         ctypes.byref(timeIntervalns),
@@ -69,7 +88,8 @@ class PicoScopeDAQ:
     For full specs of each model of oscilloscope see here: https://www.picotech.com/download/datasheets/picoscope-2000-series-data-sheet-en.pdf
 
     'stream' mode continuously collects and transfers data to the 
-    pc's buffer allowing long time data collection but at the expense of speed (though not that much). The code is implemented only for use with channel A. I found there were issues trying to get both to run without losing data
+    pc's buffer allowing long time data collection but at the expense of speed (though not that much). Channel A, B or Both
+    can be streamed, each channel being copied into its own preallocated buffer.
 
     Import statement
 
@@ -108,18 +128,39 @@ class PicoScopeDAQ:
     """
 
 
-    def __init__(self):
-        """This assumes only one device connected to system. Checks device found and instantiates object"""
+    def __init__(self, driver=None, serial=None):
+        """
+        Opens the first device found, or the one with the given serial number, and instantiates object
+
+        serial - batch and serial number eg 'AB123/0001', to choose between several connected scopes. See picoscope.list_scopes()
+        driver - object to use in place of picosdk's ps2000a, eg _picoscope_sim.SimulatedPs2000a() to run without hardware
+        """
+        if driver is None:
+            if ps is None:
+                raise _sdk_error
+            driver = ps
+        self._ps = driver
         self.status = {}
         self._chandle = ctypes.c_int16()
         
-        self.status["openunit"] = ps.ps2000aOpenUnit(ctypes.byref(self._chandle), None)
+        self.status["openunit"] = self._ps.ps2000aOpenUnit(ctypes.byref(self._chandle),
+                                                           ctypes.c_char_p(serial.encode()) if serial is not None else None)
     
         if self.status["openunit"]!=0:
             raise ValueError("No Picoscope found, check the model matches the code you are using. Read the docs above!")
+
+        self.serial = self._unit_info('PICO_BATCH_AND_SERIAL')
         
         self.channel_a=False
         self.channel_b=False
+        self._plan=None
+        self._max_adc=None
+        # time.perf_counter() just before the driver was told to start the last block capture
+        self.run_started=None
+        # Gaps in the driver's buffer indices during the last stream, samples were lost if not 0
+        self.stream_driver_overruns=0
+        # Channels that went over their voltage range during the last stream, eg {'A'}
+        self.stream_over_voltage=set()
 
     def quick_setup(self, param_dict,**kwargs):
         """
@@ -143,9 +184,10 @@ class PicoScopeDAQ:
         else:
             raise ValueError("Voltage range must be 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10 or 20")
         
-        _coupling = ps.PS2000A_COUPLING['PS2000A_AC'] if coupling=='AC' else ps.PS2000A_COUPLING['PS2000A_DC']
+        _coupling = self._ps.PS2000A_COUPLING['PS2000A_AC'] if coupling=='AC' else self._ps.PS2000A_COUPLING['PS2000A_DC']
     
         self.sample_rate=sample_rate
+        self._plan = None
         
         channel_A = 0
         channel_B = 1
@@ -154,17 +196,20 @@ class PicoScopeDAQ:
 
         if channel=='A':
             # Set up channel A
-            self.status["setChA"] = ps.ps2000aSetChannel(self._chandle, channel_A, enabled, _coupling, self._v_range_n, 0)
-            self.status["setChB"] = ps.ps2000aSetChannel(self._chandle, channel_B, not_enabled, _coupling, self._v_range_n, 0)
+            self.channel_a, self.channel_b = True, False
+            self.status["setChA"] = self._ps.ps2000aSetChannel(self._chandle, channel_A, enabled, _coupling, self._v_range_n, 0)
+            self.status["setChB"] = self._ps.ps2000aSetChannel(self._chandle, channel_B, not_enabled, _coupling, self._v_range_n, 0)
             #assert_pico_ok(self.status["setChA"])
         # Set up channel B
-        elif channel=='B' or channel=='Both':
-            self.status["setChA"] = ps.ps2000aSetChannel(self._chandle, channel_A, not_enabled, _coupling, self._v_range_n, 0)
-            self.status["setChB"] = ps.ps2000aSetChannel(self._chandle, channel_B, enabled, _coupling, self._v_range_n, 0)
+        elif channel=='B':
+            self.channel_a, self.channel_b = False, True
+            self.status["setChA"] = self._ps.ps2000aSetChannel(self._chandle, channel_A, not_enabled, _coupling, self._v_range_n, 0)
+            self.status["setChB"] = self._ps.ps2000aSetChannel(self._chandle, channel_B, enabled, _coupling, self._v_range_n, 0)
             #assert_pico_ok(self.status["setChB"])
         elif channel=='Both':
-            self.status["setChA"] = ps.ps2000aSetChannel(self._chandle, channel_A, enabled, _coupling, self._v_range_n, 0)
-            self.status["setChB"] = ps.ps2000aSetChannel(self._chandle, channel_B, enabled, _coupling, self._v_range_n, 0)
+            self.channel_a, self.channel_b = True, True
+            self.status["setChA"] = self._ps.ps2000aSetChannel(self._chandle, channel_A, enabled, _coupling, self._v_range_n, 0)
+            self.status["setChB"] = self._ps.ps2000aSetChannel(self._chandle, channel_B, enabled, _coupling, self._v_range_n, 0)
             #assert_pico_ok(self.status["setChA"])
             #assert_pico_ok(self.status["setChB"])
         else:
@@ -185,13 +230,14 @@ class PicoScopeDAQ:
         channel = 0 if 'A' else 1
 
         maxADC = ctypes.c_int16()
-        ps.ps2000aMaximumValue(self._chandle, ctypes.byref(maxADC))      
+        self._ps.ps2000aMaximumValue(self._chandle, ctypes.byref(maxADC))      
         
         converted_threshold = mV2adc(0.5*threshold*1000, self._v_range_n, maxADC)
-        self.status["trigger"] = ps.ps2000aSetSimpleTrigger(self._chandle, enable, channel, converted_threshold, direction, delay, max_wait*1000)
+        self.status["trigger"] = self._ps.ps2000aSetSimpleTrigger(self._chandle, enable, channel, converted_threshold, direction, delay, max_wait*1000)
         assert_pico_ok(self.status["trigger"])
+        self._plan = None
 
-    def start(self, samples=3000):
+    def start(self, samples=3000, raw=False, dtype=np.float64):
         """
         Collect data in block mode. 
 
@@ -202,112 +248,190 @@ class PicoScopeDAQ:
         samples - max depends on device and also on how many channels are used. Only used in block mode.
         
                 Model 2204a has 8kS - 1 channel = 8000 but 2 channels ~ 3965 samples,
+        raw - return each channel as ScaledCounts (int16 counts plus volts per count) and skip the conversion
+        dtype - np.float64 or np.float32 for the volts
         
         returns
         Signal amplitude in V for both channels
         Time in s
+        as a Capture which unpacks as time_s, a, b with time_s a lazy TimeAxis.
+        Use .as_tuple() for the times as an array.
         """        
+        assert self.channel_a or self.channel_b, 'You must setup a channel before running start'
+
+        plan = self._acquisition_plan(samples)
         self.samples=samples
 
-        # Get timebase information        
-        timebase, timeIntervalns, maxSamples, oversample = get_timebase(self._chandle, self.samples, self.sample_rate)
-        
         # Run block capture
-        self.status["runBlock"] = ps.ps2000aRunBlock(self._chandle,
-                                                0,
-                                                self.samples,
-                                                timebase,
-                                                oversample,
-                                                None,
-                                                0,
-                                                None,
-                                                None)
-        assert_pico_ok(self.status["runBlock"])
-        # Check for data collection to finish using ps2000aIsReady
-        ready = ctypes.c_int16(0)
-        check = ctypes.c_int16(0)
-        while ready.value == check.value:
-            self.status["isReady"] = ps.ps2000aIsReady(self._chandle, ctypes.byref(ready))
-
-        # Create buffers ready for assigning pointers for data collection
-        bufferAMax = (ctypes.c_int16 * self.samples)()
-        bufferAMin = (ctypes.c_int16 * self.samples)() # used for downsampling which isn't in the scope of this example
-        bufferBMax = (ctypes.c_int16 * self.samples)()
-        bufferBMin = (ctypes.c_int16 * self.samples)() # used for downsampling which isn't in the scope of this example
-
-        # Set data buffer location for data collection from channel A
-        self.status["setDataBuffersA"] = ps.ps2000aSetDataBuffers(self._chandle,
-                                                            0,
-                                                            ctypes.byref(bufferAMax),
-                                                            ctypes.byref(bufferAMin),
-                                                            self.samples,
-                                                            0,
-                                                            0)
-
-        assert_pico_ok(self.status["setDataBuffersA"])
-
-        # Set data buffer location for data collection from channel B
-        self.status["setDataBuffersB"] = ps.ps2000aSetDataBuffers(self._chandle,
-                                                            1,
-                                                            ctypes.byref(bufferBMax),
-                                                            ctypes.byref(bufferBMin),
-                                                            self.samples,
-                                                            0,
-                                                            0)
-        assert_pico_ok(self.status["setDataBuffersB"])
+        self._run_block(self.samples, plan.timebase, plan.oversample)
 
         # Create overflow location
         overflow = ctypes.c_int16()
         # create converted type totalSamples
         cTotalSamples = ctypes.c_int32(self.samples)
 
-        self.status["getValues"] = ps.ps2000aGetValues(self._chandle, 0, ctypes.byref(cTotalSamples), 0, 0, 0, ctypes.byref(overflow))
+        # Data lands in the buffers the plan registered with the driver
+        self.status["getValues"] = self._ps.ps2000aGetValues(self._chandle, 0, ctypes.byref(cTotalSamples), 0, 0, 0, ctypes.byref(overflow))
         assert_pico_ok(self.status["getValues"])
 
-
-        # find maximum ADC count value
-        maxADC = ctypes.c_int16()
-        self.status["maximumValue"] = ps.ps2000aMaximumValue(self._chandle, ctypes.byref(maxADC))
-        assert_pico_ok(self.status["maximumValue"])
-
         # convert ADC counts data to V
-        chA_v =  np.array(adc2mV(bufferAMax, self._v_range, maxADC))/1000
-        chB_v =  np.array(adc2mV(bufferBMax, self._v_range, maxADC))/1000
+        n_samples = cTotalSamples.value
+        # The plan's buffers are reused by the next capture so raw counts are copied out
+        chA_v = self._convert(plan.buffers['A'][:n_samples], raw, dtype, copy=True) if self.channel_a else np.zeros(n_samples)
+        chB_v = self._convert(plan.buffers['B'][:n_samples], raw, dtype, copy=True) if self.channel_b else np.zeros(n_samples)
 
         # Create time data
-        time_s = np.linspace(0, ((cTotalSamples.value)-1) * timeIntervalns.value/1e9, cTotalSamples.value)
+        time_s = TimeAxis(0, plan.interval/1e9, n_samples)
         
-        return time_s, chA_v, chB_v
+        return Capture(time_s, chA_v, chB_v)
+
+    def _acquisition_plan(self, samples):
+        """
+        Timebase, maximum ADC count and registered buffers for a block capture of samples.
+
+        Worked out on the first start() after setup_channel or setup_trigger and reused until
+        one of them is called again, a different number of samples is asked for or another
+        mode registers its own buffers with the driver.
+        """
+        if self._plan is not None and self._plan.samples == samples:
+            return self._plan
+
+        # Get timebase information        
+        timebase, timeIntervalns, maxSamples, oversample = get_timebase(self._chandle, samples, self.sample_rate, driver=self._ps)
+
+        # Create buffers and register them with the driver once; they stay registered between captures
+        buffers = {}
+        for channel, enabled in (('A', self.channel_a), ('B', self.channel_b)):
+            if not enabled:
+                continue
+            buffers[channel] = np.zeros(samples, dtype=np.int16)
+            self.status["setDataBuffers" + channel] = self._ps.ps2000aSetDataBuffers(self._chandle,
+                                                                self._ps.PS2000A_CHANNEL['PS2000A_CHANNEL_' + channel],
+                                                                buffers[channel].ctypes.data_as(ctypes.POINTER(ctypes.c_int16)),
+                                                                None,
+                                                                samples,
+                                                                0,
+                                                                self._ps.PS2000A_RATIO_MODE['PS2000A_RATIO_MODE_NONE'])
+            assert_pico_ok(self.status["setDataBuffers" + channel])
+
+        self._plan = AcquisitionPlan(samples, timebase, timeIntervalns.value, buffers,
+                                     oversample=oversample, max_adc=self._maximum_value())
+        return self._plan
             
 
-    def start_streaming(self, collect_time=5):
+    def _run_block(self, samples, timebase, oversample):
+        """
+        Run a block capture and sleep until the driver's block ready callback fires.
+
+        The thread is woken by the callback rather than spinning on ps2000aIsReady so waiting
+        for a capture or a trigger uses no CPU.
+        """
+        ready = threading.Event()
+
+        def block_ready(handle, status, param):
+            self.status["blockReady"] = status
+            ready.set()
+
+        # Keep a reference to the C function pointer until the driver has called it
+        self._block_callback = self._ps.BlockReadyType(block_ready)
+        self.run_started = time.perf_counter()
+        self.status["runBlock"] = self._ps.ps2000aRunBlock(self._chandle, 0, samples, timebase, oversample,
+                                                     None, 0, self._block_callback, None)
+        assert_pico_ok(self.status["runBlock"])
+        ready.wait()
+        assert_pico_ok(self.status["blockReady"])
+
+    def start_rapid_block(self, n_captures=10, samples=1000):
+        """
+        Collect n_captures triggered blocks back to back in rapid block mode.
+
+        The device memory is split into n_captures segments and the scope is armed once. It re-arms
+        itself in hardware after each trigger so the dead time between captures is microseconds rather
+        than a python round trip per capture. Set up a trigger with setup_trigger first, otherwise the
+        captures simply follow one another.
+
+        n_captures - number of triggered captures
+        samples - samples in each capture. n_captures*samples must fit in the device memory
+
+        returns
+        trigger_times - array of n_captures times in s from each trigger point to the first sample of its segment
+        data_a, data_b - (n_captures, samples) int16 arrays of raw ADC counts, None for a disabled channel.
+                         Convert with pico.counts_to_volts(data_a). The time axis of each
+                         segment is np.arange(samples) * pico.interval / 1e9
+        """
+        assert self.channel_a or self.channel_b, 'You must setup a channel before running start_rapid_block'
+        # The segment buffers registered below replace those of the block mode plan
+        self._plan = None
+
+        maxSamples = ctypes.c_int32()
+        self.status["memorySegments"] = self._ps.ps2000aMemorySegments(self._chandle, n_captures, ctypes.byref(maxSamples))
+        assert_pico_ok(self.status["memorySegments"])
+        try:
+            if samples > maxSamples.value:
+                raise ValueError('Only {} samples fit in each of {} segments'.format(maxSamples.value, n_captures))
+
+            self.status["setNoOfCaptures"] = self._ps.ps2000aSetNoOfCaptures(self._chandle, n_captures)
+            assert_pico_ok(self.status["setNoOfCaptures"])
+
+            timebase, timeIntervalns, _, oversample = get_timebase(self._chandle, samples, self.sample_rate, driver=self._ps)
+            self.interval = timeIntervalns.value
+
+            self._run_block(samples, timebase, oversample)
+
+            # One preallocated array per channel, each row registered as the buffer of one segment
+            data = {}
+            for channel, enabled in (('A', self.channel_a), ('B', self.channel_b)):
+                if not enabled:
+                    continue
+                data[channel] = np.zeros((n_captures, samples), dtype=np.int16)
+                for segment in range(n_captures):
+                    self.status["setDataBuffer" + channel] = self._ps.ps2000aSetDataBuffer(self._chandle,
+                                                                    self._ps.PS2000A_CHANNEL['PS2000A_CHANNEL_' + channel],
+                                                                    data[channel][segment].ctypes.data_as(ctypes.POINTER(ctypes.c_int16)),
+                                                                    samples,
+                                                                    segment,
+                                                                    self._ps.PS2000A_RATIO_MODE['PS2000A_RATIO_MODE_NONE'])
+                    assert_pico_ok(self.status["setDataBuffer" + channel])
+
+            cSamples = ctypes.c_uint32(samples)
+            overflow = (ctypes.c_int16 * n_captures)()
+            self.status["getValuesBulk"] = self._ps.ps2000aGetValuesBulk(self._chandle, ctypes.byref(cSamples), 0, n_captures - 1, 1,
+                                                                self._ps.PS2000A_RATIO_MODE['PS2000A_RATIO_MODE_NONE'], ctypes.byref(overflow))
+            assert_pico_ok(self.status["getValuesBulk"])
+
+            times = (ctypes.c_int64 * n_captures)()
+            timeUnits = (ctypes.c_int32 * n_captures)()
+            self.status["getValuesTriggerTimeOffsetBulk"] = self._ps.ps2000aGetValuesTriggerTimeOffsetBulk64(self._chandle, ctypes.byref(times),
+                                                                                        ctypes.byref(timeUnits), 0, n_captures - 1)
+            assert_pico_ok(self.status["getValuesTriggerTimeOffsetBulk"])
+            # PS2000A_TIME_UNITS run from femtoseconds (0) to seconds (5) in steps of 1000
+            trigger_times = np.ctypeslib.as_array(times) * 10.0 ** (3 * np.ctypeslib.as_array(timeUnits) - 15)
+        finally:
+            # Go back to a single segment so block mode works as normal, also if the capture failed
+            self.status["memorySegments"] = self._ps.ps2000aMemorySegments(self._chandle, 1, ctypes.byref(maxSamples))
+            self.status["setNoOfCaptures"] = self._ps.ps2000aSetNoOfCaptures(self._chandle, 1)
+
+        return trigger_times, data.get('A'), data.get('B')
+
+    def start_streaming(self, collect_time=5, aggregate=1, aggregate_mode='average', raw=False, dtype=np.float64):
         """
         Collect data in streaming mode
 
         stream mode transfers data repeatedly as requested with no gaps.
-        **Important** if you call start_streaming multiple times you will get 2 sets of data concatenated and all the timing will be wrong.
+        The channels set up with setup_channel are streamed simultaneously. A disabled channel is returned as zeros shaped like the enabled one.
 
         collect_time: time in seconds to collect for in stream mode, has no effect on block mode
-        aggregate: number of values averaged together and returned as single point in Stream mode
+        aggregate: number of samples the device reduces to a single point, so only 1/aggregate of the data crosses the USB
+        aggregate_mode: how each group of samples is reduced, 'average', 'decimate' or 'minmax'. With 'minmax'
+                        each channel is returned as a (2, n) array of rows max, min
+        raw: return each channel as ScaledCounts (int16 counts plus volts per count) and skip the conversion
+        dtype: np.float64 or np.float32 for the volts
         """
- 
-        enabled = 1
-        disabled = 0
-        analogue_offset = 0.0
-
-        # Set up channel A
-        channel_range = self._v_range_n
-        self.status["setChA"] = ps.ps2000aSetChannel(self._chandle,
-                                                ps.PS2000A_CHANNEL['PS2000A_CHANNEL_A'],
-                                                enabled,
-                                                ps.PS2000A_COUPLING['PS2000A_DC'],
-                                                channel_range,
-                                                analogue_offset)
-        assert_pico_ok(self.status["setChA"])
-
-        self.samples = int(collect_time * self.sample_rate)
-
-        sizeOfOneBuffer = self.sample_rate if collect_time > 1 else int(collect_time*self.sample_rate)
+        # Samples per second reaching python after downsampling on the device
+        rate = self.sample_rate / aggregate
+        self.samples = int(collect_time * rate)
+
+        sizeOfOneBuffer = int(rate) if collect_time > 1 else int(collect_time*rate)
         
         if self.samples < sizeOfOneBuffer:
             numBuffersToCapture = 1
@@ -316,104 +440,344 @@ class PicoScopeDAQ:
             numBuffersToCapture = np.ceil(self.samples / sizeOfOneBuffer)
             self.samples = int(numBuffersToCapture * sizeOfOneBuffer)
 
-        # Create buffers ready for assigning pointers for data collection
-        bufferAMax = np.zeros(shape=sizeOfOneBuffer, dtype=np.int16)
-
-        memory_segment = 0
-
-        # Set data buffer location for data collection from channel A
-        self.status["setDataBuffersA"] = ps.ps2000aSetDataBuffers(self._chandle,
-                                                            ps.PS2000A_CHANNEL['PS2000A_CHANNEL_A'],
-                                                            bufferAMax.ctypes.data_as(ctypes.POINTER(ctypes.c_int16)),
-                                                            None,
-                                                            sizeOfOneBuffer,
-                                                            memory_segment,
-                                                            ps.PS2000A_RATIO_MODE['PS2000A_RATIO_MODE_NONE'])
-        assert_pico_ok(self.status["setDataBuffersA"])
-
-        # Begin streaming mode:
-        sampleInterval = ctypes.c_int32(int(1e6/self.sample_rate))
-        sampleUnits = ps.PS2000A_TIME_UNITS['PS2000A_US']
-        # We are not triggering:
-        maxPreTriggerSamples = 0
-        autoStopOn = 1
-        # No downsampling:
-        downsampleRatio = 1
-        self.status["runStreaming"] = ps.ps2000aRunStreaming(self._chandle,
-                                                        ctypes.byref(sampleInterval),
-                                                        sampleUnits,
-                                                        maxPreTriggerSamples,
-                                                        self.samples,
-                                                        autoStopOn,
-                                                        downsampleRatio,
-                                                        ps.PS2000A_RATIO_MODE['PS2000A_RATIO_MODE_NONE'],
-                                                        sizeOfOneBuffer)
-        assert_pico_ok(self.status["runStreaming"])
-
-        actualSampleInterval = sampleInterval.value
-        actualSampleIntervalNs = actualSampleInterval * 1000
-
-        # We need a big buffer, not registered with the driver, to keep our complete capture in.
-        bufferCompleteA = np.zeros(shape=self.samples, dtype=np.int16)
-        global nextSample
-        nextSample = 0
-        autoStopOuter = False
-        wasCalledBack = False
+        buffers = self._run_streaming(sizeOfOneBuffer, self.samples * aggregate, True, aggregate, aggregate_mode)
 
+        # We need big buffers, not registered with the driver, to keep our complete capture in.
+        bufferComplete = [StreamBuffer(self.samples) for _ in buffers]
+        state = {'calledBack': False, 'autoStop': False}
 
         def streaming_callback(handle, noOfSamples, startIndex, overflow, triggerAt, triggered, autoStop, param):
-            global nextSample, autoStopOuter, wasCalledBack
-            wasCalledBack = True
-            destEnd = nextSample + noOfSamples
-            sourceEnd = startIndex + noOfSamples
-            bufferCompleteA[nextSample:destEnd] = bufferAMax[startIndex:sourceEnd]
-            nextSample += noOfSamples
-            if autoStop:
-                autoStopOuter = True
-
+            self._check_stream(startIndex, noOfSamples, overflow)
+            state['calledBack'] = True
+            state['autoStop'] = bool(autoStop)
+            for buffer, complete in zip(buffers, bufferComplete):
+                complete.extend(buffer[startIndex:startIndex + noOfSamples])
 
         # Convert the python function into a C function pointer.
-        cFuncPtr = ps.StreamingReadyType(streaming_callback)
+        cFuncPtr = self._ps.StreamingReadyType(streaming_callback)
 
         # Fetch data from the driver in a loop, copying it out of the registered buffers and into our complete one.
-        while nextSample < self.samples and not autoStopOuter:
-            wasCalledBack = False
-            self.status["getStreamingLastestValues"] = ps.ps2000aGetStreamingLatestValues(self._chandle, cFuncPtr, None)
-            if not wasCalledBack:
+        while bufferComplete[0].n_samples < self.samples and not state['autoStop']:
+            state['calledBack'] = False
+            self.status["getStreamingLastestValues"] = self._ps.ps2000aGetStreamingLatestValues(self._chandle, cFuncPtr, None)
+            if not state['calledBack']:
                 # If we weren't called back by the driver, this means no data is ready. Sleep for a short while before trying
                 # again.
                 time.sleep(0.01)
 
         print("Done grabbing values.")
+        self._stop()
 
-        # Find maximum ADC count value
-        # handle = chandle
-        # pointer to value = ctypes.byref(maxADC)
-        maxADC = ctypes.c_int16()
-        self.status["maximumValue"] = ps.ps2000aMaximumValue(self._chandle, ctypes.byref(maxADC))
-        assert_pico_ok(self.status["maximumValue"])
-
-        # Convert ADC counts data to mV
-        chA_v = np.array(adc2mV(bufferCompleteA, channel_range, maxADC))/1000
+        # Convert ADC counts data to V
+        n_samples = bufferComplete[0].n_samples
+        per_channel = self._buffers_per_channel
+        chA_v = self._convert(channel_values(bufferComplete[:per_channel]), raw, dtype) if self.channel_a else channel_zeros(per_channel, n_samples)
+        chB_v = self._convert(channel_values(bufferComplete[-per_channel:]), raw, dtype) if self.channel_b else channel_zeros(per_channel, n_samples)
 
         # Create time data
-        time_s = np.linspace(0, (self.samples-1) * actualSampleIntervalNs/1e9, self.samples)
+        time_s = TimeAxis(0, self._stream_interval_ns/1e9, n_samples)
 
-        # Stop the scope
-        # handle = chandle
-        self.status["stop"] = ps.ps2000aStop(self._chandle)
-        assert_pico_ok(self.status["stop"])
+        return Capture(time_s, chA_v, chB_v)
+
+    def iter_stream(self, chunk_samples=100000, collect_time=None, aggregate=1, aggregate_mode='average'):
+        """
+        Stream the channels set up with setup_channel and yield the data block by block while the scope keeps acquiring.
+
+        Only one block is held in memory at a time so hour long runs can be processed or
+        written to disk as they go rather than returned as one huge array at the end.
+
+        chunk_samples: number of samples in each block yielded. The final block may be shorter.
+        collect_time: time in seconds to stream for. None streams until you stop iterating.
+        aggregate: number of samples the device reduces to a single point, chunk_samples counts the reduced points
+        aggregate_mode: 'average', 'decimate' or 'minmax', see start_streaming
+
+        yields (t0, chunk) where t0 is the time in s of the first sample of the block and chunk is an
+        int16 array of raw ADC counts. chunk is 1d for a single channel and has rows A, B when streaming Both.
+        With 'minmax' chunk gains an axis of length 2 before the samples holding the max and min, eg (2, n)
+        for one channel. Convert with pico.counts_to_volts(chunk)
+
+        Example:
+
+            for t0, chunk in pico.iter_stream(chunk_samples=50000, collect_time=3600):
+                np.save('block_{}.npy'.format(t0), chunk)
+        """
+        auto_stop = collect_time is not None
+        max_samples = int(collect_time * self.sample_rate) if auto_stop else chunk_samples * aggregate
+        buffers = self._run_streaming(chunk_samples, max_samples, auto_stop, aggregate, aggregate_mode)
+        per_channel = self._buffers_per_channel
+
+        pending = [StreamBuffer(2 * chunk_samples) for _ in buffers]
+        state = {'calledBack': False, 'autoStop': False}
+
+        def streaming_callback(handle, noOfSamples, startIndex, overflow, triggerAt, triggered, autoStop, param):
+            self._check_stream(startIndex, noOfSamples, overflow)
+            state['calledBack'] = True
+            state['autoStop'] = bool(autoStop)
+            for buffer, stream in zip(buffers, pending):
+                stream.extend(buffer[startIndex:startIndex + noOfSamples])
+
+        cFuncPtr = self._ps.StreamingReadyType(streaming_callback)
+        dt = self._stream_interval_ns / 1e9
+        n_yielded = 0
+
+        try:
+            while not state['autoStop']:
+                state['calledBack'] = False
+                self.status["getStreamingLastestValues"] = self._ps.ps2000aGetStreamingLatestValues(self._chandle, cFuncPtr, None)
+                while pending[0].n_samples >= chunk_samples:
+                    yield n_yielded * dt, pop_channels(pending, chunk_samples, per_channel)
+                    n_yielded += chunk_samples
+                if not state['calledBack']:
+                    time.sleep(0.01)
+            if pending[0].n_samples:
+                yield n_yielded * dt, pop_channels(pending, pending[0].n_samples, per_channel)
+        finally:
+            self._stop()
+
+    def record_streaming(self, filename, collect_time=None, chunk_samples=100000, aggregate=1, aggregate_mode='average', metadata=None):
+        """
+        Stream the channels set up with setup_channel straight into a memory-mapped capture file.
+
+        Only one chunk is held in memory at a time so the length of a recording is limited by disk
+        space, not RAM. With collect_time=None it records until interrupted (ctrl-c); the file is
+        closed properly either way.
+
+        filename - capture file to write, see capture_file.py
+        collect_time - time in seconds to record for, None records until interrupted
+        chunk_samples - samples written to disk at a time
+        aggregate - number of samples the device reduces to a single point
+        aggregate_mode - 'average', 'decimate' or 'minmax'. 'minmax' stores channels 'A max', 'A min' etc
+        metadata - dict of extra information to keep in the file header
+
+        returns a CaptureFile for the recording. capture.volts('A') gives channel A in volts
+        """
+        channels = [name for name, enabled in (('A', self.channel_a), ('B', self.channel_b)) if enabled]
+        if aggregate_mode == 'minmax':
+            channels = [name + suffix for name in channels for suffix in (' max', ' min')]
+        header = {'device': 'ps2000a', 'sample_rate': self.sample_rate, 'voltage_range': self._v_range,
+                  'aggregate': aggregate, 'aggregate_mode': aggregate_mode}
+        header.update(metadata or {})
+        writer = None
+        try:
+            for _, chunk in self.iter_stream(chunk_samples, collect_time, aggregate, aggregate_mode):
+                if writer is None:
+                    # The sample interval is only known once streaming has started
+                    writer = CaptureWriter(filename, channels, self._stream_interval_ns / 1e9,
+                                           scale=self.scale_factor(), metadata=header)
+                writer.write(chunk.reshape(-1, chunk.shape[-1]))
+        finally:
+            if writer is not None:
+                writer.close()
+        return CaptureFile(filename)
+
+    def start_streaming_async(self, buffer_seconds=10, chunk_samples=None, aggregate=1, aggregate_mode='average'):
+        """
+        Start streaming the channels set up with setup_channel in the background and return immediately.
+
+        A dedicated thread polls the driver and copies new samples into a ring buffer holding
+        buffer_seconds of data. Call read_available() whenever convenient to collect what has
+        arrived and stop_streaming() when finished. If you fall more than buffer_seconds behind,
+        new data is dropped rather than stalling the driver and the loss is reported in
+        stream_overruns and stream_dropped_samples. Data lost before it reached the ring buffer,
+        because the thread could not poll the driver often enough, is counted in stream_driver_overruns.
+
+        buffer_seconds: length of the ring buffer in seconds of data
+        chunk_samples: size of the buffer registered with the driver. Defaults to 0.1 s of data.
+        aggregate: number of samples the device reduces to a single point
+        aggregate_mode: 'average', 'decimate' or 'minmax', see start_streaming
+
+        Example:
+
+            pico.start_streaming_async()
+            while running:
+                t0, chunk = pico.read_available()
+                analyse(chunk)
+            pico.stop_streaming()
+        """
+        if chunk_samples is None:
+            chunk_samples = max(int(self.sample_rate / aggregate / 10), 1000)
+        buffers = self._run_streaming(chunk_samples, chunk_samples * aggregate, False, aggregate, aggregate_mode)
+        self._ring = RingBuffer(buffer_seconds * self.sample_rate / aggregate, n_channels=len(buffers))
+
+        def streaming_callback(handle, noOfSamples, startIndex, overflow, triggerAt, triggered, autoStop, param):
+            self._check_stream(startIndex, noOfSamples, overflow)
+            self._ring.write([buffer[startIndex:startIndex + noOfSamples] for buffer in buffers])
+
+        # Keep a reference to the C function pointer for as long as the driver may call it.
+        self._stream_callback = self._ps.StreamingReadyType(streaming_callback)
+        self._stop_polling = threading.Event()
+        self._poll_thread = threading.Thread(target=self._poll_streaming, daemon=True)
+        self._poll_thread.start()
+
+    def read_available(self, max_samples=None):
+        """
+        Collect the samples that have arrived since the last call without waiting.
+
+        returns (t0, chunk) where t0 is the time in s of the first sample and chunk is an int16
+        array of raw ADC counts, possibly empty. chunk is 1d for a single channel and has rows A, B
+        when streaming Both, with the extra max, min axis of iter_stream for 'minmax'.
+        Convert with pico.counts_to_volts(chunk).
+        A read never spans data that was dropped: if there was an overrun you get the data up to the
+        gap and the next call returns the data after it with its own t0.
+        """
+        index, chunk = self._ring.read(max_samples)
+        return index * self._stream_interval_ns / 1e9, group_rows(chunk, self._buffers_per_channel)
+
+    def stop_streaming(self):
+        """Stop background streaming. Data still in the ring buffer can be collected with read_available()"""
+        self._stop_polling.set()
+        self._poll_thread.join()
+        self._stop()
+
+    @property
+    def stream_overruns(self):
+        """Number of times data was dropped because read_available() fell too far behind"""
+        return self._ring.overruns
+
+    @property
+    def stream_dropped_samples(self):
+        return self._ring.dropped_samples
+
+    def scale_factor(self, channel='A'):
+        """Volts per ADC count. Both channels share the voltage range so channel makes no difference"""
+        return volts_per_count(self._v_range_n, self._maximum_value())
+
+    @property
+    def stream_interval(self):
+        """Time in s between the samples of the current or last stream, after downsampling"""
+        return self._stream_interval_ns / 1e9
+
+    def counts_to_volts(self, counts, channel='A', dtype=np.float64, out=None):
+        """
+        Convert raw ADC counts from iter_stream, read_available, start_rapid_block or a raw capture to volts.
+
+        channel - 'A' or 'B', kept for symmetry with the ps2000 backend
+        dtype - np.float64 or np.float32
+        out - optional float array to write the volts into, eg one reused for every chunk of a stream
+        """
+        return adc_to_volts(counts, self._v_range_n, self._maximum_value(), dtype=dtype, out=out)
+
+    def _convert(self, counts, raw, dtype, copy=False):
+        """Volts, or ScaledCounts when raw"""
+        if raw:
+            return ScaledCounts(counts.copy() if copy else counts, self.scale_factor())
+        return self.counts_to_volts(counts, dtype=dtype)
+
+    def _unit_info(self, line):
+        """One line of unit information as a string, line is a key of picosdk.constants.PICO_INFO"""
+        string = ctypes.create_string_buffer(64)
+        required_size = ctypes.c_int16()
+        self.status["getUnitInfo"] = self._ps.ps2000aGetUnitInfo(self._chandle, string, ctypes.c_int16(len(string)),
+                                                                 ctypes.byref(required_size), PICO_INFO[line])
+        assert_pico_ok(self.status["getUnitInfo"])
+        return string.value.decode()
+
+    def _maximum_value(self):
+        """Maximum ADC count of the device. Fixed for a device so only asked for once"""
+        if self._max_adc is None:
+            maxADC = ctypes.c_int16()
+            self.status["maximumValue"] = self._ps.ps2000aMaximumValue(self._chandle, ctypes.byref(maxADC))
+            assert_pico_ok(self.status["maximumValue"])
+            self._max_adc = maxADC.value
+        return self._max_adc
+
+    def _poll_streaming(self):
+        """Driver polling loop run on the background thread by start_streaming_async"""
+        while not self._stop_polling.is_set():
+            written = self._ring.total_samples
+            self.status["getStreamingLastestValues"] = self._ps.ps2000aGetStreamingLatestValues(self._chandle, self._stream_callback, None)
+            if self._ring.total_samples == written:
+                self._stop_polling.wait(0.001)
+
+    def _check_stream(self, start_index, n_samples, over_voltage):
+        """
+        Book keeping for the streaming callbacks. over_voltage is the driver's bit field of channels over
+        their range. The driver fills its buffer in a loop, so a start_index other than where the last
+        callback finished means samples were lost.
+        """
+        if over_voltage:
+            self.stream_over_voltage.update(over_voltage_channels(over_voltage))
+        if start_index != self._next_start_index:
+            self.stream_driver_overruns += 1
+        self._next_start_index = (start_index + n_samples) % self._stream_buffer_size
+
+    def _run_streaming(self, buffer_size, max_samples, auto_stop, aggregate=1, aggregate_mode='average'):
+        """
+        Register a buffer of buffer_size samples with the driver for each enabled channel
+        and start streaming into them. Returns the registered buffers in channel order which the
+        driver overwrites in a loop, so data must be copied out of them in the streaming callback.
+        With aggregate_mode 'minmax' each channel has a max and a min buffer, in that order.
+
+        buffer_size counts samples after downsampling by aggregate, max_samples counts them before.
+        """
+        assert self.channel_a or self.channel_b, 'You must setup a channel before streaming'
+        if aggregate_mode not in RATIO_MODES:
+            raise ValueError('aggregate_mode must be one of {}'.format(list(RATIO_MODES)))
+        aggregate = int(aggregate)
+        if aggregate > 1 or aggregate_mode == 'minmax':
+            ratio_mode = self._ps.PS2000A_RATIO_MODE[RATIO_MODES[aggregate_mode]]
+        else:
+            ratio_mode = self._ps.PS2000A_RATIO_MODE['PS2000A_RATIO_MODE_NONE']
+        self._buffers_per_channel = 2 if aggregate_mode == 'minmax' else 1
+        # The streaming buffers registered below replace those of the block mode plan
+        self._plan = None
+        self.stream_driver_overruns = 0
+        self.stream_over_voltage = set()
+        self._stream_buffer_size = buffer_size
+        self._next_start_index = 0
+        memory_segment = 0
+        buffers = []
+
+        for channel, enabled in (('A', self.channel_a), ('B', self.channel_b)):
+            if not enabled:
+                continue
+            # Create buffers ready for assigning pointers for data collection
+            bufferMax = np.zeros(shape=buffer_size, dtype=np.int16)
+            buffers.append(bufferMax)
+            bufferMin = None
+            if aggregate_mode == 'minmax':
+                bufferMin = np.zeros(shape=buffer_size, dtype=np.int16)
+                buffers.append(bufferMin)
+
+            # Set data buffer location for data collection from this channel
+            self.status["setDataBuffers" + channel] = self._ps.ps2000aSetDataBuffers(self._chandle,
+                                                                self._ps.PS2000A_CHANNEL['PS2000A_CHANNEL_' + channel],
+                                                                bufferMax.ctypes.data_as(ctypes.POINTER(ctypes.c_int16)),
+                                                                None if bufferMin is None else bufferMin.ctypes.data_as(ctypes.POINTER(ctypes.c_int16)),
+                                                                buffer_size,
+                                                                memory_segment,
+                                                                ratio_mode)
+            assert_pico_ok(self.status["setDataBuffers" + channel])
+
+        # Begin streaming mode:
+        sampleInterval = ctypes.c_int32(int(1e6/self.sample_rate))
+        sampleUnits = self._ps.PS2000A_TIME_UNITS['PS2000A_US']
+        # We are not triggering:
+        maxPreTriggerSamples = 0
+        downsampleRatio = aggregate
+        self.status["runStreaming"] = self._ps.ps2000aRunStreaming(self._chandle,
+                                                        ctypes.byref(sampleInterval),
+                                                        sampleUnits,
+                                                        maxPreTriggerSamples,
+                                                        max_samples,
+                                                        int(auto_stop),
+                                                        downsampleRatio,
+                                                        ratio_mode,
+                                                        buffer_size)
+        assert_pico_ok(self.status["runStreaming"])
 
-        return time_s, chA_v, np.zeros(np.shape(chA_v))
+        # Interval between the downsampled points that reach python
+        self._stream_interval_ns = sampleInterval.value * 1000 * aggregate
+        return buffers
 
     def _stop(self):
         # Stop the scope
         # handle = chandle
-        self.status["stop"] = ps.ps2000aStop(self._chandle)
+        self.status["stop"] = self._ps.ps2000aStop(self._chandle)
         assert_pico_ok(self.status["stop"])      
 
     def close_scope(self):
-        self.status["close"] = ps.ps2000aCloseUnit(self._chandle)
+        self.status["close"] = self._ps.ps2000aCloseUnit(self._chandle)
         assert_pico_ok(self.status["close"])
 
     def __enter__(self):
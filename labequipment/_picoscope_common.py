@@ -0,0 +1,470 @@
+"""Helpers shared by the _picoscope_2000 and _picoscope_2000a backends.
+
+Nothing in here talks to the driver directly. It holds the numpy side of
+acquisition: buffers the driver callbacks copy into and conversion of raw
+ADC counts to volts.
+"""
+import ctypes
+import numbers
+import time
+
+import numpy as np
+
+
+# Full scale in mV for each picosdk voltage range index. Same table picosdk.functions.adc2mV uses.
+CHANNEL_INPUT_RANGES_MV = [10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000]
+
+
+def volts_per_count(range_index, max_adc):
+    """
+    Scale factor from raw ADC counts to volts.
+
+    range_index - picosdk voltage range index eg ps2000.PS2000_VOLTAGE_RANGE['PS2000_2V']
+    max_adc - maximum ADC count of the device, int or ctypes.c_int16
+    """
+    max_adc = getattr(max_adc, 'value', max_adc)
+    return CHANNEL_INPUT_RANGES_MV[range_index] / (1000 * max_adc)
+
+
+def adc_to_volts(adc_values, range_index, max_adc, dtype=np.float64, out=None):
+    """
+    Convert raw ADC counts to volts with a single vectorised multiply.
+
+    picosdk.functions.adc2mV builds a python list one sample at a time which for
+    long captures takes longer than the acquisition itself.
+
+    adc_values - int16 numpy array or ctypes array of raw counts
+    range_index - picosdk voltage range index eg ps2000.PS2000_VOLTAGE_RANGE['PS2000_2V']
+    max_adc - maximum ADC count of the device, int or ctypes.c_int16
+    dtype - np.float64 or np.float32 for half the memory
+    out - optional float array of the same shape to write the volts into instead of allocating one
+    """
+    if isinstance(adc_values, ctypes.Array):
+        adc_values = np.ctypeslib.as_array(adc_values)
+    return np.multiply(adc_values, volts_per_count(range_index, max_adc), out=out,
+                       dtype=dtype if out is None else out.dtype)
+
+
+class ScaledCounts:
+    """
+    Raw int16 ADC counts together with the factor that turns them into volts.
+
+    Returned in place of volts by the capture methods when raw=True so nothing is converted
+    until it is needed. Anything that asks numpy for an array (np.asarray, plt.plot, arithmetic
+    with arrays) gets volts; .counts is the untouched int16 data.
+
+    counts - int16 array
+    scale - volts per count
+    """
+
+    def __init__(self, counts, scale):
+        self.counts = counts
+        self.scale = scale
+
+    def volts(self, dtype=np.float64, out=None):
+        """Convert to volts, optionally writing into an existing float array out"""
+        return np.multiply(self.counts, self.scale, out=out, dtype=dtype if out is None else out.dtype)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.volts(dtype if dtype is not None else np.float64)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __getitem__(self, index):
+        return ScaledCounts(self.counts[index], self.scale)
+
+    @property
+    def shape(self):
+        return self.counts.shape
+
+
+def serial_text(serial):
+    """Batch and serial number as str, picosdk's ps2000 gives it as bytes"""
+    return serial.decode() if isinstance(serial, bytes) else serial
+
+
+def wait_until_ready(is_ready, expected_duration=0, min_interval=1e-4, max_interval=0.01):
+    """
+    Poll is_ready() until it returns True, without pinning a core or adding a fixed delay.
+
+    Sleeps through most of expected_duration in one go, then polls with an interval that
+    starts at min_interval and doubles up to max_interval. A capture that finishes when
+    expected is picked up within a fraction of a millisecond, while one left waiting on a
+    trigger costs about 1/max_interval polls a second.
+
+    is_ready - function returning True once the device has finished
+    expected_duration - time in s the capture should take, eg the driver's time indisposed
+    """
+    if expected_duration > 0:
+        time.sleep(0.9 * expected_duration)
+    interval = min_interval
+    while not is_ready():
+        time.sleep(interval)
+        interval = min(2 * interval, max_interval)
+
+
+class TimeAxis:
+    """
+    Uniformly sampled time axis t0 + i*dt for i in range(n), held as three numbers.
+
+    A capture's time array is as big as its data once materialised in float64 but carries no
+    information beyond t0, dt and n, so captures hand this back instead. It indexes, slices
+    and scales like an array of times and becomes a real one wherever numpy asks for it
+    (np.asarray, plt.plot, np.diff), or when combined with an array.
+    """
+
+    def __init__(self, t0, dt, n):
+        self.t0 = t0
+        self.dt = dt
+        self.n = int(n)
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def shape(self):
+        return (self.n,)
+
+    @property
+    def duration(self):
+        """Time from the first to the last sample"""
+        return (self.n - 1) * self.dt if self.n else 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.n)
+            return TimeAxis(self.t0 + start * self.dt, step * self.dt, len(range(start, stop, step)))
+        if index < 0:
+            index += self.n
+        if not 0 <= index < self.n:
+            raise IndexError('TimeAxis index out of range')
+        return self.t0 + index * self.dt
+
+    def values(self, dtype=np.float64):
+        """Materialise the times as an array"""
+        return self.t0 + np.arange(self.n, dtype=dtype) * dtype(self.dt)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.values(np.dtype(dtype).type if dtype is not None else np.float64)
+
+    def __iter__(self):
+        return iter(self.values())
+
+    # Arithmetic with a number stays lazy. With an array numpy takes over, via __array__, and returns an array.
+
+    def __add__(self, offset):
+        if not isinstance(offset, numbers.Real):
+            return NotImplemented
+        return TimeAxis(self.t0 + offset, self.dt, self.n)
+
+    __radd__ = __add__
+
+    def __sub__(self, offset):
+        if not isinstance(offset, numbers.Real):
+            return NotImplemented
+        return TimeAxis(self.t0 - offset, self.dt, self.n)
+
+    def __rsub__(self, offset):
+        if not isinstance(offset, numbers.Real):
+            return NotImplemented
+        return TimeAxis(offset - self.t0, -self.dt, self.n)
+
+    def __neg__(self):
+        return TimeAxis(-self.t0, -self.dt, self.n)
+
+    def __mul__(self, factor):
+        if not isinstance(factor, numbers.Real):
+            return NotImplemented
+        return TimeAxis(self.t0 * factor, self.dt * factor, self.n)
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, divisor):
+        if not isinstance(divisor, numbers.Real):
+            return NotImplemented
+        return TimeAxis(self.t0 / divisor, self.dt / divisor, self.n)
+
+    # Comparisons give boolean arrays like they did when the times were an array, eg data[time_s > 0.5]
+
+    def __lt__(self, other):
+        return self.values() < other
+
+    def __le__(self, other):
+        return self.values() <= other
+
+    def __gt__(self, other):
+        return self.values() > other
+
+    def __ge__(self, other):
+        return self.values() >= other
+
+    def __eq__(self, other):
+        return self.values() == other
+
+    def __ne__(self, other):
+        return self.values() != other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'TimeAxis(t0={}, dt={}, n={})'.format(self.t0, self.dt, self.n)
+
+
+class Capture:
+    """
+    Result of start() / start_streaming(): a lazy TimeAxis and the channel data.
+
+    Still unpacks like the tuple the methods used to return,
+
+        time_s, a, b = pico.start()
+
+    with time_s now a TimeAxis. as_tuple() gives the old tuple with the times materialised.
+
+    time - TimeAxis in s
+    a, b - channel data as returned by the backend (volts, ScaledCounts, zeros or None for a disabled channel)
+    """
+
+    def __init__(self, time, a, b):
+        self.time = time
+        self.a = a
+        self.b = b
+
+    @property
+    def interval(self):
+        """Sample interval in s"""
+        return self.time.dt
+
+    def __iter__(self):
+        return iter((self.time, self.a, self.b))
+
+    def __getitem__(self, index):
+        return (self.time, self.a, self.b)[index]
+
+    def __len__(self):
+        return 3
+
+    def as_tuple(self):
+        """(time_s, a, b) with time_s a float64 array, exactly as start() used to return"""
+        return self.time.values(), self.a, self.b
+
+
+class StreamBuffer:
+    """
+    Preallocated int16 store for streamed samples.
+
+    Driver callbacks copy each chunk in with one slice assignment (a single memcpy)
+    instead of extending a python list. Size it for the expected number of samples;
+    if more arrive the storage doubles so nothing is dropped.
+    """
+
+    def __init__(self, capacity):
+        self._data = np.empty(max(int(capacity), 1), dtype=np.int16)
+        self.n_samples = 0
+
+    def extend(self, chunk):
+        """Append a 1d array of samples"""
+        end = self.n_samples + len(chunk)
+        if end > len(self._data):
+            self._grow(end)
+        self._data[self.n_samples:end] = chunk
+        self.n_samples = end
+
+    def extend_from_pointer(self, pointer, n_values):
+        """Append n_values samples straight from a driver owned POINTER(c_int16)"""
+        if n_values > 0:
+            self.extend(np.ctypeslib.as_array(pointer, shape=(n_values,)))
+
+    def pop(self, n):
+        """Remove the first n samples and return them as a new array"""
+        chunk = self._data[:n].copy()
+        remaining = self.n_samples - n
+        self._data[:remaining] = self._data[n:self.n_samples]
+        self.n_samples = remaining
+        return chunk
+
+    @property
+    def values(self):
+        """View of the samples collected so far"""
+        return self._data[:self.n_samples]
+
+    def _grow(self, min_capacity):
+        data = np.empty(max(min_capacity, 2 * len(self._data)), dtype=np.int16)
+        data[:self.n_samples] = self._data[:self.n_samples]
+        self._data = data
+
+
+def pop_channels(buffers, n, per_channel=1):
+    """
+    Pop n samples from each channel's StreamBuffer.
+
+    A single channel comes back as a 1d array and several as a (n_channels, n) array,
+    rows in channel order. See group_rows for per_channel.
+    """
+    chunks = [buffer.pop(n) for buffer in buffers]
+    return group_rows(chunks[0] if len(chunks) == 1 else np.stack(chunks), per_channel)
+
+
+def channel_values(streams):
+    """Samples of one channel from its StreamBuffers, 1d for one buffer and stacked rows for several"""
+    return streams[0].values if len(streams) == 1 else np.stack([stream.values for stream in streams])
+
+
+def over_voltage_channels(flags):
+    """Names of the channels set in the over-voltage bit field the driver passes to the streaming callbacks"""
+    return {name for bit, name in enumerate('AB') if flags & 1 << bit}
+
+
+def channel_zeros(per_channel, n_samples):
+    """Stands in for a disabled channel, shaped like channel_values of an enabled one"""
+    return np.zeros(n_samples) if per_channel == 1 else np.zeros((per_channel, n_samples))
+
+
+def group_rows(samples, per_channel):
+    """
+    Group the rows of streamed samples by channel when each channel delivers more than one
+    row, eg the max and min of min-max aggregation.
+
+    samples - (n_channels * per_channel, n) array, rows of one channel next to each other
+    returns (n_channels, per_channel, n), or (per_channel, n) for a single channel
+    """
+    if per_channel == 1:
+        return samples
+    grouped = samples.reshape(len(samples) // per_channel, per_channel, samples.shape[-1])
+    return grouped[0] if len(grouped) == 1 else grouped
+
+
+class RingBuffer:
+    """
+    Fixed size ring of int16 samples, one row per channel, shared by one writer thread and one reader thread.
+
+    Neither side takes a lock: each index is only advanced by the thread that owns it and
+    the writer publishes a chunk by advancing its index after the copy. If the reader falls
+    so far behind that a chunk does not fit, the chunk is dropped rather than stalling the
+    writer and the loss is counted in overruns and dropped_samples. The position where data
+    resumes after a drop is recorded so reads never span a gap and every read knows the
+    exact sample number of its first sample.
+    """
+
+    def __init__(self, capacity, n_channels=1, max_gaps=64):
+        self.capacity = max(int(capacity), 1)
+        self.n_channels = n_channels
+        self._data = np.empty((n_channels, self.capacity), dtype=np.int16)
+        # Owned by the writer
+        self._written = 0
+        self._clock = 0
+        self._gap_pending = False
+        self._gaps = np.zeros((max_gaps, 2), dtype=np.int64)
+        self._gaps_written = 0
+        self.overruns = 0
+        self.dropped_samples = 0
+        # Owned by the reader
+        self._read = 0
+        self._read_clock = 0
+        self._gaps_read = 0
+
+    @property
+    def available(self):
+        """Number of samples waiting to be read"""
+        return self._written - self._read
+
+    @property
+    def total_samples(self):
+        """Number of samples passed to write so far, stored or dropped"""
+        return self._clock
+
+    def write(self, chunk):
+        """
+        Copy a chunk in: a 1d array for a single channel or one array per channel.
+        Returns False if it had to be dropped because the reader is behind.
+        """
+        if isinstance(chunk, np.ndarray) and chunk.ndim == 1:
+            chunk = [chunk]
+        n = len(chunk[0])
+        if n == 0:
+            return True
+        no_room = n > self.capacity - (self._written - self._read)
+        no_gap_record = self._gap_pending and self._gaps_written - self._gaps_read >= len(self._gaps)
+        if no_room or no_gap_record:
+            if not self._gap_pending:
+                self.overruns += 1
+                self._gap_pending = True
+            self.dropped_samples += n
+            self._clock += n
+            return False
+        if self._gap_pending:
+            self._gaps[self._gaps_written % len(self._gaps)] = self._written, self._clock
+            self._gaps_written += 1
+            self._gap_pending = False
+        start = self._written % self.capacity
+        first = min(n, self.capacity - start)
+        for row, samples in zip(self._data, chunk):
+            row[start:start + first] = samples[:first]
+            row[:n - first] = samples[first:]
+        self._clock += n
+        self._written += n
+        return True
+
+    def read(self, max_samples=None):
+        """
+        Take everything available, stopping short of any gap left by dropped data.
+
+        Returns (index, samples) where index is the sample number of the first sample
+        counted from the start of the stream, dropped samples included. samples is 1d for a
+        single channel and (n_channels, n) otherwise.
+        """
+        end = self._written
+        gaps_written = self._gaps_written
+        while self._gaps_read < gaps_written:
+            stored_at, clock = self._gaps[self._gaps_read % len(self._gaps)]
+            if stored_at != self._read:
+                end = min(end, int(stored_at))
+                break
+            self._read_clock = int(clock)
+            self._gaps_read += 1
+        if max_samples is not None:
+            end = min(end, self._read + max_samples)
+
+        n = end - self._read
+        start = self._read % self.capacity
+        first = min(n, self.capacity - start)
+        samples = np.concatenate((self._data[:, start:start + first], self._data[:, :n - first]), axis=1)
+        if self.n_channels == 1:
+            samples = samples[0]
+
+        index = self._read_clock
+        self._read_clock += n
+        self._read = end
+        return index, samples
+
+
+class AcquisitionPlan:
+    """
+    Everything a block capture needs that only changes when the channels or trigger change:
+    the timebase, sample interval, maximum ADC count and preallocated capture buffers.
+
+    The backends build a plan on the first start() after setup_channel / setup_trigger and
+    reuse it, buffers included, for every following start() asking for the same number of
+    samples, so repeated captures skip the timebase search and the allocations.
+
+    samples - samples per capture
+    timebase - driver timebase index
+    interval - sample interval in ns
+    buffers - dict of preallocated numpy arrays, eg {'A': int16 array}
+    everything else is stored as an attribute for the backend's own use
+    """
+
+    def __init__(self, samples, timebase, interval, buffers=None, **kwargs):
+        self.samples = samples
+        self.timebase = timebase
+        self.interval = interval
+        self.buffers = buffers if buffers is not None else {}
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def pointer(self, name):
+        """ctypes int16 pointer to one of the buffers, or None if the plan has no such buffer"""
+        if name not in self.buffers:
+            return None
+        buffer = self.buffers[name]
+        return buffer.ctypes.data_as(ctypes.POINTER(np.ctypeslib.as_ctypes_type(buffer.dtype)))
@@ -0,0 +1,505 @@
+"""Simulated PicoScope drivers.
+
+SimulatedPs2000 and SimulatedPs2000a stand in for picosdk's ps2000 and ps2000a
+driver objects. They expose the same functions the _picoscope_2000 and
+_picoscope_2000a backends call, with the same ctypes arguments, and fill the
+registered buffers with a configurable waveform. Streaming data accrues in real
+time at the requested sample rate so callbacks arrive at a realistic cadence.
+
+No PicoSDK install or hardware is needed which lets the acquisition code be
+benchmarked and regression tested anywhere:
+
+    from labequipment._picoscope_sim import SimulatedPs2000a, Waveform
+    from labequipment.picoscope import PicoScopeDAQ2000a
+
+    pico = PicoScopeDAQ2000a(driver=SimulatedPs2000a(waveform=Waveform('square', frequency=2)))
+"""
+import collections
+import ctypes
+import threading
+import time
+
+import numpy as np
+from picosdk.ctypes_wrapper import C_CALLBACK_FUNCTION_FACTORY
+
+from ._picoscope_common import CHANNEL_INPUT_RANGES_MV
+
+
+# Same fields as the UnitInfo picosdk returns from list_units and Device.info
+UnitInfo = collections.namedtuple('UnitInfo', ['driver', 'variant', 'serial'])
+
+PICO_OK = 0
+PICO_NOT_FOUND = 3
+PICO_INVALID_HANDLE = 12
+PICO_INVALID_TIMEBASE = 14
+PICO_TOO_MANY_SAMPLES = 20
+
+
+class Waveform:
+    """
+    Signal fed to every enabled channel of a simulated scope.
+
+    kind - 'sine', 'square', 'triangle' or 'dc'
+    frequency - Hz
+    amplitude - peak voltage (V)
+    offset - dc offset (V)
+    noise - standard deviation of gaussian noise added (V)
+    phase_b - phase lag of channel B relative to A in radians
+    """
+
+    def __init__(self, kind='sine', frequency=50, amplitude=1.0, offset=0.0, noise=0.0, phase_b=0.0):
+        assert kind in ('sine', 'square', 'triangle', 'dc'), 'Unrecognised waveform'
+        self.kind = kind
+        self.frequency = frequency
+        self.amplitude = amplitude
+        self.offset = offset
+        self.noise = noise
+        self.phase_b = phase_b
+        self._rng = np.random.default_rng(0)
+
+    def volts(self, t, channel=0):
+        phase = 2 * np.pi * self.frequency * t - channel * self.phase_b
+        if self.kind == 'sine':
+            v = np.sin(phase)
+        elif self.kind == 'square':
+            v = np.where(np.sin(phase) >= 0, 1.0, -1.0)
+        elif self.kind == 'triangle':
+            v = 2 / np.pi * np.arcsin(np.sin(phase))
+        else:
+            v = np.ones(np.shape(t))
+        v = self.offset + self.amplitude * v
+        if self.noise:
+            v = v + self._rng.normal(0, self.noise, np.shape(t))
+        return v
+
+    def counts(self, t, channel, range_index, max_adc):
+        full_scale = CHANNEL_INPUT_RANGES_MV[range_index] / 1000
+        counts = np.round(self.volts(t, channel) / full_scale * max_adc)
+        return np.clip(counts, -max_adc, max_adc).astype(np.int16)
+
+
+def _set(arg, value):
+    """Write value into the ctypes scalar passed by byref"""
+    arg._obj.value = value
+
+
+def _address(pointer):
+    """Address of the memory behind byref(x), a ctypes POINTER or a raw address"""
+    if pointer is None:
+        return None
+    if hasattr(pointer, '_obj'):
+        return ctypes.addressof(pointer._obj)
+    if isinstance(pointer, int):
+        return pointer
+    return ctypes.cast(pointer, ctypes.c_void_p).value
+
+
+def _array(pointer, n, ctype=ctypes.c_int16):
+    """numpy view onto n values of driver side memory"""
+    return np.ctypeslib.as_array((ctype * n).from_address(_address(pointer)))
+
+
+def _aggregate(raw, ratio, mode):
+    """Reduce raw samples by ratio the way the device does for each ratio mode. Returns (max, min)"""
+    if ratio <= 1 or mode == 0:
+        return raw, raw
+    n = len(raw) // ratio
+    blocks = raw[:n * ratio].reshape(n, ratio)
+    if mode == 1:
+        return blocks.max(axis=1), blocks.min(axis=1)
+    if mode == 2:
+        return blocks[:, 0], blocks[:, 0]
+    mean = np.round(blocks.mean(axis=1)).astype(np.int16)
+    return mean, mean
+
+
+class _Unit:
+    """State held by a simulated driver for each open handle"""
+
+    def __init__(self, serial, variant):
+        self.serial = serial
+        self.variant = variant
+        self.channels = {0: [True, 7], 1: [False, 7]}
+        self.trigger = None
+        self.buffers = {}
+        self.n_captures = 1
+        self.block = None
+        self.stream = None
+
+
+class _SimulatedDriver:
+    """Behaviour common to both simulated drivers"""
+    MAX_ADC = 32767
+    MAX_MEMORY = 8000
+
+    def __init__(self, units=1, waveform=None, serials=None, open_delay=0.0):
+        self.waveform = waveform if waveform is not None else Waveform()
+        self.serials = serials if serials is not None else ['SIM{:04d}/{:04d}'.format(i + 1, i + 1) for i in range(units)]
+        self.open_delay = open_delay
+        self.calls = 0
+        self._units = {}
+
+    def _open(self, serial=None):
+        time.sleep(self.open_delay)
+        opened = [unit.serial for unit in self._units.values()]
+        for candidate in self.serials:
+            if candidate not in opened and (serial is None or candidate == serial):
+                handle = max(self._units, default=0) + 1
+                self._units[handle] = _Unit(candidate, self.VARIANT)
+                return handle
+        return 0
+
+    def _close(self, handle):
+        return self._units.pop(handle, None) is not None
+
+    def _samples(self, unit, t):
+        """Simulated int16 counts on each channel at times t"""
+        return {ch: self.waveform.counts(t, ch, rng, self.MAX_ADC)
+                for ch, (enabled, rng) in unit.channels.items() if enabled}
+
+    def _start_block(self, handle, samples, interval_s, ready_callback=None, param=None):
+        unit = self._units[handle]
+        t_trigger = 1 / self.waveform.frequency if unit.trigger and self.waveform.frequency else 0.0
+        duration = unit.n_captures * (samples * interval_s + t_trigger)
+        unit.block = {'start': time.perf_counter(), 'duration': duration, 'samples': samples,
+                      'interval': interval_s, 'n_captures': unit.n_captures}
+        if ready_callback is not None:
+            threading.Timer(duration, ready_callback, args=(handle, PICO_OK, param)).start()
+
+    def _block_ready(self, handle):
+        block = self._units[handle].block
+        return block is not None and time.perf_counter() - block['start'] >= block['duration']
+
+    def _block_data(self, handle, segment=0):
+        """Samples of one segment, each segment starting on a trigger (rising edge of the waveform)"""
+        unit = self._units[handle]
+        block = unit.block
+        period = 1 / self.waveform.frequency if self.waveform.frequency else block['samples'] * block['interval']
+        segment_length = block['samples'] * block['interval']
+        t_start = np.ceil(segment * segment_length / period) * period if unit.trigger else segment * segment_length
+        t = t_start + np.arange(block['samples']) * block['interval']
+        return t_start, self._samples(unit, t)
+
+    def _start_stream(self, handle, interval_s, max_samples, auto_stop, ratio=1, ratio_mode=0, overview_size=100000):
+        unit = self._units[handle]
+        unit.stream = {'start': time.perf_counter(), 'interval': interval_s, 'max_samples': max_samples,
+                       'auto_stop': auto_stop, 'ratio': max(int(ratio), 1), 'ratio_mode': ratio_mode,
+                       'overview_size': overview_size, 'produced': 0, 'position': 0, 'overrun': False}
+
+    def _stream_chunk(self, handle, limit):
+        """
+        Aggregated samples that have accrued since the last poll.
+
+        Returns (max, min, lost, over_voltage, auto_stop). lost is the number of aggregated points
+        the overview buffer could not hold and over_voltage has bit n set if channel n went over its range.
+        """
+        stream = self._units[handle].stream
+        self.calls += 1
+        ratio = stream['ratio']
+        due = int((time.perf_counter() - stream['start']) / stream['interval']) - stream['produced']
+        if stream['auto_stop']:
+            due = min(due, stream['max_samples'] * ratio - stream['produced'])
+        # Data the overview buffer could not hold is lost, as on the real device
+        lost = max(due // ratio - stream['overview_size'], 0)
+        n = min(due // ratio, stream['overview_size'], limit)
+        if n <= 0:
+            return None
+        if lost:
+            stream['produced'] += lost * ratio
+            stream['overrun'] = True
+        t = (stream['produced'] + np.arange(n * ratio)) * stream['interval']
+        stream['produced'] += n * ratio
+        raw = self._samples(self._units[handle], t)
+        chunk_max, chunk_min = {}, {}
+        over_voltage = 0
+        for ch, counts in raw.items():
+            chunk_max[ch], chunk_min[ch] = _aggregate(counts, ratio, stream['ratio_mode'])
+            if np.any((counts >= self.MAX_ADC) | (counts <= -self.MAX_ADC)):
+                over_voltage |= 1 << ch
+        auto_stop = bool(stream['auto_stop'] and stream['produced'] >= stream['max_samples'] * ratio)
+        return chunk_max, chunk_min, lost, over_voltage, auto_stop
+
+
+class SimulatedPs2000(_SimulatedDriver):
+    """Drop in replacement for picosdk.ps2000.ps2000 (eg Picoscope 2204A)"""
+    VARIANT = '2204A'
+    MAX_ADC = 32767
+    MAX_MEMORY = 8000
+
+    PS2000_VOLTAGE_RANGE = {
+        'PS2000_20MV': 1,
+        'PS2000_50MV': 2,
+        'PS2000_100MV': 3,
+        'PS2000_200MV': 4,
+        'PS2000_500MV': 5,
+        'PS2000_1V': 6,
+        'PS2000_2V': 7,
+        'PS2000_5V': 8,
+        'PS2000_10V': 9,
+        'PS2000_20V': 10,
+    }
+
+    class _Device:
+        def __init__(self, driver, handle):
+            self.driver = driver
+            self.handle = handle
+            unit = driver._units[handle]
+            # picosdk's ps2000 gives the serial number as bytes
+            self.info = UnitInfo(driver, unit.variant, unit.serial.encode())
+
+    def open_unit(self, serial=None):
+        handle = self._open(serial.decode() if isinstance(serial, bytes) else serial)
+        if handle < 1:
+            raise IOError('Simulated ps2000 driver could find no devices')
+        return self._Device(self, handle)
+
+    def list_units(self):
+        opened = [unit.serial for unit in self._units.values()]
+        return [UnitInfo(self, self.VARIANT, serial.encode()) for serial in self.serials if serial not in opened]
+
+    def ps2000_close_unit(self, handle):
+        return int(self._close(handle))
+
+    def _python_set_channel(self, handle, channel_id, enabled, coupling_id, range_id, analog_offset):
+        self._units[handle].channels[channel_id] = [bool(enabled), range_id]
+        return 1
+
+    def ps2000_get_timebase(self, handle, timebase, no_of_samples, time_interval, time_units, oversample, max_samples):
+        n_enabled = max(sum(enabled for enabled, _ in self._units[handle].channels.values()), 1)
+        if timebase > 20 or no_of_samples > self.MAX_MEMORY // n_enabled:
+            return 0
+        _set(time_interval, 10 * 2 ** timebase)
+        _set(time_units, 2)
+        _set(max_samples, self.MAX_MEMORY // n_enabled)
+        return 1
+
+    def ps2000_set_trigger(self, handle, source, threshold, direction, delay, auto_trigger_ms):
+        self._units[getattr(handle, 'value', handle)].trigger = (source, threshold, direction, delay)
+        return 1
+
+    def ps2000_run_block(self, handle, no_of_values, timebase, oversample, time_indisposed_ms):
+        interval_s = 10 * 2 ** timebase * 1e-9
+        self._start_block(handle, no_of_values, interval_s)
+        _set(time_indisposed_ms, int(self._units[handle].block['duration'] * 1000))
+        return 1
+
+    def ps2000_ready(self, handle):
+        self.calls += 1
+        return int(self._block_ready(handle))
+
+    def ps2000_stop(self, handle):
+        handle = getattr(handle, 'value', handle)
+        self._units[handle].block = None
+        self._units[handle].stream = None
+        return 1
+
+    def ps2000_get_times_and_values(self, handle, times, buffer_a, buffer_b, buffer_c, buffer_d, overflow, time_units, no_of_values):
+        block = self._units[handle].block
+        n = min(no_of_values, block['samples'])
+        _, data = self._block_data(handle)
+        interval_ns = block['interval'] * 1e9
+        _array(times, n, ctypes.c_int32)[:] = np.arange(n) * interval_ns
+        for buffer, ch in ((buffer_a, 0), (buffer_b, 1)):
+            if buffer is not None and ch in data:
+                _array(buffer, n)[:] = data[ch][:n]
+        return n
+
+    def ps2000_run_streaming_ns(self, handle, sample_interval, time_units, max_samples, auto_stop, no_of_samples_per_aggregate, overview_buffer_size):
+        handle = getattr(handle, 'value', handle)
+        interval = getattr(sample_interval, 'value', sample_interval)
+        units = getattr(time_units, 'value', time_units)
+        self._start_stream(handle, interval * 10.0 ** (3 * units - 15),
+                           getattr(max_samples, 'value', max_samples),
+                           getattr(auto_stop, 'value', auto_stop),
+                           ratio=getattr(no_of_samples_per_aggregate, 'value', no_of_samples_per_aggregate),
+                           ratio_mode=1,
+                           overview_size=getattr(overview_buffer_size, 'value', overview_buffer_size))
+        return 1
+
+    def ps2000_get_streaming_last_values(self, handle, callback):
+        chunk = self._stream_chunk(handle, limit=self._units[handle].stream['overview_size'])
+        if chunk is None:
+            return 1
+        chunk_max, chunk_min, _, over_voltage, auto_stop = chunk
+        n = len(next(iter(chunk_max.values())))
+        arrays = []
+        for ch in (0, 1):
+            for source in (chunk_max, chunk_min):
+                arrays.append(np.ascontiguousarray(source[ch]) if ch in source else np.zeros(n, dtype=np.int16))
+        buffers = (ctypes.POINTER(ctypes.c_int16) * 4)(*[a.ctypes.data_as(ctypes.POINTER(ctypes.c_int16)) for a in arrays])
+        callback(buffers, over_voltage, 0, 0, int(auto_stop), n)
+        return 1
+
+    def ps2000_overview_buffer_status(self, handle, previous_buffer_overrun):
+        stream = self._units[getattr(handle, 'value', handle)].stream
+        _set(previous_buffer_overrun, int(stream is not None and stream['overrun']))
+        if stream is not None:
+            stream['overrun'] = False
+        return 0
+
+
+class SimulatedPs2000a(_SimulatedDriver):
+    """Drop in replacement for picosdk.ps2000a.ps2000a (eg Picoscope 2208B)"""
+    VARIANT = '2208B'
+    MAX_ADC = 32512
+    MAX_MEMORY = 128000000
+
+    PS2000A_CHANNEL = {'PS2000A_CHANNEL_A': 0, 'PS2000A_CHANNEL_B': 1}
+    PS2000A_COUPLING = {'PS2000A_AC': 0, 'PS2000A_DC': 1}
+    PS2000A_RATIO_MODE = {
+        'PS2000A_RATIO_MODE_NONE': 0,
+        'PS2000A_RATIO_MODE_AGGREGATE': 1,
+        'PS2000A_RATIO_MODE_DECIMATE': 2,
+        'PS2000A_RATIO_MODE_AVERAGE': 4,
+    }
+    PS2000A_TIME_UNITS = {'PS2000A_FS': 0, 'PS2000A_PS': 1, 'PS2000A_NS': 2, 'PS2000A_US': 3, 'PS2000A_MS': 4, 'PS2000A_S': 5}
+    BlockReadyType = C_CALLBACK_FUNCTION_FACTORY(None, ctypes.c_int16, ctypes.c_uint32, ctypes.c_void_p)
+    StreamingReadyType = C_CALLBACK_FUNCTION_FACTORY(None, ctypes.c_int16, ctypes.c_int32, ctypes.c_uint32, ctypes.c_int16,
+                                                     ctypes.c_uint32, ctypes.c_int16, ctypes.c_int16, ctypes.c_void_p)
+
+    @staticmethod
+    def _interval_ns(timebase):
+        return 2 ** timebase if timebase <= 2 else (timebase - 2) * 8
+
+    def ps2000aOpenUnit(self, handle, serial):
+        serial = serial.value.decode() if serial is not None else None
+        new_handle = self._open(serial)
+        _set(handle, new_handle)
+        return PICO_OK if new_handle > 0 else PICO_NOT_FOUND
+
+    def ps2000aEnumerateUnits(self, count, serials, serial_length):
+        opened = [unit.serial for unit in self._units.values()]
+        available = [serial for serial in self.serials if serial not in opened]
+        _set(count, len(available))
+        if serials is not None:
+            text = ','.join(available).encode()
+            ctypes.memmove(serials, text, len(text) + 1)
+            _set(serial_length, len(text))
+        return PICO_OK
+
+    def ps2000aGetUnitInfo(self, handle, string, string_length, required_size, info):
+        unit = self._units[getattr(handle, 'value', handle)]
+        text = {3: unit.variant, 4: unit.serial}.get(info, '').encode()
+        ctypes.memmove(string, text, len(text) + 1)
+        _set(required_size, len(text))
+        return PICO_OK
+
+    def ps2000aCloseUnit(self, handle):
+        return PICO_OK if self._close(getattr(handle, 'value', handle)) else PICO_INVALID_HANDLE
+
+    def ps2000aSetChannel(self, handle, channel, enabled, coupling, range_index, analogue_offset):
+        self._units[handle.value].channels[channel] = [bool(enabled), range_index]
+        return PICO_OK
+
+    def ps2000aMaximumValue(self, handle, value):
+        _set(value, self.MAX_ADC)
+        return PICO_OK
+
+    def ps2000aMemorySegments(self, handle, n_segments, max_samples):
+        _set(max_samples, self.MAX_MEMORY // max(n_segments, 1))
+        return PICO_OK
+
+    def ps2000aSetNoOfCaptures(self, handle, n_captures):
+        self._units[handle.value].n_captures = n_captures
+        return PICO_OK
+
+    def ps2000aGetTimebase2(self, handle, timebase, no_of_samples, time_interval_ns, oversample, max_samples, segment_index):
+        unit = self._units[handle.value]
+        n_enabled = max(sum(enabled for enabled, _ in unit.channels.values()), 1)
+        available = self.MAX_MEMORY // (n_enabled * unit.n_captures)
+        if timebase > 2 ** 32 - 1:
+            return PICO_INVALID_TIMEBASE
+        if no_of_samples > available:
+            return PICO_TOO_MANY_SAMPLES
+        _set(time_interval_ns, self._interval_ns(timebase))
+        _set(max_samples, available)
+        return PICO_OK
+
+    def ps2000aSetSimpleTrigger(self, handle, enable, source, threshold, direction, delay, auto_trigger_ms):
+        self._units[handle.value].trigger = (source, threshold, direction, delay) if enable else None
+        return PICO_OK
+
+    def ps2000aRunBlock(self, handle, pre_trigger_samples, post_trigger_samples, timebase, oversample, time_indisposed_ms, segment_index, ready, parameter):
+        self._start_block(handle.value, pre_trigger_samples + post_trigger_samples, self._interval_ns(timebase) * 1e-9, ready, parameter)
+        return PICO_OK
+
+    def ps2000aIsReady(self, handle, ready):
+        self.calls += 1
+        _set(ready, int(self._block_ready(handle.value)))
+        return PICO_OK
+
+    def ps2000aStop(self, handle):
+        unit = self._units[handle.value]
+        unit.block = None
+        unit.stream = None
+        return PICO_OK
+
+    def ps2000aSetDataBuffers(self, handle, channel, buffer_max, buffer_min, buffer_length, segment_index, mode):
+        self._units[handle.value].buffers[(channel, segment_index)] = (buffer_max, buffer_min, buffer_length)
+        return PICO_OK
+
+    def ps2000aSetDataBuffer(self, handle, channel, buffer, buffer_length, segment_index, mode):
+        return self.ps2000aSetDataBuffers(handle, channel, buffer, None, buffer_length, segment_index, mode)
+
+    def _copy_segment(self, unit, handle, segment, n):
+        _, data = self._block_data(handle, segment)
+        for ch, counts in data.items():
+            if (ch, segment) in unit.buffers:
+                buffer_max, buffer_min, length = unit.buffers[(ch, segment)]
+                m = min(n, length, len(counts))
+                for buffer in (buffer_max, buffer_min):
+                    if buffer is not None:
+                        _array(buffer, m)[:] = counts[:m]
+
+    def ps2000aGetValues(self, handle, start_index, no_of_samples, downsample_ratio, downsample_ratio_mode, segment_index, overflow):
+        unit = self._units[handle.value]
+        n = min(no_of_samples._obj.value, unit.block['samples'])
+        self._copy_segment(unit, handle.value, segment_index, n)
+        _set(no_of_samples, n)
+        _set(overflow, 0)
+        return PICO_OK
+
+    def ps2000aGetValuesBulk(self, handle, no_of_samples, from_segment_index, to_segment_index, downsample_ratio, downsample_ratio_mode, overflow):
+        unit = self._units[handle.value]
+        n = min(no_of_samples._obj.value, unit.block['samples'])
+        for segment in range(from_segment_index, to_segment_index + 1):
+            self._copy_segment(unit, handle.value, segment, n)
+        _set(no_of_samples, n)
+        return PICO_OK
+
+    def ps2000aGetValuesTriggerTimeOffsetBulk64(self, handle, times, time_units, from_segment_index, to_segment_index):
+        n = to_segment_index - from_segment_index + 1
+        _array(times, n, ctypes.c_int64)[:] = 0
+        _array(time_units, n, ctypes.c_int32)[:] = self.PS2000A_TIME_UNITS['PS2000A_NS']
+        return PICO_OK
+
+    def ps2000aRunStreaming(self, handle, sample_interval, sample_interval_time_units, max_pre_trigger_samples, max_post_trigger_samples, auto_stop, downsample_ratio, downsample_ratio_mode, overview_buffer_size):
+        interval = sample_interval._obj.value * 10.0 ** (3 * sample_interval_time_units - 15)
+        # The 2000a counts the samples to stop after before downsampling
+        max_samples = -(-(max_pre_trigger_samples + max_post_trigger_samples) // max(int(downsample_ratio), 1))
+        self._start_stream(handle.value, interval, max_samples, auto_stop,
+                           ratio=downsample_ratio, ratio_mode=downsample_ratio_mode, overview_size=overview_buffer_size)
+        return PICO_OK
+
+    def ps2000aGetStreamingLatestValues(self, handle, callback, parameter):
+        unit = self._units[handle.value]
+        stream = unit.stream
+        registered = {ch: buffers for (ch, segment), buffers in unit.buffers.items() if segment == 0}
+        length = min(buffers[2] for buffers in registered.values())
+        chunk = self._stream_chunk(handle.value, limit=length - stream['position'])
+        if chunk is None:
+            return PICO_OK
+        chunk_max, chunk_min, lost, over_voltage, auto_stop = chunk
+        # The driver keeps its place in the buffer as if the lost points had been written, leaving a gap in startIndex
+        start = (stream['position'] + lost) % length
+        produced = len(next(iter(chunk_max.values())))
+        n = min(produced, length - start)
+        for ch, (buffer_max, buffer_min, _) in registered.items():
+            if ch in chunk_max:
+                _array(buffer_max, start + n)[start:] = chunk_max[ch][:n]
+                if buffer_min is not None:
+                    _array(buffer_min, start + n)[start:] = chunk_min[ch][:n]
+        # Points past the end of the buffer after a gap are lost too
+        stream['position'] = (start + produced) % length
+        callback(handle.value, n, start, over_voltage, 0, 0, int(auto_stop), parameter)
+        return PICO_OK
@@ -0,0 +1,138 @@
+"""Simulated stepper board.
+
+SimulatedStepperBoard behaves like an Arduino running ArduinoSketches/Shaker_Motor_v3: it
+speaks the framed protocol of stepper.py on one end of a pseudo terminal, queues each motor's
+moves and takes abs(steps) / steps_per_sec seconds over each, moving both motors at once. Open the other end, board.port, with
+arduino.Arduino as you would a board that is already running:
+
+    from labequipment._stepper_sim import SimulatedStepperBoard
+    from labequipment.arduino import Arduino
+    from labequipment.stepper import FramedStepper
+
+    board = SimulatedStepperBoard()
+    stepper = FramedStepper(Arduino({'PORT': board.port, 'BAUDRATE': 115200}, reset=False))
+
+Faults can be injected to test recovery: corrupt_received and drop_sent are the indices of
+frames (counting from 0) the board treats as failing their CRC or never manages to send.
+Needs pseudo terminals, so Linux or macOS.
+"""
+import collections
+import os
+import pty
+import select
+import struct
+import threading
+import time
+import tty
+
+from labequipment.stepper import (FrameParser, encode_frame, MAX_STEPS, QUEUE_SIZE, MOTORS, MOVE, PING, HELLO,
+                                  ACK, DONE, NAK, PONG, NAK_SEQUENCE, NAK_QUEUE_FULL, NAK_INVALID)
+
+
+class SimulatedStepperBoard:
+
+    def __init__(self, steps_per_sec=50000, corrupt_received=(), drop_sent=()):
+        self.steps_per_sec = steps_per_sec
+        self.corrupt_received = set(corrupt_received)
+        self.drop_sent = set(drop_sent)
+        self.controller, self.peripheral = pty.openpty()
+        tty.setraw(self.peripheral)
+        self.port = os.ttyname(self.peripheral)
+        self.positions = {1: 0, 2: 0}
+        self.moves = []     # (seq, motor, steps) in the order they finished
+        self.received = 0
+        self.sent = 0
+        self._lock = threading.Lock()
+        self.reset()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def reset(self):
+        """Power up: forget the queue and sequence numbers and print the banner, which opening the port discards"""
+        with self._lock:
+            self._parser = FrameParser()
+            self._expected = 0
+            self._queues = {motor: collections.deque() for motor in MOTORS}
+            self._current = dict.fromkeys(MOTORS)     # motor -> (seq, steps, finish time)
+            self._last_done = dict.fromkeys(MOTORS)
+            os.write(self.controller, b'System ready.\r\n')
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        os.close(self.controller)
+        os.close(self.peripheral)
+
+    def _serve(self):
+        while not self._stop.is_set():
+            wait = 0.01
+            for current in self._current.values():
+                if current is not None:
+                    wait = min(wait, max(current[2] - time.monotonic(), 0))
+            if select.select([self.controller], [], [], wait)[0]:
+                data = os.read(self.controller, 1024)
+                with self._lock:
+                    for frame in self._parser.feed(data):
+                        self.received += 1
+                        if self.received - 1 not in self.corrupt_received:
+                            self._receive(*frame)
+            with self._lock:
+                self._step()
+
+    def _receive(self, seq, cmd, payload):
+        if cmd == HELLO:
+            self._expected = seq
+            self._last_done = dict.fromkeys(MOTORS)
+            self._send(seq, PONG, self._status())
+        elif cmd == PING:
+            self._send(seq, PONG, self._status())
+        elif cmd == MOVE:
+            if seq == self._expected:
+                motor, steps = struct.unpack('<Bi', payload) if len(payload) == 5 else (0, 0)
+                if motor not in (1, 2) or abs(steps) > MAX_STEPS:
+                    self._expected = (seq + 1) & 0xFF
+                    self._send(seq, NAK, bytes((NAK_INVALID,)))
+                elif self._queued(motor) >= QUEUE_SIZE:
+                    self._send(seq, NAK, bytes((NAK_QUEUE_FULL,)))
+                else:
+                    self._queues[motor].append((seq, steps))
+                    self._last_done[motor] = None
+                    self._expected = (seq + 1) & 0xFF
+                    self._send(seq, ACK, bytes((QUEUE_SIZE - self._queued(motor),)))
+            elif 0 < (self._expected - seq) & 0xFF < 128:
+                # Sent again because our ACK was lost, it is already queued
+                self._send((self._expected - 1) & 0xFF, ACK, bytes((0,)))
+            else:
+                self._send(self._expected, NAK, bytes((NAK_SEQUENCE,)))
+
+    def _step(self):
+        now = time.monotonic()
+        for motor in MOTORS:
+            current = self._current[motor]
+            if current is not None and now >= current[2]:
+                seq, steps, _ = current
+                self.positions[motor] += steps
+                self.moves.append((seq, motor, steps))
+                self._last_done[motor] = seq
+                self._current[motor] = None
+                self._send(seq, DONE)
+            if self._current[motor] is None and self._queues[motor]:
+                seq, steps = self._queues[motor].popleft()
+                self._current[motor] = (seq, steps, now + abs(steps) / self.steps_per_sec)
+
+    def _queued(self, motor):
+        return len(self._queues[motor]) + (self._current[motor] is not None)
+
+    def _status(self):
+        """PONG payload, each motor's last finished move"""
+        status = []
+        for motor in MOTORS:
+            done = self._last_done[motor]
+            status += (done, 1) if done is not None else (0, 0)
+        return bytes(status)
+
+    def _send(self, seq, cmd, payload=b''):
+        self.sent += 1
+        if self.sent - 1 not in self.drop_sent:
+            os.write(self.controller, encode_frame(seq, cmd, payload))
@@ -1,11 +1,26 @@
+import atexit
+from contextlib import contextmanager
 import serial
 import time
 import os
 
+from labequipment.async_serial import AsyncInstrument
+from labequipment.instrument_server import RemoteSerial
+
+try:
+    import termios
+except ImportError:
+    # Windows
+    termios = None
+
+# Arduinos opened by connect(), kept open for the rest of the session
+_pool = {}
+
 
 class Arduino:
 
-    def __init__(self, settings, timeout=0, write_timeout=0):
+    def __init__(self, settings, timeout=0, write_timeout=0, read_timeout=None, reset=True, ready=None,
+                 ready_timeout=3, handshake=None, server=None):
         """Open the selected serial port
         
         inputs:
@@ -13,6 +28,21 @@ class Arduino:
                         like:
                         {PORT   :   "COM1",
                         BAUDRATE    :  9600}
+        read_timeout :  Default deadline in seconds for read_serial_line, read_serial_bytes
+                        and readlines. None waits for as long as it takes.
+        reset       :   Opening the port normally resets the board. With reset=False DTR is
+                        held low so a board that is already running carries on, and is left
+                        low when the port closes so reopening it later doesn't reset it either.
+        ready       :   Text the sketch prints once its setup() has finished, eg 'ready'.
+                        After a reset we wait for it rather than a fixed time. None accepts
+                        the first line the board prints.
+        ready_timeout : Longest to wait for ready, the old fixed delay for sketches that print nothing.
+        handshake   :   Command to send repeatedly while waiting, for sketches that only
+                        reply to a command rather than print a banner. It is sent as a
+                        line, the newline is added if it does not end in one.
+        server      :   Socket of an instrument server (eg instrument_server.SOCKET) to share
+                        the port with other scripts through, see instrument_server.py. The
+                        board is only waited for when the server first opens the port.
         
         If not supplying a value provide False.
 
@@ -24,9 +54,59 @@ class Arduino:
             Do stuff.
                 
         """
-        self.port = serial.Serial(port=settings['PORT'], baudrate=settings['BAUDRATE'], timeout=timeout, write_timeout=write_timeout)
-        time.sleep(3) #allowing time for serial port to reset.
+        self.read_timeout = read_timeout
+        self.pooled = False
+        if server is not None:
+            self.port = RemoteSerial(settings['PORT'], socket_path=server, timeout=timeout,
+                                     baudrate=settings['BAUDRATE'], write_timeout=write_timeout)
+            self.ready = True
+            if self.port.opened:
+                self.ready = self.wait_until_ready(ready, ready_timeout, handshake)
+            self.flush()
+            return
+        self.port = serial.Serial(baudrate=settings['BAUDRATE'], timeout=timeout, write_timeout=write_timeout)
+        self.port.port = settings['PORT']
+        if not reset:
+            self.port.dtr = False
+        self.port.open()
+        self.ready = True
+        if reset:
+            self.ready = self.wait_until_ready(ready, ready_timeout, handshake)
+        else:
+            self._keep_dtr_on_close()
         self.flush()
+
+    def wait_until_ready(self, ready=None, timeout=3, handshake=None):
+        """
+        Wait for the board to finish resetting, signalled by it printing a line containing ready
+        (any line if ready is None). Returns as soon as the line arrives.
+
+        handshake - command sent as a line every 0.25 s while waiting, eg one the sketch answers
+        returns True if the board signalled it was ready, False if timeout seconds passed first
+        """
+        deadline = time.monotonic() + timeout
+        received = ''
+        if handshake is not None and not handshake.endswith('\n'):
+            handshake += '\n'
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if handshake is not None:
+                self.port.write(bytes(handshake, 'utf8'))
+                remaining = min(remaining, 0.25)
+            received += self.read_serial_line(timeout=remaining)
+            if received.endswith('\n'):
+                if ready is None or ready in received:
+                    return True
+                received = ''
+
+    def _keep_dtr_on_close(self):
+        """Stop the OS dropping DTR when the port closes (HUPCL), which would reset the board next time it's opened"""
+        if termios is not None and hasattr(self.port, 'fileno'):
+            attributes = termios.tcgetattr(self.port.fileno())
+            attributes[2] &= ~termios.HUPCL
+            termios.tcsetattr(self.port.fileno(), termios.TCSANOW, attributes)
             
     def flush(self):
         '''
@@ -61,34 +141,60 @@ class Arduino:
             write_success = False
         return write_success
     
-    def read_serial_bytes(self, no_of_bytes):
-        """ Read a given no_of_bytes from the serial port"""
-        size_of_input_buffer = 0
-        while size_of_input_buffer < no_of_bytes:
-            size_of_input_buffer = self.port.inWaiting()
-        text = self.port.read(no_of_bytes)
-
-    def read_serial_line(self):
+    def read_serial_bytes(self, no_of_bytes, timeout=None):
+        """ Read a given no_of_bytes from the serial port
+
+        Blocks in the operating system until the bytes arrive so it returns as soon as
+        they are in without using any cpu while waiting.
+
+        Input:
+            timeout     seconds to wait, defaults to read_timeout
+        Outputs:
+            the bytes read, fewer than no_of_bytes if the timeout expired first
+        """
+        with self._blocking_reads(timeout):
+            return self.port.read(no_of_bytes)
+
+    def read_serial_line(self, timeout=None):
         """
-        Waits for data in the input buffer then
-        reads a single line from the serial port.
+        Waits for a line to arrive then reads it from the serial port.
 
+        Input:
+            timeout     seconds to wait, defaults to read_timeout
         Outputs:
-            text    the data from serial in unicode
+            text    the data from serial in unicode. If the timeout expires first
+                    it is whatever had arrived, without a newline, possibly ''.
+                    Bytes that are not utf-8, eg the noise of a board resetting, become U+FFFD
         """
-        size_of_input_buffer = 0
-        while size_of_input_buffer == 0:
-            size_of_input_buffer = self.port.inWaiting()
-            time.sleep(0.1)
-        text = self.port.readline()
-        return text.decode()
-
-    def readlines(self, n):
-        out = [self.port.readline().decode() for i in range(n)]
+        with self._blocking_reads(timeout):
+            text = self.port.readline()
+        return text.decode(errors='replace')
+
+    def readlines(self, n, timeout=None):
+        """Read n lines, timeout is the deadline for all of them together"""
+        with self._blocking_reads(timeout):
+            deadline = serial.Timeout(self.port.timeout)
+            out = []
+            for i in range(n):
+                self.port.timeout = deadline.time_left()
+                out.append(self.port.readline().decode())
         return out
 
-    def ignorelines(self, n):
-        [self.port.readline() for i in range(n)]
+    def ignorelines(self, n, timeout=None):
+        self.readlines(n, timeout)
+
+    @contextmanager
+    def _blocking_reads(self, timeout):
+        """Make reads on the port wait up to timeout seconds (default read_timeout) inside the with block"""
+        timeout = self.read_timeout if timeout is None else timeout
+        previous = self.port.timeout
+        if timeout != previous:
+            self.port.timeout = timeout
+        try:
+            yield
+        finally:
+            if self.port.timeout != previous:
+                self.port.timeout = previous
 
     def read_all(self):
         string = ''
@@ -106,8 +212,104 @@ class Arduino:
         return self
 
     def __exit__(self, *args):
-        self.quit_serial()
-        
+        # Pooled Arduinos stay open for the next connect()
+        if not self.pooled:
+            self.quit_serial()
+
+
+def connect(settings, **kwargs):
+    """
+    An open Arduino on settings['PORT'], reusing the one opened by an earlier call if it is still open.
+
+    Scripts run again in the same session (eg %run in IPython or cells in a notebook) then skip
+    opening the port and waiting for the board entirely. Leaving a with block does not close a
+    pooled Arduino, use close_all(). kwargs are passed to Arduino the first time.
+    Opening with reset=False also makes reconnecting from a new session quick as the board is not reset.
+
+    Example:
+
+        with connect(settings, ready='ready') as ard:
+            ard.send_serial_line('M1+3000')
+    """
+    ard = _pool.get(settings['PORT'])
+    if ard is None or not ard.port.is_open:
+        ard = Arduino(settings, **kwargs)
+        ard.pooled = True
+        _pool[settings['PORT']] = ard
+    return ard
+
+
+def close_all():
+    """Close every Arduino opened by connect()"""
+    while _pool:
+        _, ard = _pool.popitem()
+        if ard.port.is_open:
+            ard.quit_serial()
+
+
+atexit.register(close_all)
+
+
+class AsyncArduino(AsyncInstrument):
+    """
+    Arduino for asyncio, eg line = await ard.read_serial_line(). See async_serial.py
+
+    Example:
+
+        async with AsyncArduino(settings) as ard:
+            await ard.send_serial_line('M1+3000')
+            reply = await ard.read_serial_line(timeout=10)
+    """
+
+    def __init__(self, settings, read_timeout=None, write_timeout=0, ready=None, ready_timeout=3):
+        super().__init__(settings['PORT'], baudrate=settings['BAUDRATE'], timeout=read_timeout, write_timeout=write_timeout)
+        self.ready = ready
+        self.ready_timeout = ready_timeout
+
+    async def _setup(self):
+        # Wait for the board to say it has reset, see Arduino.wait_until_ready
+        deadline = time.monotonic() + self.ready_timeout
+        while time.monotonic() < deadline:
+            line = await self.read_serial_line(timeout=deadline - time.monotonic())
+            if line.endswith('\n') and (self.ready is None or self.ready in line):
+                break
+        await self.flush()
+
+    async def flush(self):
+        await self.com.reset_input_buffer()
+
+    async def send_serial_line(self, text):
+        await self.flush()
+        if text[-2:] != "\n":
+            text += "\n"
+        num_bytes = await self.com.write(bytes(text, 'utf8'))
+        if not num_bytes:
+            print('writing to serial failed!')
+        return bool(num_bytes)
+
+    async def read_serial_bytes(self, no_of_bytes, timeout=None):
+        """Read no_of_bytes, fewer if timeout (default read_timeout) expires first"""
+        return await self.com.read(no_of_bytes, timeout)
+
+    async def read_serial_line(self, timeout=None):
+        """Read a line as unicode, what had arrived if timeout (default read_timeout) expires first"""
+        return (await self.com.readline(timeout)).decode()
+
+    async def readlines(self, n, timeout=None):
+        """Read n lines, timeout is the deadline for all of them together"""
+        if timeout is None:
+            return [await self.read_serial_line() for i in range(n)]
+        deadline = time.monotonic() + timeout
+        return [await self.read_serial_line(max(deadline - time.monotonic(), 0)) for i in range(n)]
+
+    async def read_all(self):
+        return (await self.com.read_all()).decode("utf-8")
+
+    async def quit_serial(self):
+        await self.close()
+        print('port closed')
+
+
 def find_port():
     items = os.listdir('/dev/')
     newlist = []
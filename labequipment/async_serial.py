@@ -0,0 +1,138 @@
+"""asyncio access to serial instruments.
+
+pyserial only does blocking I/O, so AsyncSerial gives every port a thread of its own to
+block in and lets the event loop await the result. A slow instrument then only holds up its own
+thread and a rig polled from one event loop takes as long as its slowest instrument rather
+than the sum of them all. Threads rather than the event loop's file descriptor readers keep it
+working with Windows COM ports and without any extra dependency.
+
+The async variants of the instruments (AsyncArduino, AsyncLauda, AsyncLaser, AsyncProbe) are
+built on AsyncInstrument and sit next to the blocking classes in their modules.
+
+Example:
+
+    from labequipment.lauda import AsyncLauda
+    from labequipment.omega_temperature_probe import AsyncProbe
+
+    async def poll(probe, lauda):
+        async with probe, lauda:
+            while True:
+                temp, bath = await asyncio.gather(probe.get_temp_C(), lauda.read_current_temp())
+                print(temp, bath)
+
+    asyncio.run(poll(AsyncProbe(), AsyncLauda('COM3')))
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import serial
+
+
+class AsyncSerial:
+    """
+    A serial.Serial whose I/O is awaited.
+
+    The port is opened by open() (or async with) on the port's own thread with the arguments of serial.Serial.
+    Calls on one port run one at a time in the order they were awaited so a write and the read of its reply
+    are never interleaved with another's.
+
+    inputs -
+    port - name of the port eg 'COM4' or '/dev/ttyACM0'
+    serial_kwargs - passed on to serial.Serial, eg baudrate=19200
+    """
+
+    def __init__(self, port, **serial_kwargs):
+        self.name = port
+        self._kwargs = serial_kwargs
+        self.port = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='serial {}'.format(port))
+
+    async def open(self):
+        if self.port is None:
+            self.port = await self._run(serial.Serial, self.name, **self._kwargs)
+        return self
+
+    async def close(self):
+        if self.port is not None:
+            await self._run(self.port.close)
+            self.port = None
+        self._executor.shutdown(wait=False)
+
+    async def write(self, data):
+        return await self._run(self.port.write, data)
+
+    async def read(self, size=1, timeout=None):
+        """Up to size bytes, fewer if timeout seconds pass first. None uses the port's timeout"""
+        return await self._run(self._with_timeout, self.port.read, size, timeout=timeout)
+
+    async def readline(self, timeout=None):
+        """One line as bytes, or what had arrived when timeout seconds passed. None uses the port's timeout"""
+        return await self._run(self._with_timeout, self.port.readline, timeout=timeout)
+
+    async def read_all(self):
+        """Everything waiting in the input buffer without waiting for more"""
+        return await self._run(self.port.read_all)
+
+    async def in_waiting(self):
+        """Number of bytes waiting in the input buffer"""
+        return await self._run(lambda: self.port.in_waiting)
+
+    async def reset_input_buffer(self):
+        await self._run(self.port.reset_input_buffer)
+
+    async def query(self, command, timeout=None):
+        """Write command and return the line sent back"""
+        return await self._run(self._query, command, timeout)
+
+    def _query(self, command, timeout):
+        self.port.write(command)
+        return self._with_timeout(self.port.readline, timeout=timeout)
+
+    def _with_timeout(self, read, *args, timeout=None):
+        """Call read with the port's timeout set to timeout, runs on the port's thread"""
+        if timeout is None:
+            return read(*args)
+        previous = self.port.timeout
+        self.port.timeout = timeout
+        try:
+            return read(*args)
+        finally:
+            self.port.timeout = previous
+
+    def _run(self, function, *args, **kwargs):
+        return asyncio.get_running_loop().run_in_executor(self._executor, lambda: function(*args, **kwargs))
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+
+class AsyncInstrument:
+    """
+    Base of the async variants of the instruments. Holds an AsyncSerial in self.com.
+
+    Open with async with, or await instrument.open() and later instrument.close().
+    Subclasses put the I/O an instrument needs once the port is open in _setup.
+    """
+
+    def __init__(self, port, **serial_kwargs):
+        self.com = AsyncSerial(port, **serial_kwargs)
+
+    async def open(self):
+        await self.com.open()
+        await self._setup()
+        return self
+
+    async def _setup(self):
+        pass
+
+    async def close(self):
+        await self.com.close()
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *args):
+        await self.close()
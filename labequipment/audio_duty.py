@@ -1,4 +1,32 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import hashlib
+import json
+import os
+import re
+import subprocess
+import wave as wavefile
+
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+try:
+    from imageio_ffmpeg import get_ffmpeg_exe
+    FFMPEG = get_ffmpeg_exe()
+except ImportError:
+    # Fall back on an ffmpeg on the PATH
+    FFMPEG = 'ffmpeg'
+
+# Sample formats of WAV files by bytes per sample
+WAV_DTYPES = {1: np.uint8, 2: np.int16, 4: np.int32}
+
+# Tones a duty cycle can be encoded as, 1000 Hz for 0 up to 16000 Hz for 1000 in steps of 15 Hz,
+# see convert_audio_frequency_to_duty_cycle
+TONE_BAND = (1000, 16000)
+TONE_STEP = 15
+
+# Duty cycles already extracted, see duty_many
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.labequipment', 'duty_cache')
 
 def convert_audio_frequency_to_duty_cycle(freqs):
     """
@@ -8,29 +36,347 @@ def convert_audio_frequency_to_duty_cycle(freqs):
     return d
 
 
-def duty(video_filename, num_frames):
-    duty_cycle = read_audio_file(video_filename, num_frames)
-    duty_cycle = np.uint16(duty_cycle)
+def duty(video_filename, num_frames, audio_rate=48000, track=False):
+    duty_cycle = read_audio_file(video_filename, num_frames, audio_rate, track)
+    # Round rather than truncate, the interpolated frequencies land either side of the exact tone
+    duty_cycle = np.uint16(np.round(duty_cycle))
     return duty_cycle
 
 
-def read_audio_file(file, frames):
-    wav = audio.extract_wav(file)
-    wav_l = wav[:, 0]
-    freqs = frame_frequency(wav_l, frames, 48000)
-    d = (freqs - 1000) / 15
-    return d
+def read_audio_file(file, frames, audio_rate=48000, track=False):
+    """
+    Duty cycle of each of frames equal parts of the left audio channel of file, decoded a block at a time.
+    track - decode with track_tone_frequency rather than batch_peak_frequency
+    """
+    return np.concatenate(list(iter_duty_cycles(file, frames, audio_rate, track=track)))
+
+
+def duty_many(video_filenames, num_frames, audio_rate=48000, processes=None, cache_dir=CACHE_DIR, track=False):
+    """
+    duty() for a list of videos, spread over a pool of processes and cached on disk.
+
+    The duty cycles of each video are stored in cache_dir under the hash of the file contents together
+    with num_frames and audio_rate, so running an analysis again, or on a renamed or copied video, loads them
+    instead of decoding the audio. The hash of each file is itself remembered against its size and
+    modification time so unchanged videos are not read at all.
+
+    video_filenames - list of videos
+    num_frames - number of frames, either one for every video or a list with one per video
+    audio_rate - samples per second the audio is decoded at
+    processes - number of worker processes, defaults to one per core
+    cache_dir - where to keep the results, None to not cache
+    track - decode with track_tone_frequency, cached separately
+
+    returns a list of uint16 arrays of duty cycles in the order of video_filenames
+    """
+    if np.ndim(num_frames) == 0:
+        num_frames = [num_frames] * len(video_filenames)
+    results = [None] * len(video_filenames)
+    cache_files = [None] * len(video_filenames)
+    if cache_dir is not None:
+        hashes = _load_hashes(cache_dir)
+        for i, (filename, frames) in enumerate(zip(video_filenames, num_frames)):
+            cache_files[i] = os.path.join(cache_dir, '{}_{}_{}{}.npy'.format(_file_hash(filename, hashes), frames, audio_rate,
+                                                                            '_track' if track else ''))
+            if os.path.exists(cache_files[i]):
+                results[i] = np.load(cache_files[i])
+        _save_hashes(cache_dir, hashes)
+
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            jobs = {i: pool.submit(duty, video_filenames[i], num_frames[i], audio_rate, track) for i in missing}
+            for i, job in jobs.items():
+                results[i] = job.result()
+                if cache_files[i] is not None:
+                    _save_result(cache_files[i], results[i])
+    return results
+
+
+def _file_hash(filename, hashes):
+    """sha256 of the contents of filename, reusing the one in hashes if the file has not changed since"""
+    stat = os.stat(filename)
+    key = os.path.abspath(filename)
+    if key in hashes and hashes[key][:2] == [stat.st_size, stat.st_mtime_ns]:
+        return hashes[key][2]
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    hashes[key] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+    return hashes[key][2]
+
 
+def _load_hashes(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, 'hashes.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_hashes(cache_dir, hashes):
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(os.path.join(cache_dir, 'hashes.json'), 'w') as f:
+            json.dump(hashes, f, indent=1)
+    except OSError:
+        # The cache only saves time, never fail an analysis because of it
+        pass
+
+
+def _save_result(cache_file, duty_cycle):
+    """Write via a temporary file so a half written result is never loaded"""
+    try:
+        temporary = cache_file + '.tmp{}'.format(os.getpid())
+        with open(temporary, 'wb') as f:
+            np.save(f, duty_cycle)
+        os.replace(temporary, cache_file)
+    except OSError:
+        pass
+
+
+def iter_duty_cycles(source, num_frames, audio_rate=48000, n_samples=None, block_frames=1000, track=False):
+    """
+    Decode the audio of source a block at a time and yield the duty cycles of its frames as they are decoded.
+
+    The audio is split into num_frames equal parts like np.array_split would, so each video frame gets its
+    own slice of the soundtrack, but never more than block_frames frames of audio are held in memory and
+    the first duty cycles are available long before the decode of an hour long video finishes.
+
+    source - WAV file, video file (decoded by ffmpeg) or a binary file object streaming raw 16 bit
+             stereo samples, eg the stdout of an ffmpeg process
+    num_frames - number of frames to split the audio into, eg the number of frames in the video
+    audio_rate - samples per second. WAV files say their own rate
+    n_samples - total samples of audio. Read from WAV headers and estimated from the duration ffmpeg reports
+                for videos, but it must be given for a stream
+    block_frames - frames decoded and analysed together
+    track - decode with track_tone_frequency, following the tone from block to block
+
+    yields a float array of duty cycles for each block of frames, in order
+    """
+    audio_rate, blocks = iter_audio(source, audio_rate)
+    if n_samples is None:
+        n_samples = audio_length(source, audio_rate)
+    n, extra = divmod(n_samples, num_frames)
+    index = np.arange(num_frames)
+    starts = index * n + np.minimum(index, extra)
+
+    pending = np.zeros(0)
+    offset = 0
+    first = 0
+    previous = None
+
+    def block_duty_cycles(starts):
+        nonlocal previous
+        batch = sliding_window_view(pending, n)[starts - offset]
+        if track:
+            freqs = track_tone_frequency(batch, audio_rate, previous)
+            previous = freqs[-1]
+        else:
+            freqs = batch_peak_frequency(batch, audio_rate)
+        return convert_audio_frequency_to_duty_cycle(freqs)
+
+    try:
+        for block in blocks:
+            pending = np.concatenate((pending, block))
+            # Frames completely decoded so far
+            last = np.searchsorted(starts + n, offset + len(pending), side='right')
+            while last - first >= block_frames or (last > first and last == num_frames):
+                stop = min(first + block_frames, last)
+                yield block_duty_cycles(starts[first:stop])
+                first = stop
+            if first == num_frames:
+                return
+            pending = pending[starts[first] - offset:]
+            offset = starts[first]
+    finally:
+        # Stops ffmpeg if the caller gives up early
+        blocks.close()
+    if first < num_frames:
+        # The audio ended early, eg n_samples estimated from the duration. Analyse what there is of the last frames
+        pending = np.concatenate((pending, np.zeros(starts[-1] + n - offset - len(pending))))
+        yield block_duty_cycles(starts[first:])
+
+
+def iter_audio(source, audio_rate=48000, block_samples=1 << 18):
+    """
+    Left channel of the audio in source, decoded block_samples at a time.
+
+    source - WAV file, video file or binary file object of raw 16 bit stereo samples, see iter_duty_cycles
+    returns audio_rate, blocks where audio_rate is the rate of the samples, from the header for a WAV
+    file, and blocks is a generator of 1d arrays
+    """
+    if hasattr(source, 'read'):
+        return audio_rate, _iter_raw(source, 2, block_samples)
+    if str(source).lower().endswith('.wav'):
+        with wavefile.open(str(source), 'rb') as f:
+            audio_rate = f.getframerate()
+        return audio_rate, _iter_wav(source, block_samples)
+    return audio_rate, _iter_ffmpeg(source, audio_rate, block_samples)
 
-def frame_frequency(wave, frames, audio_rate):
-    waves = np.array_split(wave, frames)
-    freqs = np.array(
-        [fourier_transform_peak(wav, 1 / audio_rate) for wav in waves])
-    return freqs
+
+def audio_length(source, audio_rate=48000):
+    """Number of audio samples in a WAV file, or for a video estimated from the duration ffmpeg reports"""
+    if str(source).lower().endswith('.wav'):
+        with wavefile.open(str(source), 'rb') as f:
+            return f.getnframes()
+    if hasattr(source, 'read'):
+        raise ValueError('The length of an audio stream is not known, give n_samples')
+    info = subprocess.run([FFMPEG, '-hide_banner', '-i', str(source)], capture_output=True, text=True).stderr
+    match = re.search(r'Duration: (\d+):(\d+):(\d+\.\d+)', info)
+    if match is None:
+        raise ValueError('Could not read the duration of {}'.format(source))
+    hours, minutes, seconds = match.groups()
+    return int(round((int(hours) * 3600 + int(minutes) * 60 + float(seconds)) * audio_rate))
+
+
+def _iter_wav(filename, block_samples):
+    with wavefile.open(str(filename), 'rb') as f:
+        width = f.getsampwidth()
+        if width not in WAV_DTYPES:
+            raise ValueError('{} byte WAV samples are not supported'.format(width))
+        channels = f.getnchannels()
+        while True:
+            data = f.readframes(block_samples)
+            if not data:
+                return
+            yield np.frombuffer(data, dtype=WAV_DTYPES[width])[::channels].astype(np.float64)
+
+
+def _iter_raw(stream, channels, block_samples):
+    frame_bytes = 2 * channels
+    leftover = b''
+    while True:
+        data = stream.read(block_samples * frame_bytes)
+        if not data:
+            return
+        data = leftover + data
+        usable = len(data) - len(data) % frame_bytes
+        leftover = data[usable:]
+        yield np.frombuffer(data[:usable], dtype='<i2')[::channels].astype(np.float64)
+
+
+def _iter_ffmpeg(filename, audio_rate, block_samples):
+    command = [FFMPEG, '-v', 'error', '-i', str(filename), '-vn', '-f', 's16le', '-acodec', 'pcm_s16le',
+               '-ar', str(audio_rate), '-ac', '2', '-']
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    try:
+        yield from _iter_raw(process.stdout, 2, block_samples)
+    finally:
+        process.stdout.close()
+        process.kill()
+        process.wait()
+
+
+def frame_duty_cycles(wave, frames, audio_rate, track=False):
+    """Duty cycle encoded in the tone of each of frames equal parts of wave, all frames at once"""
+    return convert_audio_frequency_to_duty_cycle(frame_frequency(wave, frames, audio_rate, track))
+
+
+def frame_frequency(wave, frames, audio_rate, track=False):
+    """
+    Frequency of the tone in each of frames equal parts of wave.
+
+    The frames start where np.array_split would start them but all have the length of the shortest
+    so they stack into one 2d array and are transformed together by batch_peak_frequency,
+    or by track_tone_frequency when track is True.
+    """
+    batch = split_frames(wave, frames)
+    if track:
+        return track_tone_frequency(batch, audio_rate)
+    return batch_peak_frequency(batch, audio_rate)
+
+
+def split_frames(wave, frames):
+    """(frames, n) array of the frames np.array_split(wave, frames) would give, each cut to the shortest length n"""
+    n, extra = divmod(len(wave), frames)
+    index = np.arange(frames)
+    starts = index * n + np.minimum(index, extra)
+    return sliding_window_view(wave, n)[starts]
+
+
+def batch_peak_frequency(batch, audio_rate, band=None):
+    """
+    Frequency of the largest peak in the spectrum of each row of batch.
+
+    One rfft over the whole batch. Each row is hann windowed and the peak is located between
+    bins by fitting a parabola through the log magnitude of the peak bin and its neighbours,
+    which is accurate to a few % of a bin for a steady tone without any zero padding.
+
+    band - (low, high) Hz to only look for the peak between, None for the whole spectrum
+    """
+    frequency, _ = _spectrum_peak(np.atleast_2d(batch), audio_rate, band)
+    return frequency
+
+
+def track_tone_frequency(batch, audio_rate, previous=None, min_fraction=0.1):
+    """
+    Frequency of the duty cycle tone in each row of batch, following it from frame to frame.
+
+    Only the band duty cycle tones occupy (TONE_BAND) is searched, so hum or shaker noise below
+    1 kHz can't be mistaken for the tone, and the interpolated peak is snapped to the nearest
+    tone a duty cycle can make. A frame where the tone does not stand out, with less than min_fraction
+    of the power in the band at the peak (about 1 for a clean tone, a few % for noise), is a dropout
+    and keeps the tone of the frame before, starting from previous.
+
+    previous - tone (Hz) of the frame before the batch, eg the last of the previous block
+    returns frequencies in Hz on the grid TONE_BAND[0] + TONE_STEP * duty
+    """
+    batch = np.atleast_2d(batch)
+    margin = TONE_STEP / 2
+    frequency, fraction = _spectrum_peak(batch, audio_rate, (TONE_BAND[0] - margin, TONE_BAND[1] + margin))
+    steps = np.clip(np.round((frequency - TONE_BAND[0]) / TONE_STEP), 0, (TONE_BAND[1] - TONE_BAND[0]) // TONE_STEP)
+    tone = TONE_BAND[0] + TONE_STEP * steps
+
+    # Carry the last clear tone forward over dropouts
+    clear = fraction >= min_fraction
+    last_clear = np.maximum.accumulate(np.where(clear, np.arange(len(tone)), -1))
+    held = tone[np.maximum(last_clear, 0)]
+    if previous is not None:
+        held = np.where(last_clear < 0, previous, held)
+    else:
+        held = np.where(last_clear < 0, tone, held)
+    return np.where(clear, tone, held)
+
+
+def _spectrum_peak(batch, audio_rate, band=None):
+    """
+    Interpolated peak frequency of each row of batch and the fraction of the power in band that is in
+    the peak bin, normalised so a steady tone gives about 1
+    """
+    n = batch.shape[-1]
+    windowed = batch * _hann(n)
+    spectrum = np.abs(np.fft.rfft(windowed, axis=-1))
+    if band is not None:
+        freqs = _rfft_freqs(n, audio_rate)
+        spectrum[:, (freqs < band[0]) | (freqs > band[1])] = 0
+    peak = np.argmax(spectrum, axis=-1)
+
+    rows = np.arange(len(batch))
+    inner = (peak > 0) & (peak < spectrum.shape[-1] - 1)
+    with np.errstate(divide='ignore'):
+        log_before = np.log(spectrum[rows, np.where(inner, peak - 1, peak)])
+        log_peak = np.log(spectrum[rows, peak])
+        log_after = np.log(spectrum[rows, np.where(inner, peak + 1, peak)])
+    curvature = log_before - 2 * log_peak + log_after
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offset = np.where(inner & np.isfinite(curvature) & (curvature < 0), 0.5 * (log_before - log_after) / curvature, 0)
+        # With a hann window the peak bin holds a third of the power of a tone
+        fraction = 3 * spectrum[rows, peak] ** 2 / np.sum(spectrum ** 2, axis=-1)
+    return np.interp(peak + offset, np.arange(spectrum.shape[-1]), _rfft_freqs(n, audio_rate)), fraction
 
 
 def fourier_transform_peak(sig, time_step):
-    ft = np.abs(np.fft.fft(sig, 48000))
-    freq = np.fft.fftfreq(48000, time_step)
-    peak = np.argmax(ft)
-    return abs(freq[peak])
\ No newline at end of file
+    """Frequency of the largest peak in the spectrum of one frame, see batch_peak_frequency"""
+    return batch_peak_frequency(sig, 1 / time_step)[0]
+
+
+@lru_cache(maxsize=16)
+def _rfft_freqs(n, audio_rate):
+    return np.fft.rfftfreq(n, 1 / audio_rate)
+
+
+@lru_cache(maxsize=16)
+def _hann(n):
+    return np.hanning(n)
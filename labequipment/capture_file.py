@@ -0,0 +1,147 @@
+"""On-disk capture format for recordings too long to hold in memory.
+
+A capture file is a fixed size JSON header followed by the raw samples,
+interleaved channel by channel (row i holds sample i of every channel).
+Chunks are appended as they arrive so a recording can run for days, and
+the reader maps the file with np.memmap so any slice is read straight from
+disk without loading the rest.
+
+Example:
+
+    with CaptureWriter('run1.cap', ['A', 'B'], 1e-5, scale=[6.1e-5, 6.1e-5]) as writer:
+        for t0, chunk in pico.iter_stream(collect_time=3600):
+            writer.write(chunk)
+
+    capture = CaptureFile('run1.cap')
+    a = capture.volts('A', 0, 100000)
+"""
+import json
+import os
+import time
+
+import numpy as np
+
+from ._picoscope_common import TimeAxis
+
+
+MAGIC = b'LABCAP1\n'
+HEADER_SIZE = 4096
+
+
+class CaptureWriter:
+    """
+    Append samples to a capture file.
+
+    filename - file to create, overwritten if it exists
+    channels - list of channel names eg ['A', 'B']
+    sample_interval - time between samples in s
+    scale - multiplier turning stored values into volts, one per channel or a single value for all
+    dtype - dtype the samples are stored as. int16 for raw ADC counts, float64 for data already in volts
+    metadata - dict of anything else worth keeping with the data eg voltage range, device, notes
+    """
+
+    def __init__(self, filename, channels, sample_interval, scale=1.0, dtype=np.int16, metadata=None):
+        if np.isscalar(scale):
+            scale = [scale] * len(channels)
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self.n_samples = 0
+        self.header = {
+            'channels': list(channels),
+            'dtype': self.dtype.str,
+            'scale': [float(s) for s in scale],
+            'sample_interval': float(sample_interval),
+            'start_time': time.time(),
+            'n_samples': 0,
+            'metadata': metadata if metadata is not None else {},
+        }
+        self._file = open(filename, 'wb')
+        self._write_header()
+
+    def write(self, chunk):
+        """Append a chunk: a 1d array for a single channel or (n_channels, n) with rows in channel order"""
+        chunk = np.asarray(chunk, dtype=self.dtype)
+        if chunk.ndim == 1:
+            chunk = chunk[np.newaxis]
+        if len(chunk) != len(self.header['channels']):
+            raise ValueError('Chunk has {} channels, file has {}'.format(len(chunk), len(self.header['channels'])))
+        self._file.write(np.ascontiguousarray(chunk.T).tobytes())
+        self.n_samples += chunk.shape[1]
+
+    def flush(self):
+        """Push buffered samples to disk so a CaptureFile opened now sees them"""
+        self._file.flush()
+
+    def close(self):
+        """Record the final sample count in the header and close the file"""
+        if self._file.closed:
+            return
+        self.header['n_samples'] = self.n_samples
+        self._file.seek(0)
+        self._write_header()
+        self._file.close()
+
+    def _write_header(self):
+        text = json.dumps(self.header).encode()
+        if len(MAGIC) + len(text) + 1 > HEADER_SIZE:
+            raise ValueError('Capture file header is limited to {} bytes, reduce the metadata'.format(HEADER_SIZE))
+        self._file.write(MAGIC + text.ljust(HEADER_SIZE - len(MAGIC) - 1) + b'\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class CaptureFile:
+    """
+    Read a capture file through np.memmap.
+
+    The sample count comes from the file size rather than the header so a file whose
+    recording was cut short, or is still being written, opens with everything on disk.
+
+    filename - capture file written by CaptureWriter
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            block = f.read(HEADER_SIZE)
+        if not block.startswith(MAGIC):
+            raise ValueError('{} is not a capture file'.format(filename))
+        self.header = json.loads(block[len(MAGIC):])
+        self.channels = self.header['channels']
+        self.dtype = np.dtype(self.header['dtype'])
+        row_bytes = self.dtype.itemsize * len(self.channels)
+        self.n_samples = (os.path.getsize(filename) - HEADER_SIZE) // row_bytes
+        if self.n_samples:
+            self.raw = np.memmap(filename, dtype=self.dtype, mode='r', offset=HEADER_SIZE,
+                                 shape=(self.n_samples, len(self.channels)))
+        else:
+            self.raw = np.zeros((0, len(self.channels)), dtype=self.dtype)
+
+    @property
+    def sample_interval(self):
+        return self.header['sample_interval']
+
+    @property
+    def metadata(self):
+        return self.header['metadata']
+
+    @property
+    def time(self):
+        """TimeAxis in s from the first sample"""
+        return TimeAxis(0, self.sample_interval, self.n_samples)
+
+    def __len__(self):
+        return self.n_samples
+
+    def channel(self, name):
+        """Stored values of one channel as a view onto the file, nothing is read until it is used"""
+        return self.raw[:, self.channels.index(name)]
+
+    def volts(self, name, start=0, stop=None, dtype=np.float64):
+        """Read samples start:stop of one channel and convert them to volts"""
+        index = self.channels.index(name)
+        return np.multiply(self.raw[start:stop, index], self.header['scale'][index], dtype=dtype)
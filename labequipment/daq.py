@@ -4,6 +4,8 @@ from PyDAQmx import *
 from ctypes import *
 import time as t
 
+from .capture_file import CaptureFile, CaptureWriter
+
 '''Data acquisition classes for year 2 lab, School of Physics and Astronomy, University of Nottingham
 for National Instruments DAQ PCI6221.
 This makes use of the PyDAQmx package to interface to the NIDAQmx ANSI C driver.
@@ -193,6 +195,26 @@ class analog:
                 data=data.reshape(self.__Nch,self.Nscans)        
             return data,timestamps
     
+    def record(self,filename,Nreads=1,metadata=None):
+    #repeat read() Nreads times appending each block of Nscans points to a capture file
+    #(see capture_file.py) so the recording does not have to fit in memory. Blocks are
+    #separate finite acquisitions so there is a short gap between them.
+    #returns a CaptureFile for the recording
+        if self.__Nch == 0:
+            print('no analog input channels configured')
+            return
+        channels = ['ai' + str(i) for i, used in enumerate(self.__chans) if used]
+        header = {'device': 'Dev1', 'Nscans': int(self.Nscans)}
+        header.update(metadata or {})
+        data,timestamps = self.read()
+        #read() may lower Rate so the file is only created once the first block is in
+        with CaptureWriter(filename, channels, 1/self.Rate, dtype=np.float64, metadata=header) as writer:
+            writer.write(data)
+            for _ in range(Nreads-1):
+                data,timestamps = self.read()
+                writer.write(data)
+        return CaptureFile(filename)
+
     def run(self,outdata):
     #run simultaneous analog input and output
     #input channel uses the output sample clock and must be started first
@@ -0,0 +1,345 @@
+"""Share serial instruments between processes.
+
+A serial port can only be opened by one process, and reopening it resets an Arduino and
+loses whatever the device had buffered. The instrument server is a small local process that
+opens each port the first time a client asks for it, keeps it open, and carries out requests
+from any number of clients over a Unix socket. Requests for one port are queued and run one at
+a time, each one whole, so clients never see each other's replies. Different ports are served
+at the same time.
+
+Start it once, it then runs in the background until shutdown_server() is called:
+
+    python -m labequipment.instrument_server [socket_path]
+
+RemoteSerial starts it for you if it is not running. Then in any number of scripts:
+
+    from labequipment.lauda import RemoteLauda
+    lauda = RemoteLauda('/dev/ttyUSB0')
+    print(lauda.read_current_temp())
+
+or with arduino.Arduino(settings, server=instrument_server.SOCKET).
+
+The protocol is one JSON object per line each way. A request names the port and an op
+(open, write, read, readline, read_all, reset_input_buffer, in_waiting, query, lock, unlock,
+shutdown), bytes are sent as latin-1 strings. Needs Unix sockets, so Linux or macOS.
+"""
+import asyncio
+from contextlib import contextmanager
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import serial
+
+from labequipment.async_serial import AsyncSerial
+
+SOCKET = os.path.join(os.path.expanduser('~'), '.labequipment', 'instruments.sock')
+# Longest a read waits for data, a read holds its port so one waiting forever would block every client
+MAX_TIMEOUT = 60
+
+
+class InstrumentServer:
+    """
+    Owns the serial ports and serves requests for them from clients connected to socket_path.
+
+    Run it with serve() in an event loop, or start() to run it on a background thread.
+    Reads wait at most max_timeout seconds, also those asking to wait forever.
+    """
+
+    def __init__(self, socket_path=SOCKET, max_timeout=MAX_TIMEOUT):
+        self.socket_path = socket_path
+        self.max_timeout = max_timeout
+        self._ports = {}
+        self._thread = None
+        self._task = None
+
+    async def serve(self):
+        """Serve until cancelled or a client sends shutdown"""
+        os.makedirs(os.path.dirname(self.socket_path) or '.', exist_ok=True)
+        if os.path.exists(self.socket_path):
+            # Left behind by a server that did not exit cleanly
+            os.unlink(self.socket_path)
+        self._stopping = asyncio.Event()
+        server = await asyncio.start_unix_server(self._client, path=self.socket_path)
+        try:
+            async with server:
+                await self._stopping.wait()
+        finally:
+            for port in self._ports.values():
+                await port.com.close()
+            self._ports.clear()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    def start(self):
+        """Serve from a background thread of this process, returns once clients can connect"""
+        listening = threading.Event()
+
+        def run():
+            loop = asyncio.new_event_loop()
+            self._loop = loop
+            self._task = loop.create_task(self.serve())
+            loop.call_soon(listening.set)
+            try:
+                loop.run_until_complete(self._task)
+            except asyncio.CancelledError:
+                pass
+            finally:
+                loop.close()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        listening.wait()
+        _wait_for_socket(self.socket_path, 5)
+        return self
+
+    def stop(self):
+        """Stop a server started with start() and close its ports"""
+        self._loop.call_soon_threadsafe(self._stopping.set)
+        self._thread.join()
+
+    async def _client(self, reader, writer):
+        """Serve the requests of one client connection in the order they arrive"""
+        held = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = None
+                try:
+                    request = json.loads(line)
+                    reply = await self._handle(request, held)
+                    reply['ok'] = True
+                except Exception as error:
+                    # Including a line that is not JSON, the client gets the error and can carry on
+                    reply = {'ok': False, 'error': '{}: {}'.format(type(error).__name__, error)}
+                reply['id'] = request.get('id') if isinstance(request, dict) else None
+                writer.write(json.dumps(reply).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            # A client that goes away holding a lock must not block everyone else
+            for port in held:
+                port.lock.release()
+            writer.close()
+
+    async def _handle(self, request, held):
+        op = request['op']
+        if op == 'shutdown':
+            self._stopping.set()
+            return {}
+        name = request['port']
+        if op == 'open':
+            opened = name not in self._ports
+            if opened:
+                # Reads always say how long to wait, the port's timeout is for those that ask to wait forever
+                kwargs = dict(request.get('serial', {}), timeout=self.max_timeout)
+                self._ports[name] = _SharedPort(AsyncSerial(name, **kwargs))
+            port = self._ports[name]
+            try:
+                await port.opening
+            except Exception:
+                self._ports.pop(name, None)
+                raise
+            return {'opened': opened}
+
+        port = self._ports.get(name)
+        if port is None:
+            raise serial.SerialException('{} has not been opened'.format(name))
+        await port.opening
+        if op == 'lock':
+            if port not in held:
+                await port.lock.acquire()
+                held.add(port)
+            return {}
+        if op == 'unlock':
+            if port in held:
+                held.remove(port)
+                port.lock.release()
+            return {}
+        if port in held:
+            return await self._do(port.com, request)
+        async with port.lock:
+            return await self._do(port.com, request)
+
+    async def _do(self, com, request):
+        op = request['op']
+        timeout = request.get('timeout')
+        if timeout is not None:
+            timeout = min(timeout, self.max_timeout)
+        if request.get('flush'):
+            await com.reset_input_buffer()
+        if op == 'write':
+            return {'size': await com.write(_encode(request['data']))}
+        if op == 'query':
+            return {'data': _decode(await com.query(_encode(request['data']), timeout))}
+        if op == 'read':
+            return {'data': _decode(await com.read(request.get('size', 1), timeout))}
+        if op == 'readline':
+            return {'data': _decode(await com.readline(timeout))}
+        if op == 'read_all':
+            return {'data': _decode(await com.read_all())}
+        if op == 'in_waiting':
+            return {'size': await com.in_waiting()}
+        if op == 'reset_input_buffer':
+            await com.reset_input_buffer()
+            return {}
+        raise ValueError('Unknown op {}'.format(op))
+
+
+class _SharedPort:
+    """A port the server has open, the lock queues the clients' requests"""
+
+    def __init__(self, com):
+        self.com = com
+        self.lock = asyncio.Lock()
+        self.opening = asyncio.ensure_future(com.open())
+
+
+class RemoteSerial:
+    """
+    A serial port owned by the instrument server, with the methods of serial.Serial the instruments use.
+
+    Every call is one request, queued behind other clients' requests for the same port. query() writes
+    and reads the reply in one request so nothing can come in between. For longer exchanges hold the port
+    with lock().
+
+    inputs -
+    port - name of the port eg '/dev/ttyACM0'
+    socket_path - socket of the instrument server
+    timeout - seconds reads wait for data, None waits as long as the server allows (its max_timeout)
+    autostart - start the server in a new process if it is not running
+    serial_kwargs - passed to serial.Serial by the server when it opens the port, eg baudrate=115200.
+                    Ignored if the port is already open.
+
+    opened is True if this client caused the server to open the port, eg so an Arduino only waits for its reset then.
+    """
+
+    def __init__(self, port, socket_path=SOCKET, timeout=None, autostart=True, **serial_kwargs):
+        self.port = port
+        self.socket_path = socket_path
+        self.timeout = timeout
+        if autostart and not _server_running(socket_path):
+            spawn_server(socket_path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(socket_path)
+        self._file = self._socket.makefile('rwb')
+        self._ids = itertools.count()
+        self.opened = self._request('open', serial=serial_kwargs)['opened']
+
+    @property
+    def is_open(self):
+        return self._file is not None
+
+    @property
+    def in_waiting(self):
+        return self._request('in_waiting')['size']
+
+    def inWaiting(self):
+        return self.in_waiting
+
+    def write(self, data, flush=False):
+        """Write bytes, flush clears the input buffer first"""
+        return self._request('write', data=_decode(data), flush=flush)['size']
+
+    def read(self, size=1):
+        return _encode(self._request('read', size=size, timeout=self.timeout)['data'])
+
+    def readline(self):
+        return _encode(self._request('readline', timeout=self.timeout)['data'])
+
+    def read_all(self):
+        return _encode(self._request('read_all')['data'])
+
+    def reset_input_buffer(self):
+        self._request('reset_input_buffer')
+
+    def query(self, data, flush=False):
+        """Write data and return the line sent back, with no other client's request in between"""
+        return _encode(self._request('query', data=_decode(data), timeout=self.timeout, flush=flush)['data'])
+
+    @contextmanager
+    def lock(self):
+        """Keep the port to ourselves for the requests inside the with block"""
+        self._request('lock')
+        try:
+            yield self
+        finally:
+            self._request('unlock')
+
+    def close(self):
+        """Disconnect, the server keeps the port open for the next client"""
+        if self._file is not None:
+            self._file.close()
+            self._socket.close()
+            self._file = None
+
+    def _request(self, op, **fields):
+        fields.update(op=op, port=self.port, id=next(self._ids))
+        self._file.write(json.dumps(fields).encode() + b'\n')
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise serial.SerialException('The instrument server closed the connection')
+        reply = json.loads(line)
+        if not reply['ok']:
+            raise serial.SerialException(reply['error'])
+        return reply
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def spawn_server(socket_path=SOCKET, timeout=10):
+    """Start the instrument server in a process of its own that outlives this one"""
+    subprocess.Popen([sys.executable, '-m', 'labequipment.instrument_server', socket_path],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                     start_new_session=True)
+    _wait_for_socket(socket_path, timeout)
+
+
+def shutdown_server(socket_path=SOCKET):
+    """Stop the instrument server, closing its ports"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(json.dumps({'op': 'shutdown'}).encode() + b'\n')
+        client.recv(1024)
+
+
+def _server_running(socket_path):
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(socket_path)
+        return True
+    except OSError:
+        return False
+
+
+def _wait_for_socket(socket_path, timeout):
+    deadline = time.monotonic() + timeout
+    while not _server_running(socket_path):
+        if time.monotonic() > deadline:
+            raise TimeoutError('Instrument server did not start on {}'.format(socket_path))
+        time.sleep(0.01)
+
+
+def _encode(text):
+    return text.encode('latin-1')
+
+
+def _decode(data):
+    return bytes(data).decode('latin-1')
+
+
+if __name__ == '__main__':
+    asyncio.run(InstrumentServer(*sys.argv[1:]).serve())
@@ -1,6 +1,8 @@
 import serial
 import time
 
+from labequipment.async_serial import AsyncInstrument
+
 ventus_commands = {
     'control_mode':b'CONTROL=POWER\r',
     'write':'WRITE',
@@ -78,6 +80,35 @@ class Laser:
         return status
 
 
+class AsyncLaser(AsyncInstrument):
+    """Laser for asyncio, eg status = await laser.get_status(). See async_serial.py"""
+
+    def __init__(self, laser=None):
+        self.laser = laser
+        serial_settings = laser['serial_settings']
+        super().__init__(serial_settings['port'],
+                         baudrate=serial_settings['baudrate'],
+                         parity=serial_settings['parity'],
+                         stopbits=serial_settings['stopbits'],
+                         timeout=5)
+
+    async def _setup(self):
+        await self.set_default_power()
+
+    async def set_default_power(self):
+        await self.com.write(self.laser['default_power'])
+
+    async def set_power(self, power):
+        msg = self.laser['set_power'] + str(power) + '\r\n'
+        await self.com.write(msg.encode('utf-8'))
+
+    async def get_status(self):
+        status = {}
+        for key, command in (('status', 'status'), ('T_psu', 'psu_temp'), ('T_laser', 'laser_temp'), ('power_mw', 'get_power')):
+            status[key] = (await self.com.query(self.laser[command])).decode('utf-8').strip('\r\n')
+        return status
+
+
 if __name__ == '__main__':
     laser = Laser(laser=ventus_commands)
     #laser.set_power(60)
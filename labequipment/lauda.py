@@ -3,6 +3,9 @@ import time
 import numpy as np
 import serial
 
+from labequipment.async_serial import AsyncInstrument
+from labequipment.instrument_server import SOCKET, RemoteSerial
+
 
 class Lauda(serial.Serial):
 
@@ -37,4 +40,83 @@ class Lauda(serial.Serial):
     def set_pumping_speed(self, val):
         self.read_all()
         self.write(bytes('OUT_SP_01_{:03d}\r\n'.format(val),
-                         encoding='utf-8', errors='strict'))
\ No newline at end of file
+                         encoding='utf-8', errors='strict'))
+
+
+class AsyncLauda(AsyncInstrument):
+    """
+    Lauda for asyncio, eg temp = await lauda.read_current_temp(). See async_serial.py
+
+    Rather than waiting a fixed 0.3 s for the temperature, the reply is read as soon as
+    it arrives, giving up after reply_timeout seconds.
+    """
+
+    def __init__(self, port, reply_timeout=1):
+        super().__init__(port)
+        self.reply_timeout = reply_timeout
+
+    async def _setup(self):
+        await self.com.read_all()
+
+    async def read_current_temp(self):
+        try:
+            await self.com.read_all()
+            txt = await self.com.query(b'IN_PV_01\r\n', timeout=self.reply_timeout)
+            val = float(txt)
+        except (ValueError, serial.SerialException):
+            val = np.nan
+        return val
+
+    async def start(self):
+        await self._send(b'START\r\n')
+
+    async def stop(self):
+        await self._send(b'STOP\r\n')
+
+    async def set_temp(self, new_temp):
+        await self._send(bytes('OUT_SP_00_{:06.2f}\r\n'.format(new_temp),
+                               encoding='utf-8', errors='strict'))
+
+    async def set_pumping_speed(self, val):
+        await self._send(bytes('OUT_SP_01_{:03d}\r\n'.format(val),
+                               encoding='utf-8', errors='strict'))
+
+    async def _send(self, command):
+        await self.com.read_all()
+        await self.com.write(command)
+
+
+class RemoteLauda:
+    """
+    Lauda shared with other scripts through the instrument server, see instrument_server.py
+
+    The temperature query clears old input and reads the reply in one request, so two
+    scripts polling the same bath never get each other's replies.
+    """
+
+    def __init__(self, port, socket_path=SOCKET, reply_timeout=1):
+        self.com = RemoteSerial(port, socket_path=socket_path, timeout=reply_timeout)
+
+    def read_current_temp(self):
+        try:
+            val = float(self.com.query(b'IN_PV_01\r\n', flush=True))
+        except (ValueError, serial.SerialException):
+            val = np.nan
+        return val
+
+    def start(self):
+        self.com.write(b'START\r\n', flush=True)
+
+    def stop(self):
+        self.com.write(b'STOP\r\n', flush=True)
+
+    def set_temp(self, new_temp):
+        self.com.write(bytes('OUT_SP_00_{:06.2f}\r\n'.format(new_temp),
+                             encoding='utf-8', errors='strict'), flush=True)
+
+    def set_pumping_speed(self, val):
+        self.com.write(bytes('OUT_SP_01_{:03d}\r\n'.format(val),
+                             encoding='utf-8', errors='strict'), flush=True)
+
+    def close(self):
+        self.com.close()
@@ -1,10 +1,15 @@
 import serial
 
+from labequipment.async_serial import AsyncInstrument
+from labequipment.instrument_server import SOCKET, RemoteSerial
+
+PORT = "/dev/serial/by-id/usb-Omega_Engineering_RH-USB_N13012205-if00-port0"
+
 
 class Probe(serial.Serial):
 
     def __init__(self,
-                 port="/dev/serial/by-id/usb-Omega_Engineering_RH-USB_N13012205-if00-port0"):
+                 port=PORT):
         super().__init__(port)
         self.write(b'C\r')
         self.readline()
@@ -18,3 +23,39 @@ class Probe(serial.Serial):
         self.write(b'H\r')
         txt = self.readline()
         return float(txt.decode().split(' ')[0][1:])
+
+
+class AsyncProbe(AsyncInstrument):
+    """Probe for asyncio, eg temp = await probe.get_temp_C(). See async_serial.py"""
+
+    def __init__(self, port=PORT, timeout=1):
+        super().__init__(port, timeout=timeout)
+
+    async def _setup(self):
+        await self.com.query(b'C\r')
+
+    async def get_temp_C(self):
+        txt = await self.com.query(b'C\r')
+        return float(txt.decode().split(' ')[0][1:])
+
+    async def get_relative_humidity(self):
+        txt = await self.com.query(b'H\r')
+        return float(txt.decode().split(' ')[0][1:])
+
+
+class RemoteProbe:
+    """Probe shared with other scripts through the instrument server, see instrument_server.py"""
+
+    def __init__(self, port=PORT, socket_path=SOCKET, timeout=1):
+        self.com = RemoteSerial(port, socket_path=socket_path, timeout=timeout)
+
+    def get_temp_C(self):
+        txt = self.com.query(b'C\r', flush=True)
+        return float(txt.decode().split(' ')[0][1:])
+
+    def get_relative_humidity(self):
+        txt = self.com.query(b'H\r', flush=True)
+        return float(txt.decode().split(' ')[0][1:])
+
+    def close(self):
+        self.com.close()
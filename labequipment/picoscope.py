@@ -1,16 +1,153 @@
+import ctypes
+import json
+import os
+
 from ._picoscope_2000a import PicoScopeDAQ as PicoScopeDAQ2000a
 from ._picoscope_2000 import PicoScopeDAQ as PicoScopeDAQ2000
+from ._picoscope_2000a import ps as _ps2000a
+from ._picoscope_2000 import ps2000 as _ps2000
+from ._picoscope_common import Capture, serial_text, TimeAxis
 
-def PicoScopeDAQ():
-    """This function is pretending to be a class! It will return the correct class for the picoscope connected. The drivers for 2204A and 2208B are different and so is the sdk. The classes are designed with the same interface so will work the same irrespective of which unit you are using. See comments at top of _picoscope_2000.py if you are working with the 2204A and _picoscope_2000a.py if working with the 2208B."""
 
-    try:
-        pico = PicoScopeDAQ2000a()
-    except:
-        print("No 2000a found, trying 2000")
+# Remembers which backend each scope needs so the next script opens it directly
+CACHE_FILE = os.path.join(os.path.expanduser('~'), '.labequipment', 'picoscopes.json')
+
+BACKENDS = {'2000a': PicoScopeDAQ2000a, '2000': PicoScopeDAQ2000}
+
+
+def PicoScopeDAQ(serial=None, simulate=None, drivers=None, cache_file=CACHE_FILE):
+    """This function is pretending to be a class! It will return the correct class for the picoscope connected. The drivers for 2204A and 2208B are different and so is the sdk. The classes are designed with the same interface so will work the same irrespective of which unit you are using. See comments at top of _picoscope_2000.py if you are working with the 2204A and _picoscope_2000a.py if working with the 2208B.
+
+    The backend each scope needed is remembered in cache_file so next time the right one is opened straight away
+    rather than after a failed attempt with the other driver.
+
+    serial - open the scope with this batch and serial number when several are connected, see list_scopes()
+    simulate - '2000' or '2000a' to get that class running on a simulated scope instead (see _picoscope_sim.py). No hardware or PicoSDK needed.
+    drivers - dict of driver objects to use in place of picosdk's, eg {'2000a': SimulatedPs2000a(units=2)}
+    cache_file - where to remember scopes, None to not use a cache
+    """
+    if simulate is not None:
+        from ._picoscope_sim import SimulatedPs2000, SimulatedPs2000a
+        if simulate == '2000':
+            return PicoScopeDAQ2000(driver=SimulatedPs2000())
+        return PicoScopeDAQ2000a(driver=SimulatedPs2000a())
+
+    drivers = _drivers(drivers)
+    cache = _load_cache(cache_file)
+
+    # Scopes seen before, most recently used first
+    remembered = [(s, backend) for s, backend in reversed(list(cache.items())) if serial in (None, s)]
+    for known_serial, backend in remembered:
+        if backend in drivers:
+            try:
+                return _open(backend, known_serial, drivers, cache, cache_file)
+            except Exception:
+                pass
+
+    for scope in list_scopes(drivers=drivers):
+        if serial in (None, scope['serial']):
+            try:
+                return _open(scope['backend'], scope['serial'], drivers, cache, cache_file)
+            except Exception:
+                pass
+
+    print("No picoscope found" if serial is None else "No picoscope {} found".format(serial))
+    return None
+
+
+def open_scopes(serials=None, drivers=None, cache_file=CACHE_FILE):
+    """
+    Open several picoscopes at once, eg to record more than two channels.
+
+    serials - list of batch and serial numbers to open, None opens every scope connected
+    returns a list of PicoScopeDAQ objects in the order of serials
+    """
+    drivers = _drivers(drivers)
+    cache = _load_cache(cache_file)
+    scopes = list_scopes(drivers=drivers)
+    if serials is None:
+        serials = [scope['serial'] for scope in scopes]
+    backends = {scope['serial']: scope['backend'] for scope in scopes}
+    missing = [s for s in serials if s not in backends]
+    if missing:
+        raise ValueError('Picoscopes {} not found, connected: {}'.format(missing, list(backends)))
+    return [_open(backends[s], s, drivers, cache, cache_file) for s in serials]
+
+
+def list_scopes(drivers=None):
+    """
+    Find the picoscopes connected without opening them where the driver allows it.
+
+    2000a units are enumerated by the driver in one call. The 2000 driver can only discover units by
+    opening them so it is only asked when no 2000a units are found.
+
+    returns a list of dicts with keys 'serial' and 'backend' ('2000a' or '2000')
+    """
+    drivers = _drivers(drivers)
+    scopes = []
+    if '2000a' in drivers:
+        scopes += [{'serial': serial, 'backend': '2000a'} for serial in _enumerate_2000a(drivers['2000a'])]
+    if not scopes and '2000' in drivers:
         try:
-            pico = PicoScopeDAQ2000()
-        except:
-            print("No 2000 found either")
-            pico = None
-    return pico
\ No newline at end of file
+            units = drivers['2000'].list_units()
+        except Exception:
+            units = []
+        scopes += [{'serial': serial_text(unit.serial), 'backend': '2000'} for unit in units]
+    return scopes
+
+
+def _drivers(drivers):
+    """Driver objects keyed by backend, leaving out any whose PicoSDK library is not installed"""
+    if drivers is None:
+        drivers = {'2000a': _ps2000a, '2000': _ps2000}
+    return {backend: driver for backend, driver in drivers.items() if driver is not None}
+
+
+def _enumerate_2000a(driver):
+    """Serial numbers of the unopened 2000a units"""
+    count = ctypes.c_int16()
+    serials = ctypes.create_string_buffer(1024)
+    length = ctypes.c_int16(len(serials))
+    status = driver.ps2000aEnumerateUnits(ctypes.byref(count), serials, ctypes.byref(length))
+    if status != 0 or count.value == 0:
+        return []
+    return serials.value.decode().split(',')
+
+
+def _open(backend, serial, drivers, cache, cache_file):
+    """Open one scope and move it to the end of the cache as the most recently used"""
+    pico = BACKENDS[backend](driver=drivers[backend], serial=serial)
+    if cache_file is not None:
+        try:
+            cache.pop(pico.serial, None)
+            cache[pico.serial] = backend
+            _save_cache(cache_file, cache)
+        except Exception:
+            # Don't leave the scope open where nobody can close it
+            pico.close_scope()
+            raise
+    return pico
+
+
+def _load_cache(cache_file):
+    if cache_file is None or not os.path.exists(cache_file):
+        return {}
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_cache(cache_file, cache):
+    # Written to a temporary file first so a failure never leaves a half written cache behind
+    temporary = cache_file + '.tmp'
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(temporary, 'w') as f:
+            json.dump(cache, f, indent=1)
+        os.replace(temporary, cache_file)
+    except (OSError, TypeError, ValueError):
+        # The cache only saves time, never fail to open a scope because of it
+        if os.path.exists(temporary):
+            os.remove(temporary)
@@ -0,0 +1,111 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .picoscope import open_scopes
+from ._picoscope_common import TimeAxis
+
+
+class MultiScopeDAQ:
+    """
+    Several picoscopes acquiring together, for more than the two channels one scope has.
+
+    Every scope is set up the same way and armed at the same moment from a thread pool so
+    the captures overlap in time and the whole acquisition takes as long as one capture
+    rather than one per scope. The captures are then aligned and stacked into one array
+    with a row per channel.
+
+    Alignment is either on a shared trigger, wire the same trigger signal into every scope
+    and call setup_trigger, or without a trigger on the time each scope was armed, which
+    lines the captures up to within the scopes' start up jitter (typically < 1 ms).
+
+    Example:
+
+        with MultiScopeDAQ() as daq:
+            daq.setup_channel(channel='Both', sample_rate=100000, voltage_range=2)
+            daq.setup_trigger(channel='A', threshold=0.5)
+            time_s, data = daq.start(samples=2000)
+            print(daq.channel_names)    # one name per row of data eg 'AB123/0001:A'
+
+    inputs -
+    scopes - list of PicoScopeDAQ objects to use, by default every scope connected is opened
+    serials - open only the scopes with these serial numbers, in this order
+    drivers - dict of driver objects passed on to picoscope.open_scopes, eg for simulated scopes
+    """
+
+    def __init__(self, scopes=None, serials=None, drivers=None):
+        self.scopes = scopes if scopes is not None else open_scopes(serials, drivers=drivers)
+        if not self.scopes:
+            raise ValueError('No picoscopes found')
+        self._pool = ThreadPoolExecutor(max_workers=len(self.scopes))
+        self._triggered = False
+
+    @property
+    def channel_names(self):
+        """Name of each row of the data returned by start, 'serial:channel'"""
+        return ['{}:{}'.format(scope.serial, channel) for scope in self.scopes for channel in self._channels(scope)]
+
+    def setup_channel(self, **kwargs):
+        """Set up the channels of every scope, takes the same arguments as PicoScopeDAQ.setup_channel"""
+        self._on_every_scope(lambda scope: scope.setup_channel(**kwargs))
+
+    def setup_trigger(self, enable=True, **kwargs):
+        """
+        Set up the same trigger on every scope, takes the same arguments as PicoScopeDAQ.setup_trigger.
+        Captures are then aligned on the trigger point.
+        """
+        self._on_every_scope(lambda scope: scope.setup_trigger(enable=enable, **kwargs))
+        self._triggered = enable
+
+    def start(self, samples=2000, dtype=np.float64):
+        """
+        Arm every scope at once and collect a block from each.
+
+        samples - samples per channel from each scope
+        dtype - np.float64 or np.float32 for the volts
+
+        returns time_s, data where time_s is a TimeAxis and data is a (n_channels, n_samples) array
+        of volts with rows in the order of channel_names. With a trigger each capture starts at
+        the trigger. Without one they are trimmed to the period all the scopes were recording.
+        """
+        captures = self._on_every_scope(lambda scope: scope.start(samples, dtype=dtype))
+        # When each scope's driver was told to start, after any setup of buffers and channels
+        armed = np.array([scope.run_started for scope in self.scopes])
+
+        dt = captures[0].time.dt
+        if not np.allclose([capture.time.dt for capture in captures], dt, rtol=1e-6):
+            raise ValueError('Scopes are sampling at different intervals {}, choose a sample rate they can all do'.format(
+                [capture.time.dt for capture in captures]))
+
+        if self._triggered:
+            skip = np.zeros(len(captures), dtype=int)
+        else:
+            # Drop the samples each scope took before the last one was armed
+            skip = np.round((armed.max() - armed) / dt).astype(int)
+        n = min(len(capture.time) - s for capture, s in zip(captures, skip))
+
+        rows = []
+        for scope, capture, s in zip(self.scopes, captures, skip):
+            for channel in self._channels(scope):
+                rows.append(capture.a[s:s + n] if channel == 'A' else capture.b[s:s + n])
+        return TimeAxis(0, dt, n), np.stack(rows)
+
+    def close(self):
+        """Close every scope"""
+        self._pool.shutdown()
+        for scope in self.scopes:
+            scope.close_scope()
+
+    def _on_every_scope(self, function):
+        """Call function(scope) for every scope in parallel and return the results in scope order"""
+        return list(self._pool.map(function, self.scopes))
+
+    @staticmethod
+    def _channels(scope):
+        return [name for name, enabled in (('A', scope.channel_a), ('B', scope.channel_b)) if enabled]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
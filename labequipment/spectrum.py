@@ -0,0 +1,176 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+class StreamingSpectrum:
+    """
+    Welch power spectral density, RMS and peak frequency of a signal that arrives in chunks.
+
+    Feed it each chunk of a stream as it arrives with update(). Chunks are cut into overlapping
+    segments which are windowed, Fourier transformed and averaged into the PSD. Only the part
+    of a segment that spills over into the next chunk is kept between updates so memory
+    stays the size of a chunk however long the stream runs. With the default mean
+    averaging the result after the last chunk matches scipy.signal.welch on the whole record.
+
+    Example:
+
+        spectrum = StreamingSpectrum(pico.stream_interval, nperseg=8192)
+        for t0, chunk in pico.iter_stream(chunk_samples=50000, collect_time=60):
+            spectrum.update(pico.counts_to_volts(chunk))
+            print(t0, spectrum.peak_frequency, spectrum.rms)
+        plt.semilogy(spectrum.freqs, spectrum.psd)
+
+    See also live_spectrum() which does the above for you.
+
+    inputs -
+    sample_interval - time in s between samples
+    nperseg - samples in each FFT segment, the frequency resolution is 1/(nperseg*sample_interval)
+    overlap - fraction of a segment shared with the next one, 0.5 for the usual Welch estimate
+    window - name of a numpy window function ('hanning', 'hamming', 'blackman', 'bartlett') or an array of nperseg weights
+    decay - None averages every segment equally. A value between 0 and 1 is the weight given to each
+            new segment (exponential averaging) so a live spectrum follows a changing signal
+    detrend - subtract the mean of each segment before transforming it
+    """
+
+    def __init__(self, sample_interval, nperseg=4096, overlap=0.5, window='hanning', decay=None, detrend=True):
+        self.sample_interval = sample_interval
+        self.nperseg = int(nperseg)
+        self.step = self.nperseg - int(round(overlap * self.nperseg))
+        if not 0 < self.step <= self.nperseg:
+            raise ValueError('overlap must be at least 0 and less than 1')
+        if decay is not None and not 0 < decay <= 1:
+            raise ValueError('decay must be between 0 and 1')
+        self.window = getattr(np, window)(self.nperseg) if isinstance(window, str) else np.asarray(window, dtype=np.float64)
+        if len(self.window) != self.nperseg:
+            raise ValueError('window must have nperseg values')
+        self.decay = decay
+        self.detrend = detrend
+        self.freqs = np.fft.rfftfreq(self.nperseg, sample_interval)
+        # One sided power spectral density in V**2/Hz, doubling the bins that also stand for negative frequencies
+        self._scale = np.full(len(self.freqs), 2 * sample_interval / np.sum(self.window ** 2))
+        self._scale[0] /= 2
+        if self.nperseg % 2 == 0:
+            self._scale[-1] /= 2
+        self.reset()
+
+    def reset(self):
+        """Forget everything seen so far"""
+        self._shape = None
+        self._tail = None
+        self._power = 0
+        self._weight = 0
+        self._sum_sq = 0
+        self.n_samples = 0
+        self.n_segments = 0
+        self.chunk_rms = None
+
+    def update(self, chunk):
+        """
+        Add the next chunk of samples.
+
+        chunk - array of samples, 1d for one channel or with the samples along the last axis for several
+                (eg rows A, B from iter_stream). Every chunk of a stream must have the same channels.
+        returns self so calls can be chained, eg spectrum.update(chunk).peak_frequency
+        """
+        chunk = np.asarray(chunk, dtype=np.float64)
+        if self._shape is None:
+            self._shape = chunk.shape[:-1]
+            self._tail = np.empty((int(np.prod(self._shape)), 0))
+        elif chunk.shape[:-1] != self._shape:
+            raise ValueError('Chunk has shape {} but the stream started with {} channels'.format(chunk.shape, self._shape))
+        samples = chunk.reshape(-1, chunk.shape[-1])
+        if not samples.shape[-1]:
+            return self
+
+        sum_sq = np.sum(samples ** 2, axis=-1)
+        self._sum_sq = self._sum_sq + sum_sq
+        self.n_samples += samples.shape[-1]
+        self.chunk_rms = np.sqrt(sum_sq / samples.shape[-1]).reshape(self._shape)
+
+        data = np.concatenate((self._tail, samples), axis=-1)
+        n_segments = (data.shape[-1] - self.nperseg) // self.step + 1 if data.shape[-1] >= self.nperseg else 0
+        if n_segments:
+            segments = sliding_window_view(data, self.nperseg, axis=-1)[:, :n_segments * self.step:self.step]
+            if self.detrend:
+                segments = segments - segments.mean(axis=-1, keepdims=True)
+            power = np.abs(np.fft.rfft(segments * self.window, axis=-1)) ** 2
+            # Weight the segments in the order they arrived, the newest last
+            if self.decay is None:
+                weights = np.ones(n_segments)
+                forget = 1
+            else:
+                weights = self.decay * (1 - self.decay) ** np.arange(n_segments - 1, -1, -1)
+                forget = (1 - self.decay) ** n_segments
+            self._power = self._power * forget + np.einsum('s,csf->cf', weights, power)
+            self._weight = self._weight * forget + weights.sum()
+            self.n_segments += n_segments
+        # Keep the samples the next segment starts with
+        self._tail = data[:, n_segments * self.step:].copy()
+        return self
+
+    @property
+    def psd(self):
+        """Power spectral density in units**2/Hz at freqs, one row per channel. None before the first full segment"""
+        if not self.n_segments:
+            return None
+        return (self._power / self._weight * self._scale).reshape(self._shape + (len(self.freqs),))
+
+    @property
+    def rms(self):
+        """Root mean square of every sample seen so far for each channel"""
+        if not self.n_samples:
+            return None
+        return np.sqrt(self._sum_sq / self.n_samples).reshape(self._shape)
+
+    @property
+    def peak_frequency(self):
+        """
+        Frequency in Hz of the largest peak in the PSD of each channel, ignoring DC.
+        Refined between bins by fitting a parabola through the peak and its neighbours.
+        """
+        psd = self.psd
+        if psd is None:
+            return None
+        psd = psd.reshape(-1, len(self.freqs))
+        rows = np.arange(len(psd))
+        index = np.argmax(psd[:, 1:], axis=-1) + 1
+        inner = (index > 0) & (index < len(self.freqs) - 1)
+        before = psd[rows, np.where(inner, index - 1, index)]
+        peak = psd[rows, index]
+        after = psd[rows, np.where(inner, index + 1, index)]
+        curvature = before - 2 * peak + after
+        with np.errstate(divide='ignore', invalid='ignore'):
+            offset = np.where(inner & (curvature != 0), 0.5 * (before - after) / curvature, 0)
+        return ((index + offset) * (self.freqs[1] - self.freqs[0])).reshape(self._shape)
+
+
+def live_spectrum(pico, collect_time=None, chunk_samples=None, nperseg=4096, overlap=0.5, window='hanning',
+                  decay=None, **stream_kwargs):
+    """
+    Stream from a picoscope and keep a StreamingSpectrum of the channels up to date as each chunk arrives.
+
+    pico - PicoScopeDAQ with its channels set up
+    collect_time - time in seconds to stream for, None streams until you stop iterating
+    chunk_samples - samples per chunk, defaults to 4 segments
+    nperseg, overlap, window, decay - see StreamingSpectrum
+    stream_kwargs - passed on to pico.iter_stream, eg aggregate
+
+    yields (t0, spectrum) after each chunk, where t0 is the time in s of the start of the chunk. spectrum is the same
+    StreamingSpectrum every time, updated with the volts of the new chunk. Its rows follow the chunks of iter_stream.
+
+    Example:
+
+        for t0, spectrum in live_spectrum(pico, collect_time=30, nperseg=8192):
+            print(t0, spectrum.peak_frequency, spectrum.rms)
+    """
+    if chunk_samples is None:
+        chunk_samples = 4 * nperseg
+    channels = [name for name, enabled in (('A', pico.channel_a), ('B', pico.channel_b)) if enabled]
+    spectrum = None
+    for t0, chunk in pico.iter_stream(chunk_samples, collect_time, **stream_kwargs):
+        if spectrum is None:
+            # The sample interval is only known once streaming has started
+            spectrum = StreamingSpectrum(pico.stream_interval, nperseg, overlap, window, decay)
+            scale = np.array([pico.scale_factor(name) for name in channels])
+            scale = scale[0] if len(channels) == 1 else scale.reshape((-1,) + (1,) * (chunk.ndim - 1))
+        yield t0, spectrum.update(chunk * scale)
@@ -1,3 +1,7 @@
+import collections
+import concurrent.futures
+import struct
+import threading
 import time
 
 class Stepper():
@@ -21,7 +25,6 @@ class Stepper():
         self.motor_timeout = 10 + (1/steps_per_sec) * abs(steps)
         message = 'M' + str(motor_no) + direction + str(steps) + '\n'
         self.ard.send_serial_line(message)
-        time.sleep(0.1)
         success = self.get_motor_confirmation()
         return success
 
@@ -33,21 +36,394 @@ class Stepper():
 
         After the motor has moved it then sends a confirmation it is finished:
 
-        M1 moved\n    
-        
-        This function will return success=True if it received confirmation that the motor has moved.        
+        M1 moved\n
+
+        This function will return success=True if it received confirmation that the motor has moved.
         """
-         
-        # Wait for bytes in the serial buffer until the timeout
-        tic = time.time()
+
+        # Wait for replies until the timeout, each read returns as soon as a line arrives
+        deadline = time.monotonic() + self.motor_timeout
         while True:
-            toc = time.time()
-            if self.ard.port.inWaiting() > 0:
-                reply = self.ard.read_serial_line()  # Read the bytes
-                if 'moved' in reply:
-                    return True
-            if toc - tic > self.motor_timeout:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
                 return False
-            time.sleep(0.1)
-        
+            reply = self.ard.read_serial_line(timeout=remaining)
+            if 'moved' in reply:
+                return True
+
+
+# Framed binary protocol, spoken by ArduinoSketches/Shaker_Motor_v3.
+#
+# Every frame is
+#
+#     SYNC  LEN  SEQ  CMD  PAYLOAD (LEN bytes)  CRC (2 bytes, big endian)
+#
+# with the CRC-16/CCITT of LEN to the end of PAYLOAD. A frame that fails its CRC is dropped
+# and the receiver looks for the next SYNC. Moves carry sequence numbers and are queued in
+# order, each motor has its own queue and both motors move at the same time. The board ACKs each
+# move as soon as it is queued, confirming every earlier move too, and sends DONE when it has
+# finished, confirming every earlier move of that motor. A lost or corrupted move is noticed by
+# the board from the gap in sequence numbers (NAK_SEQUENCE, the host resends from there) or by the
+# host when no ACK comes, and a lost reply by the host asking again (PING). HELLO and PING are not
+# sequenced.
+SYNC = 0x7E
+MAX_STEPS = 100000
+QUEUE_SIZE = 8
+MAX_PAYLOAD = 8
+MOTORS = (1, 2)
+
+# Host to board
+MOVE = 0x01     # payload motor (uint8), steps (int32 little endian, negative for '-')
+PING = 0x02     # answered by PONG
+HELLO = 0x03    # the board expects the next move to have this frame's SEQ, answered by PONG
+
+# Board to host
+ACK = 0x81      # move SEQ and every move before it are queued, payload free places in the motor's queue
+DONE = 0x82     # move SEQ and every earlier move of the same motor have finished
+NAK = 0x83      # payload error code below
+PONG = 0x84     # payload for each motor the SEQ of its last finished move and 1, or 0 0 if it has
+                # finished none since it was last given a move
+
+NAK_SEQUENCE = 1    # move out of order, SEQ is the one the board expects next
+NAK_QUEUE_FULL = 2  # move SEQ was not queued, send again once a move finishes
+NAK_INVALID = 3     # move SEQ was not a valid move and has been discarded
+
+
+def crc16(data, crc=0xFFFF):
+    """CRC-16/CCITT-FALSE, the same as crc16 in the sketch"""
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else crc << 1
+        crc &= 0xFFFF
+    return crc
+
+
+def encode_frame(seq, cmd, payload=b''):
+    body = bytes((len(payload), seq & 0xFF, cmd)) + payload
+    return bytes((SYNC,)) + body + struct.pack('>H', crc16(body))
+
+
+class FrameParser:
+    """Collects frames from bytes as they arrive, discarding anything that isn't a valid frame"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Add received bytes, returns a list of the (seq, cmd, payload) completed by them"""
+        self.buffer += data
+        frames = []
+        while True:
+            start = self.buffer.find(SYNC)
+            if start < 0:
+                self.buffer.clear()
+                return frames
+            del self.buffer[:start]
+            if len(self.buffer) < 2:
+                return frames
+            if self.buffer[1] > MAX_PAYLOAD:
+                # Can't be a frame, as in the sketch
+                del self.buffer[:1]
+                continue
+            if len(self.buffer) < 6:
+                return frames
+            end = 6 + self.buffer[1]
+            if len(self.buffer) < end:
+                return frames
+            body = bytes(self.buffer[1:end - 2])
+            if crc16(body) == struct.unpack('>H', self.buffer[end - 2:end])[0]:
+                frames.append((body[1], body[2], body[3:]))
+                del self.buffer[:end]
+            else:
+                # Not a frame after all, look for the next SYNC
+                del self.buffer[:1]
+
+
+
+class FramedStepper(Stepper):
+    """
+    Stepper for boards running Shaker_Motor_v3, which speak the framed binary protocol above.
+
+    Moves are sent without waiting for the ones before to finish. The board carries out each
+    motor's moves in order and moves both motors at the same time. A background thread reads the
+    board's replies and completes the concurrent.futures.Future returned for each move, whose
+    result is True once the move has finished and False if the board rejected it:
+
+        stepper = FramedStepper(ard)
+        stepper.move_many([(1, 2000, '+'), (2, 1500, '-')])     # Level both axes together
+        stepper.wait_all()
+
+        done = stepper.queue_move(1, 500, '+')
+        ...                                                     # Carry on meanwhile
+        done.result()
+
+    move_motor blocks as Stepper.move_motor. Frames corrupted or lost on the way are sent again,
+    if the board stops answering the pending futures raise TimeoutError and later moves wait until
+    it answers again.
+
+    inputs -
+    ard - arduino.Arduino with the board, eg opened with ready='ready'. The stepper's thread reads from it.
+    window - most moves queued on the board at once, at most its QUEUE_SIZE
+    ack_timeout - seconds to wait for a move to be acknowledged before sending it again
+    retries - times a move is sent again before giving up
+    """
+
+    def __init__(self, ard, window=QUEUE_SIZE, ack_timeout=0.05, retries=10):
+        super().__init__(ard)
+        self.window = min(window, QUEUE_SIZE)
+        self.ack_timeout = ack_timeout
+        self.retries = retries
+        self.parser = FrameParser()
+        # Moves are numbered from 0 without limit, only the low byte is sent as SEQ. At most window of
+        # them are on the board at once so _wire can tell which one a reply is about.
+        self._next = 0
+        self._backlog = collections.deque()         # (move, frame) not yet sent
+        self._sent = collections.OrderedDict()      # move -> frame, sent and waiting for ACK
+        self._moving = {motor: collections.deque() for motor in MOTORS}     # moves queued on the board
+        self._wire = {}                             # SEQ -> move, of the moves sent and not finished
+        self._futures = {}                          # move -> Future of every unfinished move
+        self._motors = {}                           # move -> motor
+        self._error = None
+        self._resync = None                         # SEQ of the HELLO sent after giving up, until it is answered
+        self._resend_at = None
+        self._stalled = False
+        self._attempts = 0
+        self._lock = threading.RLock()     # Futures complete holding it, their callbacks may queue moves
+        self._pong = threading.Condition(self._lock)
+        self._pong_seq = None
+        self._closing = threading.Event()
+        self._reader = threading.Thread(target=self._read_replies, daemon=True, name='stepper replies')
+        self._reader.start()
+        try:
+            self.hello()
+        except TimeoutError:
+            # No board, stop reading from the caller's Arduino
+            self.close()
+            raise
+
+    def hello(self, timeout=1):
+        """Start the board's sequence numbers from ours, eg after reconnecting to a board that was not reset"""
+        self._exchange(HELLO, self._next & 0xFF, timeout)
+
+    def ping(self, timeout=1):
+        """Round trip time to the board in seconds"""
+        begin = time.perf_counter()
+        self._exchange(PING, 0, timeout)
+        return time.perf_counter() - begin
+
+    def queue_move(self, motor_no, steps, direction):
+        """Send a move without waiting for it, returns a Future of whether it finished, with the move's seq"""
+        if direction not in '+-' or len(direction) != 1:
+            raise ValueError("direction should be '+' or '-'")
+        steps = int(steps) if direction == '+' else -int(steps)
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._error is not None:
+                raise self._error
+            move = self._next
+            self._next += 1
+            future.seq = move & 0xFF
+            self._futures[move] = future
+            self._motors[move] = motor_no
+            self._backlog.append((move, encode_frame(future.seq, MOVE, struct.pack('<Bi', motor_no, steps))))
+            self._send_backlog()
+        return future
+
+    def move_many(self, moves):
+        """Send several moves, eg one per motor, a list of (motor_no, steps, direction). Returns their Futures"""
+        return [self.queue_move(*move) for move in moves]
+
+    def move_motor(self, motor_no, steps, direction, steps_per_sec=2000/128):
+        self.motor_timeout = 10 + (1/steps_per_sec) * abs(steps)
+        try:
+            return self.queue_move(motor_no, steps, direction).result(self.motor_timeout)
+        except (concurrent.futures.TimeoutError, TimeoutError):
+            return False
+
+    def wait_all(self, timeout=None):
+        """Wait for every move sent so far, True if they all finished. timeout defaults to motor_timeout"""
+        timeout = getattr(self, 'motor_timeout', 10) if timeout is None else timeout
+        with self._lock:
+            pending = list(self._futures.values())
+        done, not_done = concurrent.futures.wait(pending, timeout)
+        return not not_done and all(future.exception() is None and future.result() for future in done)
+
+    @property
+    def busy(self):
+        return bool(self._futures)
+
+    def close(self):
+        """Stop reading replies, the Arduino is left open"""
+        self._closing.set()
+        self._reader.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _read_replies(self):
+        """Runs on the reader thread: handles replies as they arrive and sends moves again when needed"""
+        try:
+            while not self._closing.is_set():
+                with self._lock:
+                    timeout = self._check_resend()
+                data = self.ard.read_serial_bytes(1, timeout=timeout)
+                with self._lock:
+                    if not data:
+                        if any(self._moving.values()) and not self._sent:
+                            # Ask now and then in case a DONE was lost
+                            self.ard.port.write(encode_frame(0, PING))
+                        continue
+                    data += self.ard.port.read(self.ard.port.in_waiting)
+                    for seq, cmd, payload in self.parser.feed(data):
+                        self._handle(seq, cmd, payload)
+                    self._send_backlog()
+        except Exception as error:
+            # Nothing would complete the pending moves now, let them and any later ones raise the error
+            with self._lock:
+                self._error = error
+                self._fail(error)
+
+    def _check_resend(self):
+        """Send unacknowledged moves again if it is time, returns how long to wait for replies"""
+        timeout = 0.5 if any(self._moving.values()) else 0.1
+        if self._resync is not None:
+            now = time.monotonic()
+            if now >= self._resend_at:
+                self._send_hello()
+            timeout = min(timeout, self._resend_at - now)
+        elif self._sent and not self._stalled:
+            now = time.monotonic()
+            if now >= self._resend_at:
+                self._resend()
+            timeout = min(timeout, self._resend_at - now)
+        return max(timeout, 0.001)
+
+    def _send_backlog(self):
+        if self._resync is not None:
+            # Moves wait until the board has taken our sequence numbers again
+            return
+        moving = sum(len(seqs) for seqs in self._moving.values())
+        while self._backlog and not self._stalled and len(self._sent) + moving < self.window:
+            move, frame = self._backlog.popleft()
+            self._sent[move] = frame
+            self._wire[move & 0xFF] = move
+            self.ard.port.write(frame)
+            self._resend_at = time.monotonic() + self.ack_timeout
+
+    def _resend(self):
+        self._attempts += 1
+        if self._attempts > self.retries:
+            self._give_up()
+            return
+        for frame in self._sent.values():
+            self.ard.port.write(frame)
+        self._resend_at = time.monotonic() + self.ack_timeout
+
+    def _give_up(self):
+        self._fail(TimeoutError('Stepper board stopped acknowledging moves'))
+        # The board still expects the first move it missed, start it from the next move instead
+        self._resync = self._next & 0xFF
+        self._send_hello()
+
+    def _send_hello(self):
+        self.ard.port.write(encode_frame(self._resync, HELLO))
+        self._resend_at = time.monotonic() + self.ack_timeout
+
+    def _fail(self, error):
+        """Forget every unfinished move, their futures raise error"""
+        for future in self._futures.values():
+            future.set_exception(error)
+        self._futures.clear()
+        self._motors.clear()
+        self._backlog.clear()
+        self._sent.clear()
+        self._wire.clear()
+        for moves in self._moving.values():
+            moves.clear()
+        self._attempts = 0
+        self._stalled = False
+
+    def _handle(self, seq, cmd, payload):
+        move = self._wire.get(seq)
+        if cmd == ACK:
+            self._acknowledge(move, inclusive=True)
+        elif cmd == DONE:
+            self._finished(move)
+        elif cmd == PONG:
+            self._pong_seq = seq
+            self._pong.notify_all()
+            if seq == self._resync:
+                self._resync = None
+            for motor, last_done, any_done in zip(MOTORS, payload[::2], payload[1::2]):
+                # SEQs repeat, an idle motor's last move can have the SEQ of one the other motor is making
+                move = self._wire.get(last_done)
+                if any_done and self._motors.get(move) == motor:
+                    self._finished(move)
+        elif cmd == NAK:
+            code = payload[0]
+            self._acknowledge(move, inclusive=False)
+            if code == NAK_SEQUENCE:
+                # Every move after a lost one is NAKed, resend once per ack_timeout
+                if self._sent and not self._stalled and time.monotonic() >= self._resend_at - self.ack_timeout / 2:
+                    self._resend()
+            elif code == NAK_QUEUE_FULL:
+                self._stalled = True
+            elif code == NAK_INVALID and move in self._sent:
+                del self._sent[move]
+                self._complete(move, False)
+
+    def _acknowledge(self, move, inclusive):
+        """Move the sent moves before move (and move itself if inclusive) to their motor's queue"""
+        if move not in self._sent:
+            return
+        while self._sent:
+            first = next(iter(self._sent))
+            if first == move and not inclusive:
+                break
+            del self._sent[first]
+            self._moving[self._motors[first]].append(first)
+            self._attempts = 0
+            if first == move:
+                break
+        self._resend_at = time.monotonic() + self.ack_timeout
+
+    def _finished(self, move):
+        self._acknowledge(move, inclusive=True)
+        motor = self._motors.get(move)
+        if motor is None or move not in self._moving[motor]:
+            return
+        moving = self._moving[motor]
+        while moving:
+            first = moving.popleft()
+            self._complete(first, True)
+            if first == move:
+                break
+        if self._stalled:
+            # There is room on the board again
+            self._stalled = False
+            if self._sent:
+                self._resend()
+
+    def _complete(self, move, result):
+        self._motors.pop(move, None)
+        if self._wire.get(move & 0xFF) == move:
+            del self._wire[move & 0xFF]
+        future = self._futures.pop(move, None)
+        if future is not None:
+            future.set_result(result)
 
+    def _exchange(self, cmd, seq, timeout):
+        """Send an unsequenced frame and wait for the reader thread to see its reply"""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            self._pong_seq = None
+            while self._pong_seq != seq:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError('No reply from the stepper board')
+                self.ard.port.write(encode_frame(seq, cmd))
+                self._pong.wait(min(remaining, self.ack_timeout))
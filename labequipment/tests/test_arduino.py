@@ -0,0 +1,125 @@
+import os
+import pty
+import select
+import threading
+import time
+
+import pytest
+
+from labequipment import arduino
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'openpty'), reason='needs a pseudo terminal for the fake device')
+
+
+@pytest.fixture
+def terminal():
+    """Pseudo terminal, the Arduino opens the peripheral end and the fake device uses the controller"""
+    controller, peripheral = pty.openpty()
+    yield controller, os.ttyname(peripheral)
+    arduino.close_all()
+    os.close(controller)
+    os.close(peripheral)
+
+
+@pytest.fixture
+def device(terminal):
+    """An Arduino that is already running on one end of a pseudo terminal and the fake device's end"""
+    controller, port = terminal
+    ard = arduino.Arduino({'PORT': port, 'BAUDRATE': 115200}, reset=False)
+    yield ard, controller
+    ard.quit_serial()
+
+
+def reply_later(fd, data, delay):
+    threading.Timer(delay, os.write, (fd, data)).start()
+
+
+def test_read_serial_line_returns_when_the_line_arrives(device):
+    ard, fake = device
+    reply_later(fake, b'M1 moved\n', 0.05)
+
+    begin = time.perf_counter()
+    cpu = time.process_time()
+    assert ard.read_serial_line(timeout=2) == 'M1 moved\n'
+    assert time.perf_counter() - begin < 0.09
+    assert time.process_time() - cpu < 0.02
+
+
+def test_read_serial_bytes_returns_its_data(device):
+    ard, fake = device
+    reply_later(fake, b'\x01\x02\x03\x04', 0.02)
+    assert ard.read_serial_bytes(4, timeout=2) == b'\x01\x02\x03\x04'
+
+
+def test_reads_give_up_at_the_deadline(device):
+    ard, fake = device
+    os.write(fake, b'partial')
+
+    begin = time.perf_counter()
+    assert ard.read_serial_line(timeout=0.1) == 'partial'
+    assert 0.09 < time.perf_counter() - begin < 0.5
+    assert ard.read_serial_bytes(3, timeout=0.05) == b''
+    # The port is left non-blocking for everything else
+    assert ard.port.timeout == 0
+
+
+def test_open_waits_for_the_ready_banner_not_a_fixed_delay(terminal):
+    controller, port = terminal
+    reply_later(controller, b'booting\nSystem ready.\n', 0.1)
+
+    begin = time.perf_counter()
+    ard = arduino.Arduino({'PORT': port, 'BAUDRATE': 115200}, ready='ready')
+    assert ard.ready
+    assert time.perf_counter() - begin < 1
+    ard.quit_serial()
+
+    ard = arduino.Arduino({'PORT': port, 'BAUDRATE': 115200}, ready='ready', ready_timeout=0.1)
+    assert not ard.ready
+    ard.quit_serial()
+
+
+def test_reset_noise_does_not_stop_the_wait_for_ready(terminal):
+    controller, port = terminal
+    # Garbage at the wrong baud rate while the board resets, then the banner
+    reply_later(controller, b'\xf0\x9f\xff\x00\xc3\n\xfeSystem ready.\n', 0.1)
+
+    ard = arduino.Arduino({'PORT': port, 'BAUDRATE': 115200}, ready='ready', ready_timeout=1)
+    assert ard.ready
+    ard.quit_serial()
+
+
+def test_handshake_is_sent_as_a_line(terminal):
+    controller, port = terminal
+    stop = threading.Event()
+
+    def sketch():
+        # Only answers a whole line, like a sketch reading commands with readStringUntil('\n')
+        received = b''
+        while not stop.is_set():
+            if select.select([controller], [], [], 0.01)[0]:
+                received += os.read(controller, 1024)
+                while b'\n' in received:
+                    line, received = received.split(b'\n', 1)
+                    if line == b'ping':
+                        os.write(controller, b'pong\n')
+
+    thread = threading.Thread(target=sketch)
+    thread.start()
+    ard = arduino.Arduino({'PORT': port, 'BAUDRATE': 115200}, ready='pong', ready_timeout=1, handshake='ping')
+    stop.set()
+    thread.join()
+    assert ard.ready
+    ard.quit_serial()
+
+
+def test_connect_reuses_an_open_arduino(terminal):
+    _, port = terminal
+    settings = {'PORT': port, 'BAUDRATE': 115200}
+    with arduino.connect(settings, reset=False) as ard:
+        pass
+    assert ard.port.is_open
+    assert arduino.connect(settings) is ard
+
+    arduino.close_all()
+    assert not ard.port.is_open
+    assert arduino.connect(settings, reset=False) is not ard
@@ -0,0 +1,94 @@
+import asyncio
+import os
+import pty
+import select
+import threading
+import time
+
+import pytest
+
+from labequipment.arduino import AsyncArduino
+from labequipment.lauda import AsyncLauda
+from labequipment.omega_temperature_probe import AsyncProbe
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'openpty'), reason='needs a pseudo terminal for the fake device')
+
+
+class FakeDevice:
+    """Answers each command written to a pseudo terminal after delay seconds"""
+
+    def __init__(self, replies, delay, terminator=b'\r'):
+        self.replies = replies
+        self.terminator = terminator
+        self.delay = delay
+        self.controller, self.peripheral = pty.openpty()
+        self.port = os.ttyname(self.peripheral)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        received = b''
+        while not self._stop.is_set():
+            if not select.select([self.controller], [], [], 0.01)[0]:
+                continue
+            received += os.read(self.controller, 1024)
+            while self.terminator in received:
+                command, received = received.split(self.terminator, 1)
+                reply = self.replies.get(command)
+                if reply is not None:
+                    time.sleep(self.delay)
+                    os.write(self.controller, reply)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        os.close(self.controller)
+        os.close(self.peripheral)
+
+
+@pytest.fixture
+def fake_devices():
+    devices = []
+
+    def make(replies, delay, terminator=b'\r'):
+        devices.append(FakeDevice(replies, delay, terminator))
+        return devices[-1]
+
+    yield make
+    for device in devices:
+        device.close()
+
+
+def test_instruments_are_polled_concurrently(fake_devices):
+    delay = 0.1
+    probes = [AsyncProbe(fake_devices({b'C': b'>21.50 C\r\n'}, delay).port) for _ in range(4)]
+    lauda = AsyncLauda(fake_devices({b'IN_PV_01': b'19.95\r\n'}, delay).port)
+
+    async def poll():
+        for instrument in probes + [lauda]:
+            await instrument.open()
+        begin = time.perf_counter()
+        readings = await asyncio.gather(lauda.read_current_temp(), *(probe.get_temp_C() for probe in probes))
+        elapsed = time.perf_counter() - begin
+        for instrument in probes + [lauda]:
+            await instrument.close()
+        return readings, elapsed
+
+    readings, elapsed = asyncio.run(poll())
+    assert readings == [19.95, 21.5, 21.5, 21.5, 21.5]
+    # The slowest device's latency, not the sum of all five
+    assert elapsed < 2.5 * delay
+
+
+def test_async_arduino_reads_with_timeout(fake_devices):
+    device = fake_devices({b'M1+3000': b'M1 moved\n'}, 0.05, terminator=b'\n')
+
+    async def move():
+        async with AsyncArduino({'PORT': device.port, 'BAUDRATE': 115200}, ready_timeout=0.05) as ard:
+            await ard.send_serial_line('M1+3000')
+            reply = await ard.read_serial_line(timeout=2)
+            nothing = await ard.read_serial_line(timeout=0.05)
+            return reply, nothing
+
+    assert asyncio.run(move()) == ('M1 moved\n', '')
@@ -0,0 +1,96 @@
+import io
+import wave
+
+import numpy as np
+
+from labequipment import audio_duty
+
+
+def tones(duty_cycles, audio_rate=48000, frame_samples=1600):
+    rng = np.random.default_rng(0)
+    t = np.arange(frame_samples) / audio_rate
+    freqs = np.asarray(duty_cycles) * 15 + 1000
+    return np.concatenate([np.sin(2 * np.pi * f * t + rng.uniform(0, 2 * np.pi)) for f in freqs])
+
+
+def test_frame_duty_cycles_recovers_every_frame():
+    duty_cycles = np.random.default_rng(1).integers(0, 1000, 500)
+    wave = tones(duty_cycles)
+
+    decoded = audio_duty.frame_duty_cycles(wave, len(duty_cycles), 48000)
+
+    np.testing.assert_array_equal(np.uint16(np.round(decoded)), duty_cycles)
+    np.testing.assert_allclose(decoded, duty_cycles, atol=0.1)
+
+
+def test_split_frames_follows_array_split():
+    wave = np.arange(1003)
+    frames = audio_duty.split_frames(wave, 10)
+    starts = [part[0] for part in np.array_split(wave, 10)]
+    assert frames.shape == (10, 100)
+    np.testing.assert_array_equal(frames[:, 0], starts)
+
+
+def write_wav(filename, duty_cycles):
+    samples = np.int16(tones(duty_cycles) * 20000)
+    with wave.open(filename, 'wb') as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(48000)
+        f.writeframes(np.stack((samples, -samples), axis=1).tobytes())
+
+
+def test_duty_streams_a_wav_file(tmp_path):
+    duty_cycles = np.random.default_rng(2).integers(0, 1000, 300)
+    filename = str(tmp_path / 'shaker.wav')
+    write_wav(filename, duty_cycles)
+
+    np.testing.assert_array_equal(audio_duty.duty(filename, len(duty_cycles)), duty_cycles)
+    blocks = list(audio_duty.iter_duty_cycles(filename, len(duty_cycles), block_frames=64))
+    assert [len(block) for block in blocks] == [64, 64, 64, 64, 44]
+
+
+def test_iter_duty_cycles_from_a_pipe():
+    duty_cycles = np.random.default_rng(3).integers(0, 1000, 100)
+    samples = np.int16(tones(duty_cycles) * 20000)
+    stream = io.BytesIO(np.stack((samples, samples), axis=1).astype('<i2').tobytes())
+
+    decoded = np.concatenate(list(audio_duty.iter_duty_cycles(stream, len(duty_cycles), n_samples=len(samples))))
+    np.testing.assert_array_equal(np.round(decoded), duty_cycles)
+
+
+def test_duty_many_caches_results(tmp_path, monkeypatch):
+    rng = np.random.default_rng(4)
+    duty_cycles = [rng.integers(0, 1000, 50) for _ in range(3)]
+    filenames = [str(tmp_path / 'video{}.wav'.format(i)) for i in range(3)]
+    for filename, expected in zip(filenames, duty_cycles):
+        write_wav(filename, expected)
+    cache_dir = str(tmp_path / 'cache')
+
+    results = audio_duty.duty_many(filenames, 50, processes=2, cache_dir=cache_dir)
+    for result, expected in zip(results, duty_cycles):
+        np.testing.assert_array_equal(result, expected)
+
+    def no_decoding(*args):
+        raise AssertionError('decoded audio despite the cache')
+    monkeypatch.setattr(audio_duty, 'duty', no_decoding)
+    cached = audio_duty.duty_many(filenames[::-1], 50, cache_dir=cache_dir)
+    for result, expected in zip(cached, duty_cycles[::-1]):
+        np.testing.assert_array_equal(result, expected)
+
+
+def test_track_ignores_hum_and_holds_through_dropouts():
+    rng = np.random.default_rng(5)
+    duty_cycles = np.clip(500 + np.cumsum(rng.integers(-3, 4, 400)), 0, 1000)
+    frames = audio_duty.split_frames(tones(duty_cycles), len(duty_cycles))
+    # Mains hum louder than the tone and a few frames of silence
+    frames = 0.3 * frames + 1.5 * np.sin(2 * np.pi * 120 * np.arange(frames.shape[-1]) / 48000)
+    frames[200:205] = 0.01 * rng.normal(size=(5, frames.shape[-1]))
+
+    tracked = audio_duty.convert_audio_frequency_to_duty_cycle(audio_duty.track_tone_frequency(frames, 48000))
+
+    clear = np.ones(len(duty_cycles), dtype=bool)
+    clear[200:205] = False
+    np.testing.assert_array_equal(tracked[clear], duty_cycles[clear])
+    np.testing.assert_array_equal(tracked[200:205], duty_cycles[199])
+    assert not np.all(np.round(audio_duty.frame_duty_cycles(frames.ravel(), len(duty_cycles), 48000)) == duty_cycles)
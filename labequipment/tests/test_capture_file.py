@@ -0,0 +1,33 @@
+import numpy as np
+
+from labequipment.capture_file import CaptureFile, CaptureWriter
+
+
+def test_capture_file_round_trip(tmp_path):
+    filename = str(tmp_path / 'run.cap')
+    a = np.arange(0, 3000, dtype=np.int16)
+    b = -a
+    with CaptureWriter(filename, ['A', 'B'], 1e-5, scale=[0.5, 2.0], metadata={'note': 'test'}) as writer:
+        for start in range(0, 3000, 1000):
+            writer.write(np.stack((a[start:start + 1000], b[start:start + 1000])))
+
+    capture = CaptureFile(filename)
+    assert len(capture) == 3000
+    assert capture.header['n_samples'] == 3000
+    assert capture.metadata == {'note': 'test'}
+    assert isinstance(capture.raw, np.memmap)
+    np.testing.assert_array_equal(capture.channel('A'), a)
+    np.testing.assert_array_equal(capture.volts('B', 100, 200), b[100:200] * 2.0)
+    assert capture.time[-1] == 2999 * 1e-5
+
+
+def test_capture_file_readable_while_recording(tmp_path):
+    filename = str(tmp_path / 'run.cap')
+    writer = CaptureWriter(filename, ['ai0'], 1e-3, dtype=np.float64)
+    writer.write(np.linspace(0, 1, 500))
+    writer.flush()
+
+    capture = CaptureFile(filename)
+    assert len(capture) == 500
+    assert capture.volts('ai0')[-1] == 1.0
+    writer.close()
@@ -0,0 +1,131 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from labequipment.arduino import Arduino
+from labequipment.instrument_server import InstrumentServer, RemoteSerial
+from labequipment.lauda import RemoteLauda
+from labequipment.omega_temperature_probe import RemoteProbe
+from labequipment.tests.test_async_serial import fake_devices
+
+pytestmark = pytest.mark.skipif(not (hasattr(os, 'openpty') and hasattr(socket, 'AF_UNIX')),
+                                reason='needs pseudo terminals and Unix sockets')
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = InstrumentServer(str(tmp_path / 'instruments.sock')).start()
+    yield server
+    server.stop()
+
+
+def test_clients_sharing_a_port_get_their_own_replies(server, fake_devices):
+    device = fake_devices({b'C': b'>21.50 C\r\n', b'H': b'>45.00 %\r\n'}, 0.01)
+    results = {'C': [], 'H': []}
+
+    def poll(kind):
+        probe = RemoteProbe(device.port, socket_path=server.socket_path)
+        read = probe.get_temp_C if kind == 'C' else probe.get_relative_humidity
+        for _ in range(10):
+            results[kind].append(read())
+        probe.close()
+
+    threads = [threading.Thread(target=poll, args=(kind,)) for kind in ('C', 'H', 'C', 'H')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {'C': [21.5] * 20, 'H': [45.0] * 20}
+
+
+def test_ports_are_served_in_parallel(server, fake_devices):
+    delay = 0.2
+    laudas = [RemoteLauda(fake_devices({b'IN_PV_01': b'19.95\r\n'}, delay, b'\r\n').port,
+                          socket_path=server.socket_path) for _ in range(3)]
+    readings = []
+    threads = [threading.Thread(target=lambda lauda=lauda: readings.append(lauda.read_current_temp()))
+               for lauda in laudas]
+
+    begin = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert time.perf_counter() - begin < 2 * delay
+    assert readings == [19.95] * 3
+    for lauda in laudas:
+        lauda.close()
+
+
+def test_port_stays_open_and_lock_is_exclusive(server, fake_devices):
+    device = fake_devices({b'C': b'>21.50 C\r\n'}, 0)
+    first = RemoteSerial(device.port, socket_path=server.socket_path, timeout=1)
+    second = RemoteSerial(device.port, socket_path=server.socket_path, timeout=1)
+    assert first.opened and not second.opened
+
+    order = []
+    with first.lock():
+        waiting = threading.Thread(target=lambda: order.append(('second', second.query(b'C\r'))))
+        waiting.start()
+        time.sleep(0.1)
+        order.append(('first', first.query(b'C\r')))
+    waiting.join()
+    assert order == [('first', b'>21.50 C\r\n'), ('second', b'>21.50 C\r\n')]
+
+    first.close()
+    second.close()
+    # A new client, even from another process, finds the port already open
+    script = ('from labequipment.instrument_server import RemoteSerial;'
+              'com = RemoteSerial({!r}, socket_path={!r}, timeout=1, autostart=False);'
+              'print(com.opened, com.query(b"C\\r"))').format(device.port, server.socket_path)
+    output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout
+    assert output.strip() == "False b'>21.50 C\\r\\n'"
+
+
+def test_arduino_through_the_server_discards_unread_output(server, fake_devices):
+    device = fake_devices({b'M1+10': b'M1 moved\n'}, 0, b'\n')
+    # Another script has the port open and the board has printed something nobody read
+    other = RemoteSerial(device.port, socket_path=server.socket_path)
+    os.write(device.controller, b'stale output\n')
+    time.sleep(0.05)
+    assert other.in_waiting == 13
+
+    ard = Arduino({'PORT': device.port, 'BAUDRATE': 115200}, server=server.socket_path, read_timeout=1)
+    assert ard.port.in_waiting == 0
+    assert ard.send_serial_line('M1+10')
+    assert ard.read_serial_line() == 'M1 moved\n'
+    ard.quit_serial()
+    other.close()
+
+
+def test_read_that_would_wait_forever_does_not_block_the_port(tmp_path, fake_devices):
+    server = InstrumentServer(str(tmp_path / 'instruments.sock'), max_timeout=0.2).start()
+    device = fake_devices({b'C': b'>21.50 C\r\n'}, 0)
+    silent = RemoteSerial(device.port, socket_path=server.socket_path)
+    other = RemoteSerial(device.port, socket_path=server.socket_path, timeout=1)
+
+    begin = time.perf_counter()
+    assert silent.readline() == b''
+    assert time.perf_counter() - begin < 1
+    assert other.query(b'C\r') == b'>21.50 C\r\n'
+    silent.close()
+    other.close()
+    server.stop()
+
+
+def test_malformed_request_gets_an_error_reply(server, fake_devices):
+    device = fake_devices({b'C': b'>21.50 C\r\n'}, 0)
+    com = RemoteSerial(device.port, socket_path=server.socket_path, timeout=1)
+    com._file.write(b'not json\n')
+    com._file.flush()
+    reply = json.loads(com._file.readline())
+    assert not reply['ok'] and reply['error'].startswith('JSONDecodeError')
+    # The connection is still served
+    assert com.query(b'C\r') == b'>21.50 C\r\n'
+    com.close()
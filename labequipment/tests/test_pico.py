@@ -1,5 +1,6 @@
 
 import sys
+import time
 sys.path.insert(0, '../labequipment/')
 import labequipment.picoscope as picoscope
 import matplotlib.pyplot as plt
@@ -35,7 +36,29 @@ def test_picoscope_streammode():
     plt.plot(time, dataA)
     plt.show()
 
+def test_picoscope_dual_channel_stream_throughput(sample_rate=100000, collect_time=10):
+    """Benchmark: stream A and B together and report the sustained sample rate.
+    
+    Fails if samples were lost, ie the driver reported an overrun or fewer samples arrived than the scope took in collect_time."""
+    pico = picoscope.PicoScopeDAQ()
+    pico.setup_channel(channel='Both', sample_rate=sample_rate, voltage_range=10)
+
+    n_samples = 0
+    start = time.perf_counter()
+    for t0, chunk in pico.iter_stream(chunk_samples=sample_rate, collect_time=collect_time):
+        assert chunk.shape[0] == 2, 'Expected a row of data for each channel'
+        n_samples += chunk.shape[1]
+    elapsed = time.perf_counter() - start
+    expected = collect_time / pico.stream_interval
+    pico.close_scope()
+
+    print('Sustained {:.0f} samples/s per channel ({:.0f} total) over {:.1f} s. Received {} of {:.0f} samples'.format(
+        n_samples / elapsed, 2 * n_samples / elapsed, elapsed, n_samples, expected))
+    assert pico.stream_driver_overruns == 0, 'The driver reported samples were lost while streaming'
+    assert n_samples >= 0.98 * expected, 'Samples were lost while streaming'
+
 
 if __name__ == '__main__':
     test_picoscope_blockmode()
-    test_picoscope_streammode()
\ No newline at end of file
+    test_picoscope_streammode()
+    test_picoscope_dual_channel_stream_throughput()
\ No newline at end of file
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from labequipment import _picoscope_2000, _picoscope_2000a
+from labequipment._picoscope_sim import SimulatedPs2000, SimulatedPs2000a
+
+
+@pytest.mark.parametrize('mode', ['average', 'decimate', 'minmax'])
+def test_2000a_streams_downsampled_on_device(mode):
+    pico = _picoscope_2000a.PicoScopeDAQ(driver=SimulatedPs2000a())
+    pico.setup_channel(channel='Both', sample_rate=100000, voltage_range=2)
+
+    chunks = list(pico.iter_stream(chunk_samples=1000, collect_time=0.2, aggregate=10, aggregate_mode=mode))
+    pico.close_scope()
+
+    # 0.2 s at 100 kHz reduced by 10
+    assert sum(chunk.shape[-1] for _, chunk in chunks) == 2000
+    assert chunks[1][0] == pytest.approx(1000 * 10 / 100000)
+    if mode == 'minmax':
+        assert chunks[0][1].shape == (2, 2, 1000)
+        assert np.all(chunks[0][1][:, 0] >= chunks[0][1][:, 1])
+    else:
+        assert chunks[0][1].shape == (2, 1000)
+
+
+def test_2000_minmax_and_unsupported_modes():
+    pico = _picoscope_2000.PicoScopeDAQ(driver=SimulatedPs2000())
+    pico.setup_channel(channel='A', sample_rate=100000, voltage_range=2)
+
+    capture = pico.start_streaming(collect_time=0.2, aggregate=10, aggregate_mode='minmax')
+    assert capture.a.shape[0] == 2
+    assert np.all(capture.a[0] >= capture.a[1])
+
+    with pytest.raises(ValueError):
+        pico.start_streaming(collect_time=0.2, aggregate=10, aggregate_mode='average')
+    pico.close_scope()
+
+
+@pytest.mark.parametrize('backend, driver', [(_picoscope_2000, SimulatedPs2000), (_picoscope_2000a, SimulatedPs2000a)])
+def test_disabled_channel_is_shaped_like_the_enabled_one(backend, driver):
+    pico = backend.PicoScopeDAQ(driver=driver())
+    pico.setup_channel(channel='A', sample_rate=100000, voltage_range=2)
+
+    capture = pico.start_streaming(collect_time=0.2, aggregate=10, aggregate_mode='minmax')
+    pico.close_scope()
+
+    assert capture.a.shape[0] == 2
+    assert capture.b.shape == capture.a.shape
+    assert not np.any(capture.b)
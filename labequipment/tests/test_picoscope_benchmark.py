@@ -0,0 +1,114 @@
+"""Hardware free benchmarks of both PicoScope backends running on the simulated drivers.
+
+    pytest labequipment/tests/test_picoscope_benchmark.py --benchmark-json=pico.json
+
+Alongside the timings each benchmark stores the figures that matter for acquisition in
+extra_info: samples/s delivered, latency between the data existing and reaching python,
+and memory allocated per captured sample.
+"""
+import time
+import tracemalloc
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from labequipment import _picoscope_2000, _picoscope_2000a
+from labequipment._picoscope_sim import SimulatedPs2000, SimulatedPs2000a, Waveform
+
+
+BACKENDS = {
+    'ps2000': (_picoscope_2000.PicoScopeDAQ, SimulatedPs2000),
+    'ps2000a': (_picoscope_2000a.PicoScopeDAQ, SimulatedPs2000a),
+}
+
+
+@pytest.fixture(params=sorted(BACKENDS))
+def pico(request):
+    backend, driver = BACKENDS[request.param]
+    pico = backend(driver=driver(waveform=Waveform('sine', frequency=1000, noise=0.01)))
+    yield pico
+    pico.close_scope()
+
+
+def test_block_throughput(benchmark, pico):
+    samples = 2000
+    pico.setup_channel(channel='Both', sample_rate=1000000, voltage_range=2)
+    pico.start(samples)
+
+    capture = benchmark(pico.start, samples)
+
+    assert len(capture.time) == samples
+    benchmark.extra_info['samples_per_s'] = 2 * samples / benchmark.stats.stats.mean
+
+    tracemalloc.start()
+    pico.start(samples)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    benchmark.extra_info['bytes_per_sample'] = peak / (2 * samples)
+    # Two float64 channels of volts are 16 bytes a sample and the time axis is not materialised.
+    # The rest of the allowance covers the simulated driver generating its waveform.
+    assert peak / (2 * samples) < 32
+
+
+def test_block_ready_latency(benchmark, pico):
+    """Time from the capture finishing on the device to start() returning it"""
+    pico.setup_channel(channel='A', sample_rate=100000, voltage_range=2)
+    pico.start(1000)
+    latencies = []
+
+    def capture():
+        begin = time.perf_counter()
+        time_s, _, _ = pico.start(1000)
+        latencies.append(time.perf_counter() - begin - len(time_s) * time_s.dt)
+
+    benchmark.pedantic(capture, rounds=20, iterations=1)
+
+    benchmark.extra_info['median_latency_s'] = float(np.median(latencies))
+    assert np.median(latencies) < 0.02
+
+
+def test_streaming_throughput(benchmark, pico):
+    sample_rate = 200000
+    collect_time = 0.5
+    pico.setup_channel(channel='Both', sample_rate=sample_rate, voltage_range=2)
+    chunk_samples = 10000
+    received = []
+    starts = []
+
+    def stream():
+        n = 0
+        for t0, chunk in pico.iter_stream(chunk_samples=chunk_samples, collect_time=collect_time):
+            starts.append(t0)
+            n += chunk.shape[-1]
+        received.append(n)
+
+    benchmark.pedantic(stream, rounds=3, iterations=1)
+
+    # The scope picks the nearest sample interval it can do, read it back from the block start times
+    dt = starts[1] / chunk_samples
+    delivered = np.mean(received) / collect_time
+    benchmark.extra_info['samples_per_s'] = 2 * delivered
+    benchmark.extra_info['fraction_of_sample_rate'] = delivered * dt
+    assert pico.stream_driver_overruns == 0
+    assert delivered * dt > 0.95
+
+
+def test_streaming_callback_latency(benchmark, pico):
+    """Age of the newest sample in each chunk when it reaches python"""
+    pico.setup_channel(channel='A', sample_rate=100000, voltage_range=2)
+    chunk_samples = 1000
+    arrivals = []
+
+    def stream():
+        begin = time.perf_counter()
+        for t0, chunk in pico.iter_stream(chunk_samples=chunk_samples, collect_time=0.3):
+            arrivals.append((time.perf_counter() - begin, t0, len(chunk)))
+
+    benchmark.pedantic(stream, rounds=3, iterations=1)
+
+    dt = arrivals[1][1] / chunk_samples
+    latencies = [arrived - t0 - n * dt for arrived, t0, n in arrivals]
+    benchmark.extra_info['median_latency_s'] = float(np.median(latencies))
+    assert np.median(latencies) < 0.05
@@ -0,0 +1,60 @@
+import json
+
+from labequipment import picoscope
+from labequipment._picoscope_sim import SimulatedPs2000, SimulatedPs2000a
+
+
+class CountingPs2000a(SimulatedPs2000a):
+    enumerations = 0
+
+    def ps2000aEnumerateUnits(self, count, serials, serial_length):
+        self.enumerations += 1
+        return super().ps2000aEnumerateUnits(count, serials, serial_length)
+
+
+def test_list_and_open_several_scopes(tmp_path):
+    drivers = {'2000a': SimulatedPs2000a(units=2), '2000': SimulatedPs2000(units=0)}
+    cache_file = str(tmp_path / 'picoscopes.json')
+
+    scopes = picoscope.list_scopes(drivers=drivers)
+    assert [scope['backend'] for scope in scopes] == ['2000a', '2000a']
+
+    picos = picoscope.open_scopes(drivers=drivers, cache_file=cache_file)
+    assert [pico.serial for pico in picos] == [scope['serial'] for scope in scopes]
+    for pico in picos:
+        pico.close_scope()
+
+
+def test_cached_backend_is_opened_directly(tmp_path):
+    cache_file = str(tmp_path / 'picoscopes.json')
+    drivers = {'2000a': CountingPs2000a(units=0), '2000': SimulatedPs2000(serials=['AB123/0001'])}
+
+    pico = picoscope.PicoScopeDAQ(drivers=drivers, cache_file=cache_file)
+    pico.close_scope()
+    assert json.load(open(cache_file)) == {'AB123/0001': '2000'}
+
+    assert drivers['2000a'].enumerations == 1
+    pico = picoscope.PicoScopeDAQ(drivers=drivers, cache_file=cache_file)
+    assert pico.serial == 'AB123/0001'
+    # Straight to the 2000 backend without enumerating 2000a units first
+    assert drivers['2000a'].enumerations == 1
+    pico.close_scope()
+
+
+def test_failed_cache_write_keeps_the_old_cache(tmp_path):
+    cache_file = str(tmp_path / 'picoscopes.json')
+    picoscope._save_cache(cache_file, {'AB123/0001': '2000'})
+    picoscope._save_cache(cache_file, {b'AB123/0001': '2000'})
+    assert json.load(open(cache_file)) == {'AB123/0001': '2000'}
+    assert list(tmp_path.iterdir()) == [tmp_path / 'picoscopes.json']
+
+
+def test_scope_is_closed_if_it_cannot_be_registered(tmp_path, monkeypatch):
+    driver = SimulatedPs2000(serials=['AB123/0001'])
+
+    def fail(cache_file, cache):
+        raise RuntimeError('cache')
+
+    monkeypatch.setattr(picoscope, '_save_cache', fail)
+    assert picoscope.PicoScopeDAQ(drivers={'2000': driver}, cache_file=str(tmp_path / 'picoscopes.json')) is None
+    assert driver._units == {}
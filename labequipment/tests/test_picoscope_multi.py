@@ -0,0 +1,51 @@
+import time
+
+import numpy as np
+
+from labequipment.picoscope_multi import MultiScopeDAQ
+from labequipment._picoscope_sim import SimulatedPs2000a, Waveform
+
+
+def test_multi_scope_capture_is_stacked_and_aligned():
+    with MultiScopeDAQ(drivers={'2000a': SimulatedPs2000a(units=2)}) as daq:
+        daq.setup_channel(channel='Both', sample_rate=100000, voltage_range=2)
+        daq.setup_trigger(channel='A', threshold=0.5)
+        time_s, data = daq.start(samples=1000)
+
+        assert data.shape == (4, 1000)
+        assert len(time_s) == 1000
+        assert [name.split(':')[1] for name in daq.channel_names] == ['A', 'B', 'A', 'B']
+        # Both scopes see the same signal and capture from the same trigger
+        np.testing.assert_allclose(data[0], data[2])
+
+
+class FreeRunningPs2000a(SimulatedPs2000a):
+    """Untriggered blocks start wherever the signal has got to when the scope is told to run"""
+
+    def _block_data(self, handle, segment=0):
+        t_start, counts = super()._block_data(handle, segment)
+        unit = self._units[handle]
+        if unit.trigger:
+            return t_start, counts
+        t = unit.block['start'] + np.arange(unit.block['samples']) * unit.block['interval']
+        return unit.block['start'], self._samples(unit, t)
+
+
+def test_untriggered_captures_are_aligned_on_when_acquisition_started():
+    driver = FreeRunningPs2000a(units=2, waveform=Waveform('triangle', frequency=1))
+    with MultiScopeDAQ(drivers={'2000a': driver}) as daq:
+        daq.setup_channel(channel='A', sample_rate=100000, voltage_range=2)
+        slow = daq.scopes[1]
+        plan = slow._acquisition_plan
+
+        def slow_plan(*args, **kwargs):
+            # Setting up the capture takes one scope much longer
+            time.sleep(0.03)
+            return plan(*args, **kwargs)
+
+        slow._acquisition_plan = slow_plan
+        time_s, data = daq.start(samples=8000)
+
+        assert len(time_s) < 8000
+        # 0.03 s out would be 0.12 V apart on this signal
+        np.testing.assert_allclose(data[0], data[1], atol=0.02)
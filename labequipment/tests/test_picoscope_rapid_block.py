@@ -0,0 +1,33 @@
+import pytest
+from picosdk.errors import PicoSDKCtypesError
+
+from labequipment import _picoscope_2000a
+from labequipment._picoscope_sim import SimulatedPs2000a, PICO_INVALID_HANDLE
+
+
+def test_failed_rapid_block_goes_back_to_one_segment(monkeypatch):
+    driver = SimulatedPs2000a()
+    pico = _picoscope_2000a.PicoScopeDAQ(driver=driver)
+    pico.setup_channel(channel='A', sample_rate=100000, voltage_range=2)
+    _, data_a, _ = pico.start_rapid_block(n_captures=5, samples=100)
+    assert data_a.shape == (5, 100)
+
+    segments = []
+    memory_segments = driver.ps2000aMemorySegments
+
+    def count_segments(handle, n_segments, max_samples):
+        segments.append(n_segments)
+        return memory_segments(handle, n_segments, max_samples)
+
+    monkeypatch.setattr(driver, 'ps2000aMemorySegments', count_segments)
+    monkeypatch.setattr(driver, 'ps2000aGetValuesBulk', lambda *args: PICO_INVALID_HANDLE)
+    with pytest.raises(PicoSDKCtypesError):
+        pico.start_rapid_block(n_captures=5, samples=100)
+    with pytest.raises(ValueError):
+        pico.start_rapid_block(n_captures=5, samples=10 ** 9)
+    assert segments == [5, 1, 5, 1]
+
+    # Block mode still gets the whole memory
+    capture = pico.start(samples=1000)
+    pico.close_scope()
+    assert len(capture.time) == 1000
@@ -0,0 +1,151 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from labequipment import _picoscope_2000, _picoscope_2000a
+from labequipment._picoscope_common import RingBuffer
+from labequipment._picoscope_sim import SimulatedPs2000, SimulatedPs2000a, Waveform
+
+BACKENDS = [(_picoscope_2000, SimulatedPs2000), (_picoscope_2000a, SimulatedPs2000a)]
+
+
+@pytest.mark.parametrize('backend, driver', BACKENDS)
+def test_stream_keeping_up_loses_nothing(backend, driver):
+    pico = backend.PicoScopeDAQ(driver=driver())
+    pico.setup_channel(channel='Both', sample_rate=100000, voltage_range=2)
+
+    received = sum(chunk.shape[-1] for _, chunk in pico.iter_stream(chunk_samples=5000, collect_time=0.2))
+    pico.close_scope()
+
+    assert pico.stream_driver_overruns == 0
+    assert pico.stream_over_voltage == set()
+    if backend is _picoscope_2000a:
+        # The 2000a stops itself after collect_time of samples, the ps2000 is stopped after collect_time of wall time
+        assert received == 20000
+
+
+@pytest.mark.parametrize('backend, driver, sample_rate, chunk_samples, pause', [
+    # The ps2000 overview buffer holds 100000 samples, the 2000a one a chunk
+    (_picoscope_2000, SimulatedPs2000, 1000000, 50000, 0.15),
+    (_picoscope_2000a, SimulatedPs2000a, 100000, 1000, 0.03),
+])
+def test_overrun_is_reported_when_the_driver_is_not_polled_in_time(backend, driver, sample_rate, chunk_samples, pause):
+    pico = backend.PicoScopeDAQ(driver=driver())
+    pico.setup_channel(channel='A', sample_rate=sample_rate, voltage_range=2)
+
+    received = 0
+    for _, chunk in pico.iter_stream(chunk_samples=chunk_samples, collect_time=0.5):
+        received += chunk.shape[-1]
+        time.sleep(pause)
+    pico.close_scope()
+
+    assert pico.stream_driver_overruns > 0
+    assert received < 0.5 / pico.stream_interval
+    assert pico.stream_over_voltage == set()
+
+
+@pytest.mark.parametrize('backend, driver', BACKENDS)
+def test_clipping_is_reported_as_over_voltage_not_lost_samples(backend, driver):
+    # 3 V peaks on a 2 V range
+    pico = backend.PicoScopeDAQ(driver=driver(waveform=Waveform('sine', frequency=100, amplitude=3)))
+    pico.setup_channel(channel='Both', sample_rate=100000, voltage_range=2)
+
+    list(pico.iter_stream(chunk_samples=5000, collect_time=0.2))
+    pico.close_scope()
+
+    assert pico.stream_over_voltage == {'A', 'B'}
+    assert pico.stream_driver_overruns == 0
+
+
+def test_ring_buffer_wraps_at_exactly_its_capacity():
+    ring = RingBuffer(10, n_channels=2)
+    assert ring.write([np.arange(6), -np.arange(6)])
+    assert ring.read(4)[0] == 0
+    assert ring.read()[0] == 4
+    # Fills the ring exactly, wrapping round from sample 6
+    chunk = np.arange(6, 16)
+    assert ring.write([chunk, -chunk])
+    assert ring.available == 10
+    index, samples = ring.read()
+    assert index == 6
+    assert np.array_equal(samples, [chunk, -chunk])
+    assert ring.overruns == ring.dropped_samples == 0
+
+
+def test_ring_buffer_reports_where_data_was_dropped():
+    ring = RingBuffer(10)
+    assert ring.write(np.arange(8))
+    # No room for either, one overrun of 5 + 3 samples
+    assert not ring.write(np.arange(8, 13))
+    assert not ring.write(np.arange(13, 16))
+    assert ring.write(np.arange(16, 18))
+    assert (ring.overruns, ring.dropped_samples, ring.total_samples) == (1, 8, 18)
+
+    # A read stops at the gap, the next starts after it with its own index
+    index, samples = ring.read()
+    assert index == 0 and np.array_equal(samples, np.arange(8))
+    index, samples = ring.read()
+    assert index == 16 and np.array_equal(samples, [16, 17])
+    assert ring.read()[1].size == 0
+
+
+def test_ring_buffer_with_a_slow_reader_on_another_thread():
+    ring = RingBuffer(1000)
+    chunks = 400
+
+    def produce():
+        for i in range(chunks):
+            # Each sample holds its own sample number, wrapped to fit int16
+            ring.write((np.arange(i * 100, (i + 1) * 100) % 30000).astype(np.int16))
+            time.sleep(0.0005)
+
+    producer = threading.Thread(target=produce)
+    producer.start()
+    reads = []
+    while producer.is_alive() or ring.available:
+        index, samples = ring.read(250)
+        if samples.size:
+            reads.append((index, samples))
+        time.sleep(0.01)
+    producer.join()
+
+    assert ring.overruns > 0
+    next_index = 0
+    for index, samples in reads:
+        assert index >= next_index
+        assert np.array_equal(samples, np.arange(index, index + len(samples)) % 30000)
+        next_index = index + len(samples)
+    assert sum(len(samples) for _, samples in reads) + ring.dropped_samples == chunks * 100
+
+
+def test_async_stream_with_a_slow_consumer_reports_gaps():
+    driver = SimulatedPs2000a(waveform=Waveform('sine', frequency=200))
+    pico = _picoscope_2000a.PicoScopeDAQ(driver=driver)
+    pico.setup_channel(channel='A', sample_rate=20000, voltage_range=2)
+
+    # The ring holds 0.1 s of data, reading every 0.2 s falls behind
+    pico.start_streaming_async(buffer_seconds=0.1, chunk_samples=2000)
+    reads = []
+    begin = time.perf_counter()
+    while time.perf_counter() - begin < 0.8:
+        time.sleep(0.2)
+        reads.append(pico.read_available())
+    pico.stop_streaming()
+    reads.append(pico.read_available())
+    pico.close_scope()
+
+    dt = pico.stream_interval
+    assert pico.stream_overruns > 0 and pico.stream_dropped_samples > 0
+    assert pico.stream_driver_overruns == 0
+    next_t0 = 0
+    gaps = 0
+    for t0, chunk in reads:
+        assert t0 >= next_t0 - dt / 2
+        gaps += t0 > next_t0 + dt / 2
+        # t0 says which samples these are, check them against the simulated signal
+        expected = driver.waveform.counts(t0 + np.arange(len(chunk)) * dt, 0, 7, driver.MAX_ADC)
+        assert np.allclose(chunk, expected, atol=50)
+        next_t0 = t0 + len(chunk) * dt
+    assert gaps > 0
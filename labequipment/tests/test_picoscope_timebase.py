@@ -0,0 +1,46 @@
+from ctypes import byref, c_int16, c_int32
+
+import pytest
+
+from labequipment._picoscope_2000 import get_timebase
+from labequipment._picoscope_sim import SimulatedPs2000
+
+
+def scan_timebases(device, samples, wanted_time_interval):
+    """The search get_timebase replaced: step through the timebases until one is as slow as wanted"""
+    previous = None
+    for timebase in range(2 ** 15):
+        time_interval, time_units, max_samples = c_int32(), c_int16(), c_int32()
+        ok = device.driver.ps2000_get_timebase(device.handle, timebase, samples, byref(time_interval),
+                                               byref(time_units), 1, byref(max_samples))
+        if ok and time_interval.value >= wanted_time_interval:
+            return previous
+        if ok:
+            previous = timebase, time_interval.value
+    raise AssertionError('No timebase is slow enough')
+
+
+@pytest.fixture
+def device():
+    driver = SimulatedPs2000()
+    device = driver.open_unit()
+    yield device
+    driver.ps2000_close_unit(device.handle)
+
+
+# The simulated 2204A samples every 10 * 2**timebase ns. 20 and 5120 are timebases exactly, the rest fall in between
+@pytest.mark.parametrize('wanted', [20, 40.5, 1000, 1E9/3000, 5120, 1E9/100, 1E6])
+def test_bisection_finds_the_timebase_a_scan_does(device, wanted):
+    timebase, interval, _ = get_timebase(device, 1000, wanted)
+    assert (timebase, interval) == scan_timebases(device, 1000, wanted)
+    assert interval < wanted <= 2 * interval
+
+
+def test_fastest_timebase_has_its_interval(device):
+    # Every timebase is as slow as wanted, the fastest is the nearest
+    assert get_timebase(device, 1000, 10)[:2] == (0, 10)
+
+
+def test_too_many_samples_for_any_timebase(device):
+    with pytest.raises(Exception, match='too many samples'):
+        get_timebase(device, 10 ** 6, 1000)
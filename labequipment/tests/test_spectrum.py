@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from labequipment import _picoscope_2000a
+from labequipment._picoscope_sim import SimulatedPs2000a, Waveform
+from labequipment.spectrum import StreamingSpectrum, live_spectrum
+
+
+def test_chunked_welch_matches_whole_record():
+    signal = pytest.importorskip('scipy.signal')
+    fs = 10000
+    rng = np.random.default_rng(0)
+    x = np.stack((np.sin(2 * np.pi * 1234.5 * np.arange(100000) / fs), rng.normal(size=100000)))
+
+    spectrum = StreamingSpectrum(1 / fs, nperseg=1024)
+    for start in range(0, x.shape[-1], 7777):
+        spectrum.update(x[:, start:start + 7777])
+
+    _, psd = signal.welch(x, fs, window=np.hanning(1024), nperseg=1024, noverlap=512)
+    np.testing.assert_allclose(spectrum.psd, psd)
+    np.testing.assert_allclose(spectrum.rms, np.sqrt(np.mean(x ** 2, axis=-1)))
+    assert spectrum.peak_frequency[0] == pytest.approx(1234.5, abs=fs / 1024)
+
+
+def test_live_spectrum_from_stream():
+    pico = _picoscope_2000a.PicoScopeDAQ(driver=SimulatedPs2000a(waveform=Waveform('sine', frequency=1000)))
+    pico.setup_channel(channel='A', sample_rate=100000, voltage_range=2)
+
+    updates = list(live_spectrum(pico, collect_time=0.3, nperseg=1024))
+    pico.close_scope()
+
+    spectrum = updates[-1][1]
+    assert spectrum.psd.shape == (513,)
+    assert spectrum.peak_frequency == pytest.approx(1000, abs=100)
+    assert spectrum.rms == pytest.approx(1 / np.sqrt(2), rel=0.01)
@@ -0,0 +1,166 @@
+import os
+import pty
+import queue
+import threading
+import time
+
+import pytest
+import serial
+
+from labequipment.arduino import Arduino
+from labequipment.stepper import FramedStepper, FrameParser, encode_frame, ACK, MOVE
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'openpty'), reason='needs a pseudo terminal for the simulated board')
+
+
+@pytest.fixture
+def board_factory():
+    from labequipment._stepper_sim import SimulatedStepperBoard
+    made = []
+
+    def make(**kwargs):
+        board = SimulatedStepperBoard(**kwargs)
+        stepper = FramedStepper(Arduino({'PORT': board.port, 'BAUDRATE': 115200}, reset=False))
+        made.append((board, stepper))
+        return board, stepper
+
+    yield make
+    for board, stepper in made:
+        stepper.close()
+        stepper.ard.quit_serial()
+        board.close()
+
+
+def test_parser_skips_noise_and_corrupt_frames():
+    good = encode_frame(5, MOVE, b'\x01\x10\x00\x00\x00')
+    corrupt = bytearray(good)
+    corrupt[6] ^= 0x01
+    parser = FrameParser()
+    frames = parser.feed(b'System ready.\r\n' + bytes(corrupt) + good[:4])
+    frames += parser.feed(good[4:] + encode_frame(6, MOVE))
+    assert frames == [(5, MOVE, b'\x01\x10\x00\x00\x00'), (6, MOVE, b'')]
+
+
+def test_parser_does_not_wait_on_a_stray_sync():
+    # 0x7E then a length no frame can have, the ACK after it must come out straight away
+    ack = encode_frame(3, ACK, b'\x07')
+    assert FrameParser().feed(b'\x7e\xff' + ack) == [(3, ACK, b'\x07')]
+
+
+def test_moves_are_pipelined_without_sleeps(board_factory):
+    board, stepper = board_factory()
+    assert stepper.ping() < 0.01
+
+    begin = time.perf_counter()
+    assert stepper.move_motor(1, 10, '+')
+    assert time.perf_counter() - begin < 0.02
+
+    # 20 moves of 20 ms each, more than the board can queue at once
+    seqs = [stepper.queue_move(2, 1000, '-' if i % 2 else '+').seq for i in range(20)]
+    assert stepper.wait_all(timeout=5)
+    assert [move[0] for move in board.moves[1:]] == seqs
+    assert board.positions == {1: 10, 2: 0}
+    assert not stepper.busy
+
+
+def test_lost_and_corrupt_frames_are_recovered(board_factory):
+    board, stepper = board_factory(corrupt_received={2, 6}, drop_sent={3, 5, 9})
+    for i in range(10):
+        stepper.queue_move(1, 100 * (i + 1), '+')
+    assert stepper.wait_all(timeout=5)
+    assert [move[2] for move in board.moves] == [100 * (i + 1) for i in range(10)]
+
+
+def test_invalid_move_is_rejected(board_factory):
+    board, stepper = board_factory()
+    assert not stepper.move_motor(3, 10, '+')
+    assert not stepper.move_motor(1, 200000, '+')
+    assert stepper.move_motor(1, 10, '-')
+    assert board.positions[1] == -10
+
+
+def test_motors_move_together(board_factory):
+    board, stepper = board_factory()
+    begin = time.perf_counter()
+    assert stepper.move_motor(1, 5000, '+')
+    assert stepper.move_motor(2, 5000, '-')
+    one_after_another = time.perf_counter() - begin
+
+    begin = time.perf_counter()
+    futures = stepper.move_many([(1, 5000, '-'), (2, 5000, '+')])
+    assert not any(future.done() for future in futures)
+    assert stepper.wait_all(timeout=2)
+    together = time.perf_counter() - begin
+
+    assert [future.result() for future in futures] == [True, True]
+    assert board.positions == {1: 0, 2: 0}
+    assert together < 0.7 * one_after_another
+
+
+def test_callbacks_can_queue_the_next_move(board_factory):
+    board, stepper = board_factory()
+    second = queue.Queue()
+    first = stepper.queue_move(1, 100, '+')
+    first.add_done_callback(lambda future: second.put(stepper.queue_move(2, 100, '+')))
+    assert first.result(timeout=1)
+    assert second.get(timeout=1).result(timeout=1)
+    assert board.positions == {1: 100, 2: 100}
+
+
+def test_more_moves_than_sequence_numbers(board_factory):
+    board, stepper = board_factory()
+    futures = [stepper.queue_move(1 + i % 2, 1, '+') for i in range(300)]
+    assert stepper.wait_all(timeout=10)
+    assert all(future.result() for future in futures)
+    assert len(board.moves) == 300
+    assert board.positions == {1: 150, 2: 150}
+
+
+def test_idle_motor_does_not_finish_the_other_motors_move(board_factory):
+    board, stepper = board_factory(steps_per_sec=20000)
+    assert stepper.move_motor(1, 1, '+')
+    for _ in range(255):
+        stepper.queue_move(2, 1, '+')
+    assert stepper.wait_all(timeout=10)
+
+    # Same SEQ as motor 1's last move, which every PING reports
+    future = stepper.queue_move(2, 30000, '+')
+    assert future.seq == board.moves[0][0]
+    time.sleep(1)
+    assert not future.done()
+    assert future.result(timeout=3)
+    assert board.positions == {1: 1, 2: 30255}
+
+
+def test_pending_moves_fail_if_the_reader_stops(board_factory, monkeypatch):
+    board, stepper = board_factory(steps_per_sec=1000)
+
+    def unplugged(no_of_bytes, timeout=None):
+        raise serial.SerialException('device disconnected')
+
+    future = stepper.queue_move(1, 1000, '+')
+    monkeypatch.setattr(stepper.ard, 'read_serial_bytes', unplugged)
+    with pytest.raises(serial.SerialException):
+        future.result(timeout=2)
+    with pytest.raises(serial.SerialException):
+        stepper.queue_move(1, 10, '+')
+
+
+def test_moves_resume_after_giving_up(board_factory):
+    board, stepper = board_factory(corrupt_received=range(1, 40))
+    with pytest.raises(TimeoutError):
+        stepper.queue_move(1, 10, '+').result(timeout=5)
+    assert stepper.queue_move(1, 20, '+').result(timeout=5)
+    assert board.positions[1] == 20
+
+
+def test_no_board_leaves_no_reader_behind():
+    controller, peripheral = pty.openpty()
+    ard = Arduino({'PORT': os.ttyname(peripheral), 'BAUDRATE': 115200}, reset=False)
+    threads = threading.active_count()
+    with pytest.raises(TimeoutError):
+        FramedStepper(ard)
+    assert threading.active_count() == threads
+    ard.quit_serial()
+    os.close(controller)
+    os.close(peripheral)
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from labequipment import _picoscope_2000, _picoscope_2000a
+from labequipment._picoscope_common import Capture, TimeAxis
+from labequipment._picoscope_sim import SimulatedPs2000, SimulatedPs2000a
+
+
+@pytest.fixture(params=[(_picoscope_2000, SimulatedPs2000), (_picoscope_2000a, SimulatedPs2000a)], ids=['ps2000', 'ps2000a'])
+def capture(request):
+    backend, driver = request.param
+    pico = backend.PicoScopeDAQ(driver=driver())
+    pico.setup_channel(channel='Both', sample_rate=100000, voltage_range=2)
+    capture = pico.start(samples=1000)
+    pico.close_scope()
+    return capture
+
+
+def test_capture_unpacks_like_the_old_tuple(capture):
+    time_s, a, b = capture
+    assert isinstance(time_s, TimeAxis)
+    assert len(time_s) == len(a) == len(b) == 1000
+    assert capture.interval == time_s.dt > 0
+
+    times, a_again, _ = capture.as_tuple()
+    assert isinstance(times, np.ndarray) and times.dtype == np.float64
+    assert np.allclose(times, time_s.t0 + np.arange(1000) * time_s.dt)
+    assert a_again is a
+    assert np.array_equal(np.asarray(time_s), times)
+
+
+def test_time_axis_indexes_and_slices_like_its_array(capture):
+    time_s = capture.time
+    times = capture.as_tuple()[0]
+    assert time_s[0] == times[0] and time_s[-1] == pytest.approx(times[-1])
+    assert np.allclose(time_s[10:500:7], times[10:500:7])
+    assert len(time_s[10:500:7]) == len(times[10:500:7])
+    with pytest.raises(IndexError):
+        time_s[1000]
+
+
+def test_arithmetic_with_numbers_stays_lazy(capture):
+    time_s = capture.time
+    times = capture.as_tuple()[0]
+    for result, expected in [(time_s + 1, times + 1), (2 + time_s, 2 + times), (time_s - 0.5, times - 0.5),
+                             (1 - time_s, 1 - times), (-time_s, -times), (time_s * 1000, times * 1000),
+                             (3 * time_s, 3 * times), (time_s * np.float64(3), times * 3), (time_s / 2, times / 2)]:
+        assert isinstance(result, TimeAxis)
+        assert np.allclose(result, expected)
+
+
+def test_arithmetic_with_arrays_gives_arrays(capture):
+    time_s = capture.time
+    times = capture.as_tuple()[0]
+    weights = np.linspace(0, 1, 1000)
+    for result, expected in [(time_s * weights, times * weights), (weights * time_s, weights * times),
+                             (time_s + weights, times + weights), (time_s - weights, times - weights),
+                             (time_s / (weights + 1), times / (weights + 1))]:
+        assert type(result) is np.ndarray
+        assert np.allclose(result, expected)
+    with pytest.raises(TypeError):
+        time_s * 'seconds'
+
+
+def test_comparisons_select_samples(capture):
+    time_s, a, _ = capture
+    times = capture.as_tuple()[0]
+    middle = times[500]
+    assert np.array_equal(time_s > middle, times > middle)
+    assert np.array_equal(time_s <= middle, times <= middle)
+    assert np.array_equal(a[time_s >= middle], a[times >= middle])
+    assert np.array_equal(time_s == times, np.ones(1000, dtype=bool))
+
+
+def test_capture_of_a_disabled_channel():
+    capture = Capture(TimeAxis(0, 1e-3, 5), np.arange(5.0), None)
+    time_s, a, b = capture
+    assert b is None
+    assert np.allclose(time_s, [0, 1e-3, 2e-3, 3e-3, 4e-3])
+    assert capture[1] is a and len(capture) == 3